@@ -0,0 +1,692 @@
+import datetime
+import email.message
+import email.utils
+import glob
+import gzip
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import time
+import zipfile
+from pathlib import Path
+
+import pymysql
+import typer
+
+from config import cfg, converters
+from file import File, run_step
+from storage import Storage
+from util import (place_file, PLACEMENTS, delete_file_or_dir,
+                  remove_scratch_dir, Progress, Tracer)
+from util.trace import STAGES
+
+app = typer.Typer()
+pwconv_path = Path(__file__).parent.resolve()
+
+# Words in generated documents, with letters outside ascii
+WORDS = ('arkiv dokument saksbehandler vedtak møte referat søknad '
+         'kommune tilsynsrapport årsmelding budsjett økonomi plan '
+         'eiendom vei skole barnehage helse kultur utvalg sak').split()
+# Fixed timestamp of generated archives and messages
+TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+# Formats of files before and after the stub conversion
+# in the orchestration benchmark
+STUB_MIME = 'application/x-pwconvert-benchmark'
+STUB_DEST_MIME = 'application/x-pwconvert-benchmark-converted'
+
+
+@app.callback()
+def main():
+    """Benchmarks for PWConvert"""
+
+
+@app.command()
+def placement(source: str, dest: str, files: int = 100, size: int = 10):
+    """
+    Measure throughput of the ways kept files can be placed in DEST
+
+    Writes FILES files of SIZE MB in SOURCE, and places them in DEST
+    with each strategy of `placement` in application.yml. Use folders
+    on the filesystems to be used for conversion.
+    """
+    source_dir = os.path.join(source, 'pwconvert-benchmark')
+    os.makedirs(source_dir, exist_ok=True)
+    paths = []
+    for i in range(files):
+        path = os.path.join(source_dir, f'{i}.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size * 1024 * 1024))
+        paths.append(path)
+    os.sync()
+
+    print('placement\tmethod\tseconds\tMB/s')
+    for strategy in PLACEMENTS:
+        dest_dir = os.path.join(dest, 'pwconvert-benchmark-' + strategy)
+        os.makedirs(dest_dir, exist_ok=True)
+        methods = set()
+        t0 = time.time()
+        for path in paths:
+            methods.add(place_file(path, os.path.join(dest_dir,
+                                                      os.path.basename(path)),
+                                   strategy))
+        os.sync()
+        seconds = time.time() - t0
+        print(f"{strategy}\t{','.join(sorted(methods))}\t{seconds:.2f}\t"
+              f"{files * size / seconds:.0f}")
+        shutil.rmtree(dest_dir)
+
+    shutil.rmtree(source_dir)
+
+
+def _words(rng: random.Random, count: int) -> str:
+    return ' '.join(rng.choice(WORDS) for i in range(count))
+
+
+def _lines(rng: random.Random, count: int) -> list[str]:
+    return [_words(rng, rng.randint(4, 16)).capitalize() + '.'
+            for i in range(count)]
+
+
+def _write_zip(path: str, members: dict[str, str]) -> None:
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, data in members.items():
+            # The mimetype of OpenDocument files must be first, uncompressed
+            compression = (zipfile.ZIP_STORED if name == 'mimetype'
+                           else zipfile.ZIP_DEFLATED)
+            zf.writestr(zipfile.ZipInfo(name, TIMESTAMP), data, compression)
+
+
+def _write_text(path, rng, scale, template='{}'):
+    text = template.format('\n'.join(_lines(rng, 20 * scale)))
+    # Written in latin-1, so that the text converters have work to do
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(text)
+
+
+def _write_csv(path, rng, scale):
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write('id;name;amount\n')
+        for i in range(50 * scale):
+            f.write(f'{i};{_words(rng, 2)};{rng.randint(0, 100000)}\n')
+
+
+def _write_json(path, rng, scale):
+    with open(path, 'w', encoding='latin-1') as f:
+        json.dump([{'id': i, 'title': _words(rng, 3), 'text': line}
+                   for i, line in enumerate(_lines(rng, 10 * scale))],
+                  f, ensure_ascii=False)
+
+
+def _write_html(path, rng, scale):
+    paragraphs = ''.join(f'<p>{line}</p>' for line in _lines(rng, 20 * scale))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html><html><head><meta charset="utf-8">'
+                f'<title>{_words(rng, 3)}</title></head>'
+                f'<body><h1>{_words(rng, 3)}</h1>{paragraphs}</body></html>')
+
+
+def _write_xhtml(path, rng, scale):
+    paragraphs = ''.join(f'<p>{line}</p>' for line in _lines(rng, 20 * scale))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>'
+                '<html xmlns="http://www.w3.org/1999/xhtml">'
+                f'<head><title>{_words(rng, 3)}</title></head>'
+                f'<body>{paragraphs}</body></html>')
+
+
+def _write_rtf(path, rng, scale):
+    # Letters outside ascii as rtf escapes
+    lines = [''.join(c if ord(c) < 128 else f"\\'{ord(c):02x}" for c in line)
+             for line in _lines(rng, 20 * scale)]
+    with open(path, 'w', encoding='ascii') as f:
+        f.write('{\\rtf1\\ansi\\deff0{\\fonttbl{\\f0 Times New Roman;}}'
+                '\\f0\\fs24 ' + '\\par\n'.join(lines) + '\\par}')
+
+
+def _write_postscript(path, rng, scale):
+    lines = [line.encode('ascii', 'replace').decode()
+             for line in _lines(rng, 40 * scale)]
+    with open(path, 'w', encoding='ascii') as f:
+        f.write('%!PS-Adobe-3.0\n/Times-Roman findfont 10 scalefont setfont\n')
+        for i in range(0, len(lines), 60):
+            for j, line in enumerate(lines[i:i + 60]):
+                f.write(f'40 {780 - j * 12} moveto ({line}) show\n')
+            f.write('showpage\n')
+
+
+def _write_eml(path, rng, scale):
+    msg = email.message.EmailMessage()
+    msg['From'] = 'Arkiv <arkiv@example.com>'
+    msg['To'] = 'Saksbehandler <post@example.com>'
+    msg['Subject'] = _words(rng, 4).capitalize()
+    msg['Date'] = email.utils.format_datetime(
+        datetime.datetime(*TIMESTAMP, tzinfo=datetime.timezone.utc)
+    )
+    msg['Message-ID'] = f'<{rng.getrandbits(64):x}@example.com>'
+    msg.set_content('\n'.join(_lines(rng, 10 * scale)))
+    msg.add_attachment('\n'.join(_lines(rng, 10 * scale)),
+                       filename='vedlegg.txt')
+    # Else the boundary is random
+    msg.set_boundary(f'{rng.getrandbits(64):x}')
+    with open(path, 'wb') as f:
+        f.write(bytes(msg))
+
+
+def _write_gzip(path, rng, scale):
+    data = '\n'.join(_lines(rng, 200 * scale)).encode()
+    with open(path, 'wb') as f:
+        with gzip.GzipFile('data.txt', 'wb', fileobj=f, mtime=0) as gz:
+            gz.write(data)
+
+
+def _write_archive(path, rng, scale):
+    _write_zip(path, {f'dokument-{i}.txt': '\n'.join(_lines(rng, 50))
+                      for i in range(2 * scale)})
+
+
+def _write_image(path, rng, scale):
+    from PIL import Image
+
+    # Noise in blocks, so that it compresses somewhat like a scan
+    width, height = 160 * scale, 120 * scale
+    small = Image.frombytes('RGB', (width // 8, height // 8),
+                            rng.randbytes(width // 8 * height // 8 * 3))
+    small.resize((width, height)).save(path)
+
+
+def _write_docx(path, rng, scale):
+    paragraphs = ''.join(f'<w:p><w:r><w:t>{line}</w:t></w:r></w:p>'
+                         for line in _lines(rng, 20 * scale))
+    _write_zip(path, {
+        '[Content_Types].xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types"><Default Extension="rels" ContentType="'
+            'application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="'
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+            'document.main+xml"/></Types>',
+        '_rels/.rels':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+            '2006/relationships"><Relationship Id="rId1" Type="http://'
+            'schemas.openxmlformats.org/officeDocument/2006/relationships/'
+            'officeDocument" Target="word/document.xml"/></Relationships>',
+        'word/document.xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+            'wordprocessingml/2006/main"><w:body>'
+            f'{paragraphs}</w:body></w:document>',
+    })
+
+
+def _write_xlsx(path, rng, scale):
+    rows = ''.join(
+        f'<row r="{i}"><c r="A{i}"><v>{rng.randint(0, 100000)}</v></c>'
+        f'<c r="B{i}" t="inlineStr"><is><t>{_words(rng, 3)}</t></is></c></row>'
+        for i in range(1, 50 * scale + 1)
+    )
+    _write_zip(path, {
+        '[Content_Types].xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types"><Default Extension="rels" ContentType="'
+            'application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="'
+            'application/vnd.openxmlformats-officedocument.spreadsheetml.'
+            'sheet.main+xml"/><Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.'
+            'spreadsheetml.worksheet+xml"/></Types>',
+        '_rels/.rels':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+            '2006/relationships"><Relationship Id="rId1" Type="http://'
+            'schemas.openxmlformats.org/officeDocument/2006/relationships/'
+            'officeDocument" Target="xl/workbook.xml"/></Relationships>',
+        'xl/_rels/workbook.xml.rels':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+            '2006/relationships"><Relationship Id="rId1" Type="http://'
+            'schemas.openxmlformats.org/officeDocument/2006/relationships/'
+            'worksheet" Target="worksheets/sheet1.xml"/></Relationships>',
+        'xl/workbook.xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/'
+            'spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.'
+            'org/officeDocument/2006/relationships"><sheets><sheet '
+            'name="Ark1" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        'xl/worksheets/sheet1.xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/'
+            f'spreadsheetml/2006/main"><sheetData>{rows}</sheetData>'
+            '</worksheet>',
+    })
+
+
+def _write_opendocument(path, mime, body):
+    _write_zip(path, {
+        'mimetype': mime,
+        'META-INF/manifest.xml':
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:'
+            'opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+            '<manifest:file-entry manifest:full-path="/" '
+            f'manifest:media-type="{mime}"/><manifest:file-entry '
+            'manifest:full-path="content.xml" manifest:media-type="text/xml"/>'
+            '</manifest:manifest>',
+        'content.xml':
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<office:document-content xmlns:office="urn:oasis:names:tc:'
+            'opendocument:xmlns:office:1.0" xmlns:text="urn:oasis:names:tc:'
+            'opendocument:xmlns:text:1.0" xmlns:table="urn:oasis:names:tc:'
+            'opendocument:xmlns:table:1.0" office:version="1.2">'
+            f'<office:body>{body}</office:body></office:document-content>',
+    })
+
+
+def _write_odt(path, rng, scale):
+    paragraphs = ''.join(f'<text:p>{line}</text:p>'
+                         for line in _lines(rng, 20 * scale))
+    _write_opendocument(path, 'application/vnd.oasis.opendocument.text',
+                        f'<office:text>{paragraphs}</office:text>')
+
+
+def _write_ods(path, rng, scale):
+    rows = ''.join(
+        '<table:table-row><table:table-cell office:value-type="float" '
+        f'office:value="{rng.randint(0, 100000)}"/><table:table-cell '
+        f'office:value-type="string"><text:p>{_words(rng, 3)}</text:p>'
+        '</table:table-cell></table:table-row>'
+        for i in range(50 * scale)
+    )
+    _write_opendocument(
+        path, 'application/vnd.oasis.opendocument.spreadsheet',
+        '<office:spreadsheet><table:table table:name="Ark1">'
+        f'{rows}</table:table></office:spreadsheet>'
+    )
+
+
+# Extension and writer of generated files of each mime type. The writers
+# take the path, a seeded random generator and a scale from 1 and up
+CORPUS = {
+    'text/plain': ('.txt', _write_text),
+    'text/csv': ('.csv', _write_csv),
+    'text/css': ('.css', lambda path, rng, scale: _write_text(
+        path, rng, scale, 'body {{ font-family: serif; }}\n/* {} */')),
+    'text/markdown': ('.md', lambda path, rng, scale: _write_text(
+        path, rng, scale, '# Referat\n\n{}')),
+    'application/json': ('.json', _write_json),
+    'text/html': ('.html', _write_html),
+    'application/xhtml+xml': ('.xhtml', _write_xhtml),
+    'text/rtf': ('.rtf', _write_rtf),
+    'application/postscript': ('.ps', _write_postscript),
+    'message/rfc822': ('.eml', _write_eml),
+    'application/gzip': ('.gz', _write_gzip),
+    'application/zip': ('.zip', _write_archive),
+    'image/bmp': ('.bmp', _write_image),
+    'image/tiff': ('.tif', _write_image),
+    'image/x-tga': ('.tga', _write_image),
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        ('.docx', _write_docx),
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        ('.xlsx', _write_xlsx),
+    'application/vnd.oasis.opendocument.text': ('.odt', _write_odt),
+    'application/vnd.oasis.opendocument.spreadsheet': ('.ods', _write_ods),
+}
+
+# Formats without a writer, saved by LibreOffice from a generated file
+# of another format, when it's installed
+DERIVED = {
+    'application/msword': (
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+        'document', '.doc'
+    ),
+    'application/vnd.ms-excel': (
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        '.xls'
+    ),
+}
+
+
+def make_corpus(corpus_dir: str, mimes: list[str], files: int,
+                seed: int) -> dict[str, list[str]]:
+    """
+    Write files of each mime type, the same for the same seed
+
+    Returns:
+        paths of the files of each mime type that could be made
+    """
+    corpus = {}
+    soffice = shutil.which('soffice')
+    for mime in mimes:
+        if mime in CORPUS:
+            ext, writer = CORPUS[mime]
+        elif mime in DERIVED and soffice:
+            ext, writer = DERIVED[mime][1], None
+        else:
+            continue
+        folder = os.path.join(corpus_dir, mime.replace('/', '_'))
+        os.makedirs(folder, exist_ok=True)
+        # Each mime type gets its own generator, so that its files don't
+        # depend on which other types are generated
+        rng = random.Random(f'{seed}:{mime}')
+        paths = []
+        for i in range(files):
+            path = os.path.join(folder, f'{i}{ext}')
+            if writer:
+                writer(path, rng, i + 1)
+            else:
+                from_ext, from_writer = CORPUS[DERIVED[mime][0]]
+                from_path = os.path.join(folder, f'{i}{from_ext}')
+                from_writer(from_path, rng, i + 1)
+                subprocess.run([soffice, '--headless', '--convert-to',
+                                ext.lstrip('.'), '--outdir', folder, from_path],
+                               capture_output=True)
+                os.remove(from_path)
+                if not os.path.isfile(path):
+                    break
+            paths.append(path)
+        if paths:
+            corpus[mime] = paths
+
+    return corpus
+
+
+def get_rule(mime: str, ext: str) -> dict:
+    """Get converter of mime type, as applied to files with extension"""
+    converter = dict(converters[mime])
+    if 'source-ext' in converter and ext in converter['source-ext']:
+        converter.update(converter['source-ext'][ext])
+
+    return converter
+
+
+def make_file(mime: str, path: str) -> File:
+    """Get file of the generated corpus, as it would be read from database"""
+    row = {'id': None, 'path': os.path.basename(path), 'encoding': None,
+           'status': 'new', 'mime': mime, 'format': None, 'version': None,
+           'size': os.path.getsize(path), 'puid': None, 'source_id': None,
+           'kept': False}
+
+    return File(row, pwconv_path, False)
+
+
+def measure_rule(mime: str, converter: dict, command: str, paths: list[str],
+                 out_dir: str, repeat: int) -> dict:
+    """Convert files with one command of a converter, `repeat` times"""
+    latencies = []
+    failed = 0
+    size = 0
+    # The first conversion, which may load modules, isn't counted
+    for i in [-1] + list(range(repeat)):
+        for path in paths[:1] if i < 0 else paths:
+            src_file = make_file(mime, path)
+            dest_path = os.path.join(out_dir, Path(path).stem)
+            dest_path += src_file.get_dest_ext(converter, dest_path, False)
+            temp_path = os.path.join(out_dir, 'temp', src_file.path)
+            timeout = converter.get('timeout', cfg['timeout'])
+            if command == converter.get('engine'):
+                step = ('engine', command, path, dest_path, timeout, {})
+            else:
+                cmd = src_file.get_conversion_cmd(command, path, dest_path,
+                                                  temp_path)
+                step = ('command', cmd, pwconv_path, timeout, {})
+            t0 = time.perf_counter()
+            returncode, out, err = run_step(step)
+            seconds = time.perf_counter() - t0
+            if i >= 0:
+                latencies.append(seconds)
+                size += src_file.size
+                failed += bool(returncode) or not os.path.exists(dest_path)
+            delete_file_or_dir(dest_path)
+            delete_file_or_dir(os.path.join(out_dir, 'temp'))
+
+    total = sum(latencies)
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=20,
+                                           method='inclusive')
+        p50, p95 = percentiles[9], percentiles[18]
+    else:
+        p50 = p95 = latencies[0]
+
+    return {
+        'mime': mime,
+        'command': command,
+        'conversions': len(latencies),
+        'bytes': size,
+        'seconds': total,
+        'files_per_second': len(latencies) / total if total else 0,
+        'mb_per_second': size / 1e6 / total if total else 0,
+        'p50': p50,
+        'p95': p95,
+        'failure_rate': failed / len(latencies),
+    }
+
+
+@app.command('converters')
+def converter_rules(
+    dest: str,
+    mime: list[str] = typer.Option(None, help="Only these mime types"),
+    files: int = typer.Option(5, help="Files of each mime type"),
+    repeat: int = typer.Option(3, help="Conversions of each file"),
+    seed: int = typer.Option(0, help="Seed of the generated files"),
+    output: str = typer.Option('benchmark-converters.json',
+                               help="Write results to this JSON file"),
+    baseline: str = typer.Option(None, help="Results of an earlier run, "
+                                 "to compare with"),
+    keep: bool = typer.Option(False, help="Keep the generated files")
+):
+    """
+    Measure throughput and latency of each converter in converters.yml
+
+    Generates FILES files of each mime type with converters in DEST,
+    of growing size and the same for the same SEED, and converts each
+    of them REPEAT times with each engine and command of the converter.
+    Mime types that can't be generated, or whose converters are only
+    installed on other machines, are listed as skipped or failing, so
+    compare runs on the same machine.
+    """
+    rules = [m for m in converters
+             if 'command' in converters[m] or 'engine' in converters[m]
+             or 'source-ext' in converters[m]]
+    if mime:
+        rules = [m for m in rules if m in mime]
+    work_dir = os.path.join(dest, 'pwconvert-benchmark')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir, exist_ok=True)
+    corpus = make_corpus(os.path.join(work_dir, 'corpus'), rules, files, seed)
+
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = {(r['mime'], r['command']): r
+                        for r in json.load(f)['results']}
+
+    results = []
+    skipped = [m for m in rules if m not in corpus]
+    print('mime\tcommand\tfiles/s\tMB/s\tp50\tp95\tfailed'
+          + ('\tp50 change' if baseline else ''))
+    for m in rules:
+        if m not in corpus:
+            continue
+        converter = get_rule(m, Path(corpus[m][0]).suffix)
+        commands = make_file(m, corpus[m][0]).get_alternatives(converter)
+        if not commands:
+            skipped.append(m)
+            continue
+        for command in commands:
+            result = measure_rule(m, converter, command, corpus[m], out_dir,
+                                  repeat)
+            results.append(result)
+            line = (f"{m}\t{command}\t"
+                    f"{result['files_per_second']:.1f}\t"
+                    f"{result['mb_per_second']:.2f}\t{result['p50']:.3f}\t"
+                    f"{result['p95']:.3f}\t{result['failure_rate']:.0%}")
+            if baseline:
+                before = previous.get((m, command))
+                line += '\t' + (f"{result['p50'] / before['p50'] - 1:+.0%}"
+                                 if before and before['p50'] else '-')
+            print(line, flush=True)
+
+    if skipped:
+        print('Skipped, no generated files:', ', '.join(sorted(skipped)))
+    with open(output, 'w') as f:
+        json.dump({'seed': seed, 'files': files, 'repeat': repeat,
+                   'results': results, 'skipped': sorted(skipped)},
+                  f, indent=2)
+    remove_scratch_dir()
+    if not keep:
+        shutil.rmtree(work_dir)
+
+
+def make_tree(source_dir: str, files: int, per_folder: int = 1000) -> None:
+    """Write tiny files, in folders of `per_folder` files"""
+    for i in range(files):
+        if i % per_folder == 0:
+            folder = os.path.join(source_dir, f'{i // per_folder:05d}')
+            os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'{i}.txt'), 'w') as f:
+            f.write(f'{i}\n')
+
+
+def stub_metadata(self, source_path, source_dir):
+    """Identify file as the stub formats, without reading it"""
+    self.mime = STUB_DEST_MIME if source_path.endswith('.out') else STUB_MIME
+    self.format = 'PWConvert benchmark'
+    self.encoding = None
+
+
+def drop_mysql_database(name: str) -> None:
+    conn = pymysql.connect(host=cfg['db']['host'], user=cfg['db']['user'],
+                           password=cfg['db']['pass'])
+    with conn.cursor() as cursor:
+        cursor.execute(f'drop database if exists {name}')
+    conn.close()
+
+
+@app.command()
+def orchestration(
+    dest: str,
+    files: int = typer.Option(100000, help="Files in the largest tree"),
+    mysql: str = typer.Option(None, help="Also run on MySQL databases "
+                              "with this prefix, see `db` in application.yml"),
+    stub: str = typer.Option('engine', help="Stub converter: engine, "
+                             "copying in the worker, or command, running cp"),
+    jobs: int = typer.Option(cfg['jobs'], help="Conversions at the same "
+                             "time, when `pipeline` is set"),
+    output: str = typer.Option('benchmark-orchestration.json',
+                               help="Write results to this JSON file"),
+    keep: bool = typer.Option(False, help="Keep the generated files")
+):
+    """
+    Measure time spent per file on other work than conversion
+
+    Generates trees of tiny files in DEST, with 1000, 10000 and so on
+    up to FILES files, and converts each of them into a new database
+    with every converter swapped for a stub, and identification of
+    files skipped. So the times are those of scanning, database
+    queries, leases, progress and moving files through the workers,
+    and how they grow with the number of rows.
+    """
+    if stub not in ('engine', 'command'):
+        print(f'Unknown stub {stub}')
+        raise typer.Exit(1)
+    work_dir = os.path.abspath(os.path.join(dest, 'pwconvert-benchmark'))
+    output = os.path.abspath(output)
+    # Changes the working directory, as when converting
+    import convert
+
+    converters.clear()
+    converters[STUB_MIME] = {'dest-ext': 'out'}
+    if stub == 'engine':
+        converters[STUB_MIME]['engine'] = 'bin.noop'
+    else:
+        converters[STUB_MIME]['command'] = 'cp <source> <dest>'
+    converters[STUB_DEST_MIME] = {'accept': True}
+    File.set_metadata = stub_metadata
+
+    sizes = [10 ** k for k in range(3, 7) if 10 ** k < files] + [files]
+    systems = ['sqlite'] + (['mysql'] if mysql else [])
+    results = []
+    print('database\trows\tscan µs\ttotal µs\tfiles/s\t'
+          + '\t'.join(f'{stage} µs' for stage in STAGES))
+    for size in sizes:
+        source_dir = os.path.join(work_dir, f'source-{size}')
+        make_tree(source_dir, size)
+        for system in systems:
+            dest_dir = os.path.join(work_dir, f'dest-{system}-{size}')
+            if system == 'sqlite':
+                db = dest_dir + '.db'
+            else:
+                db = f'{mysql}_{size}'
+                drop_mysql_database(db)
+            os.makedirs(dest_dir)
+
+            with Storage(db) as store:
+                t0 = time.perf_counter()
+                count = convert.add_files_to_storage(source_dir, store)
+                scan = time.perf_counter() - t0
+
+                convert.init_worker(Progress(1), trace=True)
+                convert.progress.counter(0).add(count)
+                timestamp = datetime.datetime.now()
+                t0 = time.perf_counter()
+                convert.convert_folder(
+                    source_dir, dest_dir, False, False, db, '', False,
+                    None, None, None, 'new', False, False, False, False,
+                    timestamp, False, None, None, 0, jobs
+                )
+                seconds = time.perf_counter() - t0
+
+                conds, params = store.get_conds(finished=True,
+                                                status='converted',
+                                                timestamp=timestamp)
+                converted = store.get_row_count(conds, params)
+
+            prefix = dest_dir.rstrip('/')
+            stats = Tracer.merge(glob.escape(prefix) + '-trace-*.json',
+                                 prefix + '-trace.json')
+            stages = {stage: mean * 1e6
+                      for stage, n, total, mean, p95 in Tracer.summary(stats)}
+            result = {
+                'database': system,
+                'rows': count,
+                'converted': converted,
+                'stub': stub,
+                'pipeline': bool(cfg['pipeline']),
+                'scan_us_per_file': scan / count * 1e6,
+                'convert_us_per_file': seconds / count * 1e6,
+                'files_per_second': count / seconds,
+                'stages_us_per_file': stages,
+            }
+            results.append(result)
+            print(f"{system}\t{count}\t{result['scan_us_per_file']:.0f}\t"
+                  f"{result['convert_us_per_file']:.0f}\t"
+                  f"{result['files_per_second']:.0f}\t"
+                  + '\t'.join(f'{stages[stage]:.0f}' if stage in stages
+                               else '-' for stage in STAGES), flush=True)
+            if converted < count:
+                print(f'{count - converted} files not converted, see {db}')
+
+            if not keep:
+                shutil.rmtree(dest_dir)
+                for path in glob.glob(glob.escape(prefix) + '*'):
+                    delete_file_or_dir(path)
+                if system == 'mysql':
+                    drop_mysql_database(db)
+        if not keep:
+            shutil.rmtree(source_dir)
+
+    with open(output, 'w') as f:
+        json.dump({'files': files, 'results': results}, f, indent=2)
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    app()
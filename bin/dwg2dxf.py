@@ -1,18 +1,67 @@
 import os
 import shutil
+import tempfile
+from pathlib import Path
 from ezdxf.addons import odafc
 import typer
 
+from config import cfg
+from util import run_shell_cmd
+
+
+def convert_dir(src_dir: str, dest_dir: str, version: str = 'R2018') -> int:
+    """
+    Convert all dwg files in folder to dxf files in folder `dest_dir`,
+    with one call to ODAFileConverter
+
+    Returns:
+        Number of files that failed
+    """
+
+    dwg_paths = [path for path in sorted(Path(src_dir).iterdir())
+                 if path.suffix.lower() == '.dwg']
+    # Arguments are input and output folder, output version and type,
+    # recursive, audit and filter. ODAFileConverter needs a display
+    cmd = ['ODAFileConverter', src_dir, dest_dir, 'ACAD' + version[1:],
+           'DXF', '0', '1', '*.DWG']
+    if shutil.which('xvfb-run'):
+        cmd = ['xvfb-run', '-a'] + cmd
+    returncode, out, err = run_shell_cmd(
+        cmd, timeout=cfg['timeout'] * max(len(dwg_paths), 1)
+    )
+
+    # ODAFileConverter doesn't report which files failed
+    failed = 0
+    for dwg_path in dwg_paths:
+        dxf_path = Path(dest_dir, dwg_path.stem + '.dxf')
+        if not dxf_path.is_file():
+            failed += 1
+            print('failed\t' + str(dxf_path), err or out or returncode)
+
+    return failed
+
+
 def dwg2dxf(src_path: str, dest_path: str):
+    """
+    Convert dwg to dxf
 
-    # Convert to temp folder to avoid problems with chmod
-    # if dest_path is on Windows
-    tmp_path = '/tmp/file.dxf'
-    if os.path.exists(tmp_path):
-       os.remove(tmp_path) 
+    If SRC_PATH is a folder, all dwg files in it are converted
+    to dxf files in folder DEST_PATH with one call to ODAFileConverter
+    """
 
-    odafc.convert(src_path, tmp_path, version='R2018')
-    shutil.copyfile(tmp_path, dest_path)
+    if os.path.isdir(src_path):
+        os.makedirs(dest_path, exist_ok=True)
+        if convert_dir(src_path, dest_path):
+            raise typer.Exit(code=1)
+        return
+
+    # Convert to temp folder to avoid problems with chmod
+    # if dest_path is on Windows. Each job gets its own folder,
+    # so that parallel conversions don't overwrite each other
+    with tempfile.TemporaryDirectory(prefix='dwg2dxf-') as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, 'file.dxf')
+        odafc.convert(src_path, tmp_path, version='R2018')
+        shutil.copyfile(tmp_path, dest_path)
 
 
 if __name__ == "__main__":
@@ -1,20 +1,19 @@
 import os
+import tempfile
+from pathlib import Path
 import ezdxf
 from ezdxf.addons import odafc
 from ezdxf.addons.drawing import Frontend, RenderContext
 from ezdxf.addons.drawing import layout, pymupdf, config
 import typer
 
+from bin.dwg2dxf import convert_dir
 
-def dwg2pdf(src_path: str, dest_path: str, dark_bg: bool = False):
-
-    tmp_path = '/tmp/file.dxf'
-    if os.path.exists(tmp_path):
-        os.remove(tmp_path)
 
-    odafc.convert(src_path, tmp_path, version='R2018')
+def render(dxf_path: str, dest_path: str, dark_bg: bool = False):
+    """Render modelspace of dxf file to pdf"""
 
-    doc = ezdxf.readfile(tmp_path)
+    doc = ezdxf.readfile(dxf_path)
     msp = doc.modelspace()
 
     # 1. create the render context
@@ -29,13 +28,44 @@ def dwg2pdf(src_path: str, dest_path: str, dark_bg: bool = False):
         frontend = Frontend(context, backend)
     # 4. draw the modelspace
     frontend.draw_layout(msp)
-    # 5. create an A4 page layout
-    page = layout.Page(210, 297, layout.Units.mm, margins=layout.Margins.all(20))
-    # 6. get the PDF rendering as bytes
-    backend.get_pdf_bytes(page)
+    # 5. get the PDF rendering as bytes, with page size fitted to the drawing
+    pdf_bytes = backend.get_pdf_bytes(layout.Page(0, 0))
 
     with open(dest_path, "wb") as fp:
-        fp.write(backend.get_pdf_bytes(layout.Page(0, 0)))
+        fp.write(pdf_bytes)
+
+
+def dwg2pdf(src_path: str, dest_path: str, dark_bg: bool = False):
+    """
+    Convert dwg to pdf
+
+    If SRC_PATH is a folder, all dwg files in it are converted to dxf
+    with one call to ODAFileConverter, and rendered to pdf files in
+    folder DEST_PATH
+    """
+
+    # Each job gets its own temp folder, so that parallel
+    # conversions don't overwrite each other
+    with tempfile.TemporaryDirectory(prefix='dwg2pdf-') as tmp_dir:
+        if not os.path.isdir(src_path):
+            tmp_path = os.path.join(tmp_dir, 'file.dxf')
+            odafc.convert(src_path, tmp_path, version='R2018')
+            render(tmp_path, dest_path, dark_bg)
+            return
+
+        os.makedirs(dest_path, exist_ok=True)
+        failed = convert_dir(src_path, tmp_dir)
+        for dxf_path in sorted(Path(tmp_dir).glob('*.dxf')):
+            pdf_path = Path(dest_path, dxf_path.stem + '.pdf')
+            try:
+                render(str(dxf_path), str(pdf_path), dark_bg)
+                print('ok\t' + str(pdf_path))
+            except Exception as e:
+                failed += 1
+                print('failed\t' + str(pdf_path), e)
+
+    if failed:
+        raise typer.Exit(code=1)
 
 
 if __name__ == "__main__":
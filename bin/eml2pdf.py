@@ -1,28 +1,133 @@
 #!/usr/bin/env python3
 
+import html
+import mimetypes
 import os
 import sys
+from email import policy
+from email.parser import BytesParser
+
+import pymupdf
 import typer
-import uuid
 
-from bin.common import run_command_and_convert_to_pdfa
+HEADERS = ['From', 'To', 'Cc', 'Date', 'Subject']
+MARGIN = 50
+
+
+def render_pdf(content: str, target_file_path: str):
+    """Render html to A4 pages with PyMuPDF, without starting any process"""
+    story = pymupdf.Story(html=content)
+    writer = pymupdf.DocumentWriter(target_file_path)
+    mediabox = pymupdf.paper_rect('a4')
+    where = mediabox + (MARGIN, MARGIN, -MARGIN, -MARGIN)
+    more = True
+    while more:
+        device = writer.begin_page(mediabox)
+        more, _ = story.place(where)
+        story.draw(device)
+        writer.end_page()
+    writer.close()
+
+
+def get_html(msg) -> str:
+    """Get html with headers and body of message"""
+    rows = ''.join(
+        f'<tr><th align="left">{name}:</th><td>{html.escape(str(msg[name]))}</td></tr>'
+        for name in HEADERS if msg[name]
+    )
+    content = f'<table>{rows}</table><hr/>'
+
+    body = msg.get_body(preferencelist=('html', 'plain'))
+    if body is None:
+        return content
+
+    text = body.get_content()
+    if body.get_content_subtype() == 'html':
+        content += text
+    else:
+        content += f'<pre style="white-space: pre-wrap">{html.escape(text)}</pre>'
+
+    return content
+
+
+def save_attachments(msg, target_dir: str) -> int:
+    """Save attachments of message as files in folder"""
+    names = set()
+    count = 0
+    for part in msg.iter_attachments():
+        count += 1
+        filename = os.path.basename(part.get_filename() or '').strip()
+        if not filename:
+            ext = mimetypes.guess_extension(part.get_content_type()) or ''
+            if part.get_content_type() == 'message/rfc822':
+                ext = '.eml'
+            filename = f'attachment-{count}{ext}'
+
+        # Avoid overwriting attachments with the same name
+        stem, ext = os.path.splitext(filename)
+        i = 1
+        while filename.lower() in names or filename == 'message.pdf':
+            filename = f'{stem}-{i}{ext}'
+            i += 1
+        names.add(filename.lower())
+
+        if part.get_content_type() == 'message/rfc822':
+            data = part.get_content().as_bytes()
+        else:
+            data = part.get_payload(decode=True) or b''
+
+        with open(os.path.join(target_dir, filename), 'wb') as f:
+            f.write(data)
 
+    return count
 
-def eml2pdf(src_file_path: str, target_file_path: str):
+
+def eml2pdf(src_file_path: str, target_dir: str) -> int:
     """
-    Convert email content to pdf/a
+    Convert email to pdf, and save attachments as separate files
+
+    The message is written as `message.pdf` in TARGET_DIR, together
+    with the attachments. When run by PWConvert, the files in the
+    folder are added as files to be converted in the database.
 
     Args:
-        src_file_path: path for the image to be converted
-        target_file_path: path for the converted file
+        src_file_path: path for the email to be converted
+        target_dir: folder for the converted message and attachments
+
+    Returns:
+        Number of attachments
+    """
+    with open(src_file_path, 'rb') as f:
+        msg = BytesParser(policy=policy.default).parse(f)
+
+    os.makedirs(target_dir, exist_ok=True)
+    render_pdf(get_html(msg), os.path.join(target_dir, 'message.pdf'))
+
+    return save_attachments(msg, target_dir)
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """Convert email in the worker process"""
+    try:
+        count = eml2pdf(source_path, dest_path)
+    except Exception as e:
+        return 1, '', str(e)
+
+    return 0, f'{count} attachments', ''
+
+
+def main(src_file_path: str, target_dir: str):
+    """
+    Convert email to pdf, and save attachments as separate files
 
     Returns:
         Exit code 0 if successful, otherwise 1.
     """
-    tmp_file = f"{os.path.dirname(os.path.realpath(src_file_path))}/{uuid.uuid4()}.pdf"
-    command = ['eml_to_pdf', src_file_path, tmp_file]
-    return sys.exit(run_command_and_convert_to_pdfa(command, tmp_file, target_file_path))
+    returncode, out, err = convert(src_file_path, target_dir, None)
+    print(out or err)
+    return sys.exit(returncode)
 
 
 if __name__ == "__main__":
-    typer.run(eml2pdf)
+    typer.run(main)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import signal
+import subprocess
+import time
+from typing import List
+
+import typer
+
+from util import run_shell_cmd
+
+GS_ARGS = ['-q', '-dPDFA=2', '-dNOPAUSE', '-sColorConversionStrategy=RGB',
+           '-sDEVICE=pdfwrite', '-dPDFACompatibilityPolicy=1',
+           '-sOutputFile=/dev/null', '--permit-file-write=/dev/null']
+DONE = 'PWCONVERT-DONE'
+FAILED = 'PWCONVERT-FAILED'
+# Restart with fresh permissions when Ghostscript has been given
+# access to this many directories
+MAX_DIRS = 100
+# The Ghostscript process converts one file at a time, so the pipeline
+# runs this engine in one thread at a time. Its resource usage isn't
+# recorded, since the process converts many files
+SERIAL = True
+
+
+def ps_string(text: str) -> str:
+    """Quote text as PostScript hex string, to avoid escaping paths"""
+    return '<' + text.encode().hex() + '>'
+
+
+class Ghostscript:
+    """
+    Ghostscript process kept open for converting many pdfs to PDF/A
+
+    Each pdf is run in the same interpreter, so that startup and font
+    initialisation is done only once. Ghostscript runs in safe mode,
+    and is restarted when a file is outside the directories it's been
+    allowed to read and write.
+    """
+
+    def __init__(self):
+        self._proc = None
+        self._dirs = []
+        # Folder for temporary files, inherited from the worker
+        self._tmpdir = None
+
+    def start(self, dirs: List[str]):
+        self.stop()
+        self._dirs = dirs
+        self._tmpdir = os.environ.get('TMPDIR')
+        permits = [f"--permit-file-all={d.rstrip('/')}/*" for d in dirs]
+        self._proc = subprocess.Popen(
+            ['gs'] + GS_ARGS + permits + ['-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+    def stop(self):
+        if self._proc and self._proc.poll() is None:
+            os.killpg(self._proc.pid, signal.SIGKILL)
+            self._proc.wait()
+        self._proc = None
+
+    def is_permitted(self, path: str) -> bool:
+        return any(path.startswith(d.rstrip('/') + '/') for d in self._dirs)
+
+    def convert(self, source_path: str, dest_path: str,
+                timeout: int) -> tuple[int, str, str]:
+        source_path = os.path.abspath(source_path)
+        dest_path = os.path.abspath(dest_path)
+
+        if (
+            not self._proc or self._proc.poll() is not None or
+            not self.is_permitted(source_path) or
+            not self.is_permitted(dest_path) or
+            # The scratch directory of the worker is removed when it
+            # has converted a folder
+            self._tmpdir != os.environ.get('TMPDIR') or
+            (self._tmpdir and not os.path.isdir(self._tmpdir))
+        ):
+            if len(self._dirs) > MAX_DIRS:
+                self._dirs = []
+            for path in [source_path, dest_path]:
+                if not self.is_permitted(path):
+                    self._dirs.append(os.path.dirname(path))
+            try:
+                self.start(self._dirs)
+            except OSError as e:
+                # Like Ghostscript not being installed
+                self._proc = None
+                return 1, '', str(e)
+
+        # Set output file to /dev/null after conversion to make
+        # Ghostscript close the converted file
+        job = (
+            f'clear << /OutputFile {ps_string(dest_path)} >> setpagedevice '
+            f'{{ {ps_string(source_path)} run }} stopped '
+            '<< /OutputFile (/dev/null) >> setpagedevice '
+            f'{{ ({FAILED}) }} {{ ({DONE}) }} ifelse = flush\n'
+        )
+        try:
+            self._proc.stdin.write(job.encode())
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            self.stop()
+            return 1, '', 'Ghostscript exited'
+
+        out = ''
+        deadline = time.time() + timeout
+        fd = self._proc.stdout.fileno()
+        while DONE not in out and FAILED not in out:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.stop()
+                return 1, 'timeout', None
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # Ghostscript exited
+                self.stop()
+                return 1, out, 'Ghostscript exited'
+            out += chunk.decode(errors='replace')
+
+        return (0 if DONE in out else 1), out, ''
+
+
+_gs = Ghostscript()
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """
+    Convert pdf to PDF/A in the Ghostscript process of this worker,
+    and validate the result with pdfcpu
+    """
+    returncode, out, err = _gs.convert(source_path, dest_path, timeout)
+    if returncode:
+        return returncode, out, err
+
+    returncode, out, err = run_shell_cmd(['pdfcpu', 'validate', dest_path],
+                                         timeout=timeout)
+    if returncode:
+        return returncode, out, err
+
+    return 0, '', ''
+
+
+def pdf2pdfa(files: List[str], dest_dir: str, timeout: int = 300):
+    """
+    Convert pdfs to PDF/A in one Ghostscript process
+
+    Args:
+        files: paths for the files to be converted
+        dest_dir: folder for the converted files
+        timeout: max seconds per file
+    """
+    failed = 0
+    for path in files:
+        dest_path = os.path.join(dest_dir, os.path.basename(path))
+        returncode, out, err = convert(path, dest_path, timeout)
+        print(('ok' if returncode == 0 else 'failed') + '\t' + path)
+        failed += returncode != 0
+    _gs.stop()
+
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == '__main__':
+    typer.run(pdf2pdfa)
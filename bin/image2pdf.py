@@ -1,29 +1,98 @@
 #!/usr/bin/env python3
 
-import os
+import io
 import sys
-import uuid
 
+import img2pdf
+from PIL import Image, ImageSequence
+from pi_heif import register_heif_opener
 import typer
 
-from bin.common import run_command_and_convert_to_pdfa
+register_heif_opener()
+
+# sRGB profile installed with icc-profiles-free, used as output intent
+ICC_PROFILE = '/usr/share/color/icc/sRGB.icc'
+# Modes img2pdf can embed without converting colors
+DIRECT_MODES = ('1', 'L', 'RGB')
+
+
+def to_png(image: Image.Image) -> bytes:
+    """Decode image to RGB and encode as lossless png"""
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        # PDF/A-1 doesn't allow transparency
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode not in DIRECT_MODES:
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
 
 
 def image2pdf(src_file_path: str, target_file_path: str):
     """
     Convert images to pdf/a
 
+    JPEG, JPEG2000, PNG and CCITT G4 TIFF data are embedded in the pdf
+    without being re-encoded. Other images are decoded once and
+    embedded losslessly.
+
     Args:
         src_file_path: path for the file to be converted
         target_file_path: path for the converted file
 
+    Returns:
+        `embed` if img2pdf read the image directly, or `decode` if
+        it was decoded with Pillow first
+    """
+    with Image.open(src_file_path) as image:
+        direct = image.format != 'HEIF' and image.mode in DIRECT_MODES
+        if direct:
+            images = [src_file_path]
+        else:
+            images = [to_png(frame) for frame in ImageSequence.Iterator(image)]
+
+    try:
+        with open(target_file_path, 'wb') as f:
+            img2pdf.convert(*images, outputstream=f, pdfa=ICC_PROFILE)
+        return 'embed' if direct else 'decode'
+    except (img2pdf.ImageOpenError, img2pdf.AlphaChannelError, ValueError):
+        if not direct:
+            raise
+        # Let Pillow decode images that img2pdf can't embed directly
+        with Image.open(src_file_path) as image:
+            images = [to_png(frame) for frame in ImageSequence.Iterator(image)]
+        with open(target_file_path, 'wb') as f:
+            img2pdf.convert(*images, outputstream=f, pdfa=ICC_PROFILE)
+        return 'decode'
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """Convert image to pdf/a in the worker process"""
+    try:
+        method = image2pdf(source_path, dest_path)
+    except Exception as e:
+        return 1, '', str(e)
+
+    return 0, method, ''
+
+
+def main(src_file_path: str, target_file_path: str):
+    """
+    Convert images to pdf/a
+
     Returns:
         Exit code 0 if successful, otherwise 1.
     """
-    tmp_file = f"{os.path.dirname(os.path.realpath(src_file_path))}/{uuid.uuid4()}.pdf"
-    command = ['convert', src_file_path, tmp_file]
-    return sys.exit(run_command_and_convert_to_pdfa(command, tmp_file, target_file_path))
+    returncode, out, err = convert(src_file_path, target_file_path, None)
+    if err:
+        print(err)
+    return sys.exit(returncode)
 
 
 if __name__ == "__main__":
-    typer.run(image2pdf)
+    typer.run(main)
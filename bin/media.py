@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+import typer
+
+from config import cfg
+from util import run_shell_cmd
+
+# Codecs that can be kept as they are in the output container
+ARCHIVAL_CODECS = {
+    '.mp4': {'video': ['h264'], 'audio': ['aac', 'mp3']},
+    '.mp3': {'audio': ['mp3']},
+}
+# Encoders used for streams that must be transcoded
+ENCODERS = {
+    '.mp4': {'video': ['libx264', '-crf', '20', '-preset', 'medium'],
+             'audio': ['aac', '-b:a', '192k']},
+    '.mp3': {'audio': ['libmp3lame', '-b:a', '192k']},
+}
+
+
+def probe(source_path: str, timeout: int = None) -> list:
+    """
+    Get codec type, codec name, field order and whether it's an attached
+    picture, for the streams in file
+    """
+    cmd = ['ffprobe', '-v', 'error', '-show_entries',
+           'stream=codec_type,codec_name,field_order'
+           ':stream_disposition=attached_pic', '-of', 'json', source_path]
+    returncode, out, err = run_shell_cmd(cmd, timeout=timeout)
+    if returncode:
+        return []
+
+    return json.loads(out).get('streams', [])
+
+
+def get_ffmpeg_cmd(source_path: str, dest_path: str,
+                   streams: list) -> tuple[list, list]:
+    """
+    Get ffmpeg command that copies streams with archival codecs,
+    and transcodes the rest
+
+    Returns:
+        command, and list of stream types that are transcoded
+    """
+    ext = os.path.splitext(dest_path)[1].lower()
+    codecs = ARCHIVAL_CODECS[ext]
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-i', source_path,
+           '-threads', str(cfg['media']['threads'])]
+    transcoded = []
+    for codec_type in codecs:
+        # Attached pictures like cover art are left out
+        found = [s for s in streams if s.get('codec_type') == codec_type
+                 and not s.get('disposition', {}).get('attached_pic')]
+        if not found:
+            continue
+        # Stream specifier `V` selects video streams that aren't
+        # attached pictures
+        cmd += ['-map', '0:' + codec_type[0].replace('v', 'V')]
+        if all(s.get('codec_name') in codecs[codec_type] for s in found):
+            cmd += ['-c:' + codec_type[0], 'copy']
+            continue
+        transcoded.append(codec_type)
+        cmd += ['-c:' + codec_type[0]] + ENCODERS[ext][codec_type]
+        if codec_type == 'video' and any(
+            s.get('field_order') not in (None, 'progressive', 'unknown')
+            for s in found
+        ):
+            cmd += ['-vf', 'yadif']
+
+    if ext == '.mp4':
+        cmd += ['-movflags', '+faststart']
+
+    return cmd + [dest_path], transcoded
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """
+    Convert video to mp4 or audio to mp3, remuxing streams that
+    already have archival codecs instead of transcoding them
+
+    Returns `remux` or the transcoded stream types as output
+    """
+    streams = probe(source_path, timeout)
+    if not streams:
+        return 1, '', 'No streams found'
+
+    cmd, transcoded = get_ffmpeg_cmd(source_path, dest_path, streams)
+    returncode, out, err = run_shell_cmd(cmd, timeout=timeout)
+    if returncode:
+        return returncode, out, err
+
+    method = 'transcode ' + ' '.join(transcoded) if transcoded else 'remux'
+    return 0, method, ''
+
+
+def media(src_file_path: str, target_file_path: str):
+    """
+    Convert video to mp4 or audio to mp3
+
+    Returns:
+        Exit code 0 if successful, otherwise 1.
+    """
+    returncode, out, err = convert(src_file_path, target_file_path,
+                                   cfg['timeout'])
+    print(out or err)
+    return sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    typer.run(media)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import shutil
+import sys
+
+import typer
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """
+    Copy file as is, in the worker process
+
+    Used in place of the converters by `benchmark.py orchestration`,
+    to time the conversion without the work of the converters.
+    """
+    try:
+        shutil.copyfile(source_path, dest_path)
+    except OSError as e:
+        return 1, '', str(e)
+
+    return 0, '', ''
+
+
+def main(src_file_path: str, target_file_path: str):
+    """Copy file as is"""
+    returncode, out, err = convert(src_file_path, target_file_path, None)
+    if err:
+        print(err)
+    return sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,43 +1,171 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 from pathlib import Path
+from typing import List
 import uuid
 
 import typer
 
-from util import run_shell_cmd
+from config import cfg
+from util import run_shell_cmd, get_scratch_dir, remove_file
 
+# Converted files not yet asked for, and files that failed, in this process
+_cache = {}
+_cache_dir = None
+_failed = set()
+# Files waiting to be converted, in order, see `queue`
+_queued = {}
+_lock = threading.Lock()
+# A batch converts the files queued by other threads as well, so the
+# pipeline runs this engine in one thread at a time. Resource usage
+# isn't recorded, since it's that of the whole batch
+SERIAL = True
 
-def office2pdf(source_file: str, target_file: str):
+
+def run_documentbuilder(files: List[tuple], timeout: int = None):
     """
-    Convert office files to pdf
+    Convert office files to pdf in one documentbuilder session
 
     Args:
-        source_file: path for the file to be converted
-        target_file: path for the converted file
-
-    Returns:
-        Nothing
+        files: list of (source path, target path)
+        timeout: max seconds for the whole session
     """
 
-    docbuilder_file = Path('/tmp', str(uuid.uuid4()).split("-")[0])
+    docbuilder_file = Path(get_scratch_dir(), str(uuid.uuid4()).split("-")[0])
 
-    docbuilder = [
-        f'builder.OpenFile("{source_file}", "")',
-        f'builder.SaveFile("pdf", "{target_file}")',
-        'builder.CloseFile();',
-    ]
+    docbuilder = []
+    for source_file, target_file in files:
+        docbuilder += [
+            f'builder.OpenFile({json.dumps(source_file)}, "")',
+            f'builder.SaveFile("pdf", {json.dumps(target_file)})',
+            'builder.CloseFile();',
+        ]
 
     with open(docbuilder_file, 'w+') as file:
         file.write('\n'.join(docbuilder))
 
     command = ['documentbuilder', docbuilder_file]
-    result, out, err = run_shell_cmd(command)
+    result, out, err = run_shell_cmd(command, timeout=timeout)
 
     docbuilder_file.unlink()
 
-    if err:
+    return result, out, err
+
+
+def queue(source_path: str, dest_path: str) -> None:
+    """
+    Let file waiting to be converted by this engine be converted
+    together with the file being converted
+
+    Called by the pipeline for files this worker has leased, when
+    their next step is this engine.
+    """
+    with _lock:
+        _queued[os.path.abspath(source_path)] = None
+
+
+def convert(source_path: str, dest_path: str,
+            timeout: int) -> tuple[int, str, str]:
+    """
+    Convert office file to pdf
+
+    Files waiting for this engine in the pipeline are converted in the
+    same documentbuilder session, and kept until they are asked for.
+    """
+    global _cache_dir
+    source_path = os.path.abspath(source_path)
+    with _lock:
+        _queued.pop(source_path, None)
+
+        if source_path not in _cache:
+            # Remove converted files no longer waiting to be asked for
+            for path in set(_cache) - set(_queued):
+                remove_file(_cache.pop(path))
+            if not _cache_dir or not os.path.isdir(_cache_dir):
+                _cache_dir = tempfile.mkdtemp(prefix='office2pdf-',
+                                              dir=get_scratch_dir())
+
+            batch = [source_path]
+            for path in list(_queued):
+                if len(batch) >= cfg['office']['batch-size']:
+                    break
+                if not os.path.isfile(path):
+                    # The conversion was stopped before its turn
+                    del _queued[path]
+                elif path not in _cache and path not in _failed:
+                    batch.append(path)
+        else:
+            batch = []
+
+    if batch:
+        files = [(path, os.path.join(_cache_dir, f'{uuid.uuid4().hex}.pdf'))
+                 for path in batch]
+        result, out, err = run_documentbuilder(
+            files, min(timeout * len(files), cfg['office']['batch-timeout'])
+        )
+        if out == 'timeout':
+            # Files are saved in order, so the last file written may have
+            # been stopped while it was saved. The others are complete
+            saved = [target for source, target in files
+                     if os.path.isfile(target)]
+            if saved:
+                remove_file(saved[-1])
+        with _lock:
+            _cache.update(files)
+
+    with _lock:
+        cached_file = _cache.pop(source_path)
+    if os.path.isfile(cached_file):
+        shutil.move(cached_file, dest_path)
+        return 0, '', ''
+
+    # A file in the session may have stopped documentbuilder,
+    # so we try once more with this file alone
+    result, out, err = run_documentbuilder([(source_path, dest_path)], timeout)
+    if result or err or not os.path.isfile(dest_path):
+        _failed.add(source_path)
+        return 1, out, err
+
+    return 0, '', ''
+
+
+def office2pdf(source_files: List[str], target: str):
+    """
+    Convert office files to pdf
+
+    With several source files, all are converted in one documentbuilder
+    session, and the pdf files are written to folder TARGET
+
+    Args:
+        source_files: paths for the files to be converted
+        target: path for the converted file, or folder for converted files
+
+    Returns:
+        Nothing
+    """
+
+    if len(source_files) == 1:
+        files = [(source_files[0], target)]
+    else:
+        os.makedirs(target, exist_ok=True)
+        files = [(path, os.path.join(target, Path(path).stem + '.pdf'))
+                 for path in source_files]
+
+    result, out, err = run_documentbuilder(files)
+
+    failed = [source for source, target_file in files
+              if not os.path.isfile(target_file)]
+    if len(files) > 1:
+        for source, target_file in files:
+            print(('failed' if source in failed else 'ok') + '\t' + source)
+
+    if err or failed:
         print('err', err)
         sys.exit(1)
 
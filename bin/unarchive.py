@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import typer
+
+from util import (ArchiveLimitError, check_extracted, get_tree_size,
+                  delete_file_or_dir, remove_file)
+
+# Least seconds between checks of files written by unar
+POLL_INTERVAL = 0.2
+
+
+def gunzip(source_path: str, dest_path: str, expanded: int = 0) -> None:
+    """Decompress gzip file, checking the bytes written against the limits"""
+    archive_size = os.path.getsize(source_path)
+    size = 0
+    try:
+        with gzip.open(source_path) as src, open(dest_path, 'wb') as dst:
+            while chunk := src.read(1024 * 1024):
+                size += len(chunk)
+                check_extracted(1, size, archive_size, expanded)
+                dst.write(chunk)
+    except (ArchiveLimitError, OSError, EOFError):
+        remove_file(dest_path)
+        raise
+
+
+def unar(source_path: str, dest_path: str,
+         expanded: int = 0) -> tuple[int, str]:
+    """
+    Extract archive with unar, checking the files written against the
+    limits while it runs
+    """
+    archive_size = os.path.getsize(source_path)
+    with tempfile.TemporaryFile() as output:
+        proc = subprocess.Popen(['unar', '-k', 'skip', '-D', source_path,
+                                 '-o', dest_path],
+                                stdout=output, stderr=subprocess.STDOUT)
+        interval = POLL_INTERVAL
+        try:
+            while proc.poll() is None:
+                time.sleep(interval)
+                t0 = time.monotonic()
+                check_extracted(*get_tree_size(dest_path), archive_size,
+                                expanded)
+                # Checking takes longer the more files are written, so
+                # it's done less often, to take at most a tenth of the time
+                interval = max(POLL_INTERVAL, 10 * (time.monotonic() - t0))
+            check_extracted(*get_tree_size(dest_path), archive_size, expanded)
+        except ArchiveLimitError:
+            proc.kill()
+            proc.wait()
+            raise
+        output.seek(0)
+
+        return proc.returncode, output.read().decode(errors='replace')
+
+
+def unarchive(source_path: str, dest_path: str, expanded: int = 0):
+    """
+    Extract archive, and stop if it exceeds the limits in `archive`
+    in application.yml
+
+    The limits are checked against the bytes written, since the sizes
+    listed in an archive can be false. Gzip files are decompressed to
+    DEST_PATH, and other archives are extracted to the folder DEST_PATH.
+
+    --expanded: Bytes already extracted from the archives within the\n
+    ..          same original file, counted in the limit on total size
+    """
+    with open(source_path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    try:
+        if is_gzip:
+            gunzip(source_path, dest_path, expanded)
+            returncode, out = 0, ''
+        else:
+            returncode, out = unar(source_path, dest_path, expanded)
+    except ArchiveLimitError as e:
+        delete_file_or_dir(dest_path)
+        print(f'Archive exceeds limits: {e}')
+        sys.exit(1)
+    except (OSError, EOFError) as e:
+        print(e)
+        sys.exit(1)
+
+    print(out, end='')
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    typer.run(unarchive)
@@ -15,12 +15,14 @@
 
 from __future__ import annotations
 import os
-import shutil
 import datetime
+import glob
+import itertools
+import threading
 import time
 from pathlib import Path
 import mimetypes
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 import typer
 
 from rich.console import Console
@@ -28,12 +30,20 @@ import petl as etl
 
 from storage import Storage
 from file import File
-from util import make_filelist, remove_file
+from pipeline import Pipeline, Job
+from util import (remove_file, get_scratch_dir,
+                  remove_scratch_dir, clean_scratch_dirs, remove_empty_dirs,
+                  get_worker_id, is_stale_worker, Prefetcher, Watcher,
+                  scan_files, scan_tree, Progress, Counter, clear_line,
+                  tracer, profiler, Tracer, Profiler)
 from config import cfg
 
 console = Console()
 pwconv_path = Path(__file__).parent.resolve()
 os.chdir(pwconv_path)
+# Shared with the processes of the Pool by `init_worker`
+progress: Progress = None
+dump_count = itertools.count()
 
 
 def remove_fields(table, *args):
@@ -57,6 +67,47 @@ def handle_error(error):
     print(error, flush=True)
 
 
+def init_worker(shared: Progress, trace: bool = False,
+                profile: bool = False) -> None:
+    """Set up process converting files"""
+    global progress
+    progress = shared
+    tracer.enabled = trace
+    profiler.enabled = profile
+
+
+def dump_trace(dest_dir: str) -> None:
+    """Write stats and profiles of this process, for `report_trace`"""
+    # A process may convert several folders
+    part = f'{os.getpid()}-{next(dump_count)}'
+    prefix = dest_dir.rstrip('/')
+    tracer.dump(f'{prefix}-trace-{part}.json')
+    profiler.dump(f'{prefix}-profile-{part}.prof')
+
+
+def report_trace(dest_dir: str) -> None:
+    """Join stats and profiles of all processes, and print a summary"""
+    prefix = dest_dir.rstrip('/')
+    if tracer.enabled:
+        stats = Tracer.merge(glob.escape(prefix + '-trace-') + '*.json',
+                             prefix + '-trace.json')
+        console.print(f"\n{'stage':<10}{'files':>10}{'seconds':>12}"
+                      f"{'mean ms':>12}{'p95 ms':>12}", style="bold")
+        for stage, count, total, mean, p95 in Tracer.summary(stats):
+            console.print(f"{stage:<10}{count:>10}{total:>12.2f}"
+                          f"{mean * 1000:>12.1f}{p95 * 1000:>12.0f}",
+                          highlight=False)
+        console.print(f"See {prefix}-trace.json for each mime type and "
+                      "converter")
+    if profiler.enabled:
+        stats = Profiler.merge(glob.escape(prefix + '-profile-') + '*.prof',
+                               prefix + '-profile.prof')
+        if stats:
+            stats.sort_stats('cumulative').print_stats(20)
+            console.print(f"See {prefix}-profile.prof, e.g. with "
+                          "python -m pstats")
+
+
 def convert(
     source: str,
     dest: str,
@@ -70,11 +121,17 @@ def convert(
     reconvert: bool = False,
     identify_only: bool = False,
     filecheck: bool = False,
+    filecheck_action: str = None,
     set_source_ext: bool = False,
     from_path: str = None,
     to_path: str = None,
     multi: bool = False,
-    retry: bool = False
+    retry: bool = False,
+    jobs: int = cfg['jobs'],
+    watch: bool = False,
+    trace: bool = False,
+    profile: bool = False,
+    yes: bool = False
 ) -> None:
     """
     Convert all files in SOURCE folder
@@ -82,10 +139,15 @@ def convert(
     --db:        Name of MySQL base.\n
     ..           If not set, it uses a SQLite base with path `dest + .db`
 
-    --filecheck: Check if files in source match files in database
+    --filecheck: Check if files in source match files in database.\n
+    ..           Differences are written to `dest + -filecheck.tsv`
+
+    --filecheck-action: What to do if files don't match, instead of asking:\n
+    ..           continue, cancel, add (to database) or delete (from source).\n
+    ..           Also starts the conversion without asking, like --yes
 
     --status:    Filter on status: accepted, converted, deleted, failed,\n
-    ..           protected, skipped, timeout, new
+    ..           protected, rejected, skipped, timeout, interrupted, new
 
     --from-path: Convert files where path is larger than or the same as this value
 
@@ -95,73 +157,121 @@ def convert(
 
     --retry:     Try to convert files where conversion previously failed
 
+    --jobs:      Number of conversions each process runs at the same time.\n
+    ..           Use more than 1 when converters mostly wait on disk or network.\n
+    ..           Only used when `pipeline` is set in application.yml
+
     --puid:      Filter on Pronom Unique Identifier, f.ex fmt/39 for \n
     ..           Microsoft Word 6.0/95
 
+    --watch:     Keep running after the conversion, and convert files\n
+    ..           added to or changed in SOURCE. See `watch` in application.yml
+
+    --trace:     Time the stages of the conversion of each file, and write\n
+    ..           the times by mime type and converter to `dest + -trace.json`
+
+    --profile:   Run the conversion under cProfile, and write the profile\n
+    ..           of all processes and threads to `dest + -profile.prof`.\n
+    ..           From Python 3.12 only one thread can be profiled, so the\n
+    ..           files are then converted without the pipeline
+
+    --yes:       Start the conversion without asking
+
     """
 
+    if watch and (reconvert or identify_only):
+        console.print("--watch can't be used with --reconvert or "
+                      "--identify-only", style="bold red")
+        return False
+
+    if filecheck_action not in (None, 'continue', 'cancel', 'add', 'delete'):
+        console.print(f"Unknown --filecheck-action {filecheck_action}",
+                      style="bold red")
+        return False
+
     Path(dest).mkdir(parents=True, exist_ok=True)
     timestamp = datetime.datetime.now()
 
-    if os.path.isdir('/tmp/convert'):
-        shutil.rmtree('/tmp/convert')
+    clean_scratch_dirs()
 
     if not db:
         db = dest.rstrip('/') + '.db'
 
     with Storage(db) as store:
+        # Convert again files left in progress by workers that are gone
+        recovered = store.recover_rows(is_stale_worker)
+        if recovered:
+            console.print(f"{recovered} interrupted files will be converted "
+                          "again", style="bold orange1")
+
         filelist_path = dest.rstrip('/') + '-filelist.txt'
         is_new_batch = os.path.isfile(filelist_path)
-        first_run = store.get_row_count() == 0
-        if first_run:
-            make_filelist(source, filelist_path)
+        # Workers started at the same time wait for the first one to add
+        # the files, instead of adding them too
+        with store.scan_lock():
+            first_run = store.get_row_count() == 0
+            if first_run:
+                add_files_to_storage(source, store)
+            elif is_new_batch:
+                write_id_file_to_storage(filelist_path, source, store, '')
 
         if first_run or is_new_batch:
-            write_id_file_to_storage(filelist_path, source, store, '')
             status = 'new'
 
+        # Before the files are counted, since files may be added
+        if filecheck:
+            res = check_files(source, store,
+                              dest.rstrip('/') + '-filecheck.tsv',
+                              filecheck_action)
+            if res == 'cancelled':
+                return False
+
         conds, params = store.get_conds(mime=mime, puid=puid, status=status,
                                         reconvert=(reconvert or identify_only),
                                         from_path=from_path, to_path=to_path,
                                         timestamp=timestamp, ext=ext, retry=retry)
 
         count_remains = store.get_row_count(conds, params)
-        m = Manager()
-        count = {
-            'remains': m.Value('i', count_remains),
-            'finished': m.Value('i', 0)
-        }
-
-        if input(f"Converts {count_remains} files. Continue? [y/n] ") != 'y':
-            return False
 
-        if filecheck:
-            res = check_files(source, store)
-            if res == 'cancelled':
+        if not (yes or filecheck_action):
+            answ = input(f"Converts {count_remains} files. Continue? [y/n] ")
+            if answ != 'y':
                 return False
 
         console.print("Converting files..", style="bold cyan")
 
-        pool = Pool()
+        # Trace and profile of this run only
+        remove_file(dest.rstrip('/') + '-trace.json')
+        remove_file(dest.rstrip('/') + '-profile.prof')
+
+        dirs = store.get_subfolders(conds, params) if multi else []
+        # Each folder converted counts files in its own slot
+        init_worker(Progress(len(dirs) + 1), trace, profile)
+        progress.counter(0).add(count_remains)
+        pool = Pool(initializer=init_worker,
+                    initargs=(progress, trace, profile))
         t0 = time.time()
 
-        if multi:
-            dirs = store.get_subfolders(conds, params)
-            for dir in dirs:
-                dir = Path(dir).name
-                args = (source, dest, debug, orig_ext, db, dir, True,
-                        mime, puid, ext, status, reconvert, retry,
-                        identify_only, filecheck, timestamp, set_source_ext,
-                        from_path, to_path, count)
-                pool.apply_async(convert_folder, args=args, error_callback=handle_error)
-        else:
-            convert_folder(source, dest, debug, orig_ext, db, '', True,
-                           mime, puid, ext, status, reconvert, retry,
-                           identify_only, filecheck, timestamp, set_source_ext,
-                           from_path, to_path, count)
+        with progress.show():
+            if multi:
+                for slot, dir in enumerate(dirs, start=1):
+                    dir = Path(dir).name
+                    args = (source, dest, debug, orig_ext, db, dir, True,
+                            mime, puid, ext, status, reconvert, retry,
+                            identify_only, filecheck, timestamp,
+                            set_source_ext, from_path, to_path, slot, jobs)
+                    pool.apply_async(convert_folder, args=args,
+                                     error_callback=handle_error)
+            else:
+                convert_folder(source, dest, debug, orig_ext, db, '', True,
+                               mime, puid, ext, status, reconvert, retry,
+                               identify_only, filecheck, timestamp,
+                               set_source_ext, from_path, to_path, 0, jobs)
 
-        pool.close()
-        pool.join()
+            pool.close()
+            pool.join()
+        clean_scratch_dirs()
+        remove_empty_dirs(dest.rstrip('/') + '-temp')
 
         duration = str(datetime.timedelta(seconds=round(time.time() - t0)))
         console.print('\nConversion finished in ' + duration)
@@ -184,6 +294,13 @@ def convert(
             console.print(f"{count_removed} files removed",
                           style="bold orange1")
 
+        conds, params = store.get_conds(finished=True, status='rejected',
+                                        timestamp=timestamp)
+        count_rejected = store.get_row_count(conds, params)
+        if count_rejected:
+            console.print(f"{count_rejected} archives rejected",
+                          style="bold red")
+
         conds, params = store.get_conds(finished=True, status='failed',
                                         timestamp=timestamp)
         count_failed = store.get_row_count(conds, params)
@@ -191,6 +308,104 @@ def convert(
             console.print(f"{count_failed} files failed",
                           style="bold red")
         console.print(f"See database {db} for details")
+        report_trace(dest)
+
+        if not watch:
+            return
+
+        console.print(f"Watching {source} for changes..", style="bold cyan")
+        # Start with a full scan, to find changes made during conversion
+        folders = None
+        with Watcher(source, cfg['watch']['interval'], cfg['watch']['settle'],
+                     cfg['watch']['inotify']) as watcher:
+            while True:
+                count_new = sync_source(source, dest, store, folders)
+                if count_new:
+                    progress.reset()
+                    progress.counter(0).add(count_new)
+                    with progress.show():
+                        convert_folder(source, dest, debug, orig_ext, db, '',
+                                       True, mime, puid, ext, None, False,
+                                       False, False, False,
+                                       datetime.datetime.now(),
+                                       set_source_ext, from_path, to_path, 0,
+                                       jobs)
+                    report_trace(dest)
+                folders = watcher.wait()
+
+
+def sync_source(source_dir: str, dest_dir: str, store: Storage,
+                folders: set[str] = None) -> int:
+    """
+    Update database with files added to, changed in or removed from source
+
+    New files are added, and changed files get status 'new' so that
+    they're converted again. Files converted from changed files are
+    removed. Removed files get status 'deleted', and files converted
+    from them are kept.
+
+    Args:
+        folders: folders to look for changes in, not including
+                 subfolders unless the folder is gone. All if None
+    Returns:
+        number of files to convert
+    """
+    files = scan_files(source_dir, folders, cfg['watch']['settle'])
+    if folders is None:
+        snapshot = store.get_snapshot()
+    else:
+        snapshot = {}
+        for folder in folders:
+            gone = not os.path.isdir(Path(source_dir, folder))
+            snapshot.update(store.get_snapshot(folder, recursive=gone))
+
+    new_rows = []
+    changed_rows = []
+    scanned_rows = []
+    for path, stat in files.items():
+        # Still being written to
+        if stat is None:
+            continue
+        size, mtime = stat
+        row = snapshot.get(path)
+        if row is None:
+            new_rows.append({'path': path, 'size': size, 'mtime': mtime,
+                             'status': 'new', 'source_id': None, 'depth': 0})
+        elif row['status'] == 'in_progress':
+            # Looked at again when the folder changes next time
+            continue
+        elif row['mtime'] is None and row['status'] != 'deleted':
+            # Scanned before modification times were recorded
+            scanned_rows.append({'id': row['id'], 'size': size,
+                                 'mtime': mtime})
+        elif (row['status'] == 'deleted' or row['mtime'] != mtime or
+              row['size'] != size):
+            remove_converted(row['id'], path, dest_dir, store)
+            changed_rows.append({
+                'id': row['id'], 'size': size, 'mtime': mtime,
+                'status': 'new', 'status_ts': None, 'mime': None,
+                'puid': None, 'format': None, 'version': None,
+                'encoding': None, 'kept': None, 'checksum': None,
+                'converter': None
+            })
+
+    deleted_rows = [{'id': row['id'], 'status': 'deleted',
+                     'status_ts': datetime.datetime.now()}
+                    for path, row in snapshot.items()
+                    if path not in files and
+                    row['status'] not in ('deleted', 'in_progress')]
+
+    store.add_rows(new_rows)
+    store.update_rows(changed_rows)
+    store.update_rows(scanned_rows)
+    store.update_rows(deleted_rows)
+
+    if new_rows or changed_rows or deleted_rows:
+        console.print(f"{len(new_rows)} files added, {len(changed_rows)} "
+                      f"changed and {len(deleted_rows)} removed",
+                      style="bold cyan")
+
+    return len(new_rows) + len(changed_rows)
 
 
 def convert_folder(
@@ -213,9 +428,10 @@ def convert_folder(
     set_source_ext: bool,
     from_path: str,
     to_path: str,
-    count: dict
+    slot: int,
+    jobs: int = 1
 ) -> tuple[str, str]:
-    """Convert all files in folder"""
+    """Convert all files in folder, counting them in `slot` of progress"""
 
     with Storage(db) as store:
         if reconvert:
@@ -233,78 +449,287 @@ def convert_folder(
                 from_path=from_path, to_path=to_path, timestamp=timestamp,
                 reconvert=identify_only, retry=retry
             )
-        table = store.get_rows(conds, params, limit=1)
-
-        # loop through all files and run conversion:
-        # unpacked files are added to and converted in main loop
-        table.row_count = 0
-        i = 0
-        percent = 0
-        while tbl := etl.dicts(table):
-            i += 1
-            count['finished'].value += 1
-            row = tbl[0]
-            if row['source_id'] is None:
-                table.row_count += 1
-
-            n = count['remains'].value
-            new_percent = round((1 - n/(n + count['finished'].value)) * 100)
-            percent = percent if percent > new_percent else new_percent
-
-            if reconvert and row['source_id'] is None:
-                # Remove any copied original files
-                remove_file(Path(dest_dir, row['path']))
-
-                rows = store.get_descendants(row['id'])
-                for file_row in rows:
-                    remove_file(Path(dest_dir, file_row[1]))
-
-                store.delete_descendants(row['id'])
-
-            print(end='\x1b[2K')  # clear line
-            print(f"\r{percent}% | "
-                  f"{row['path'][0:100]}", end=" ", flush=True)
-
-            unidentify = reconvert or identify_only
-            src_file = File(row, pwconv_path, unidentify)
-            norm = src_file.convert(source_dir, dest_dir, orig_ext,
-                                    debug, set_source_ext, identify_only)
-
-            # If conversion failed
-            if norm is False:
-                if src_file.status != 'accepted':
-                    console.print('  ' + src_file.status, style="bold red")
-            elif type(norm) is str:
-                dest_path = Path(dest_dir, norm)
-                unpacked_count = sum([len(files) for r, d, files
-                                      in os.walk(dest_path)])
-                console.print(f'Unpacked {unpacked_count} files',
-                              style="bold cyan", end=' ')
-
-                # Write new files to database
-                filelist_dir = os.path.join(dest_dir, norm)
-                filelist_path = filelist_dir.rstrip('/') + '-filelist.txt'
-                make_filelist(os.path.join(dest_dir, norm),
-                              filelist_path)
-                n = write_id_file_to_storage(filelist_path, dest_dir, store,
-                                             norm, source_id=src_file.id)
-
-                count['remains'].value += n
+        unidentify = reconvert or identify_only
+        args = (source_dir, dest_dir, orig_ext, debug, set_source_ext,
+                identify_only, store)
+        counter = progress.counter(slot)
+        # Files are leased, so that workers sharing the database
+        # don't convert the same files
+        owner = get_worker_id()
+        stop = threading.Event()
+        threading.Thread(target=heartbeat, args=(db, owner, stop),
+                         daemon=True).start()
+
+        prefetcher = None
+        if cfg['prefetch']['max-bytes']:
+            prefetcher = Prefetcher(source_dir, cfg['prefetch']['max-bytes'])
+
+        try:
+            with profiler.profile():
+                # The stages of the pipeline run in threads, which can't
+                # be profiled together with this one from Python 3.12
+                if cfg['pipeline'] and not (profiler.enabled and
+                                            profiler.one_thread):
+                    convert_rows_pipeline(store, conds, params, args, jobs,
+                                          reconvert, unidentify, counter, owner,
+                                          prefetcher)
+                    return
+
+                # loop through all files and run conversion:
+                # unpacked files are added to and converted in main loop.
+                # Order by depth so that nested archives are unpacked
+                # breadth-first
+                while True:
+                    with tracer.time('query'):
+                        tbl = etl.dicts(store.lease_rows(conds, params, owner,
+                                                         order='depth, id'))
+                    if not tbl:
+                        if wait_for_leases(store, conds, params):
+                            continue
+                        break
+                    row = tbl[0]
+                    start_row(row, dest_dir, store, reconvert, counter)
+
+                    local_path = None
+                    if prefetcher:
+                        # Before the next files are set, which leaves
+                        # out this file since it's leased
+                        if row['source_id'] is None:
+                            local_path = prefetcher.get(row['path'])
+                        prefetch_rows(prefetcher, store, conds, params)
+
+                    src_file = File(row, pwconv_path, unidentify,
+                                    local_path=local_path)
+                    norm = src_file.convert(*args)
+                    finish_row(src_file, norm, dest_dir, store, counter)
+                    if local_path:
+                        prefetcher.release(row['path'])
+        finally:
+            stop.set()
+            if prefetcher:
+                prefetcher.close()
+            remove_scratch_dir()
+            dump_trace(dest_dir)
+
+
+def wait_for_leases(store: Storage, conds: list, params: list) -> bool:
+    """
+    Wait a little if no files could be leased, but files are left
 
-            else:
-                if norm.status == 'failed' and norm.kept is True:
-                    console.print('converted file kept', style="bold orange1")
-                norm.status_ts = datetime.datetime.now()
-                store.add_row(norm.__dict__)
+    On MySQL, files other workers are leasing are skipped, so that no
+    files could be leased doesn't mean that none are left.
+
+    Returns:
+        True if files are left, and leasing should be tried again
+    """
+    if not store.count_unleased(conds, params):
+        return False
+    time.sleep(0.1)
+
+    return True
+
+
+def heartbeat(db: str, owner: str, stop: threading.Event) -> None:
+    """
+    Renew leases of files being converted until `stop` is set,
+    and let files of workers that are gone be converted again
+    """
+    with Storage(db) as store:
+        while not stop.wait(cfg['lease']['seconds'] / 3):
+            store.renew_leases(owner)
+            store.recover_rows(is_stale_worker)
+
+
+def prefetch_rows(prefetcher: Prefetcher, store: Storage, conds: list,
+                  params: list) -> None:
+    """Let prefetcher copy the next original files to be converted"""
+    max_files = cfg['prefetch']['max-files']
+    if prefetcher.pending() >= max_files // 2:
+        return
+
+    # Rows leased by this or other workers are skipped, as in `lease_rows`
+    conds = conds + ['(status is null or status <> ?)']
+    table = store.get_rows(conds, params + ['in_progress'], limit=max_files,
+                           order='depth, id')
+    prefetcher.update([row['path'] for row in etl.dicts(table)
+                       if row['source_id'] is None])
+
+
+def convert_rows_pipeline(store: Storage, conds: list, params: list,
+                          args: tuple, jobs: int, reconvert: bool,
+                          unidentify: bool, counter: Counter, owner: str,
+                          prefetcher: Prefetcher = None) -> None:
+    """
+    Convert files in a pipeline of stages running at the same time
 
-            src_file.status_ts = datetime.datetime.now()
-            store.update_row(src_file.__dict__)
-            count['remains'].value -= 1
+    This thread fetches the files to convert and writes the results
+    to the database, while the stages of `Pipeline` identify and
+    convert the files. At most `pipeline.queue-size` files are in
+    the pipeline at a time.
+    """
+    dest_dir = args[1]
+    size = cfg['pipeline']['queue-size']
+    pipeline = Pipeline(jobs, cfg['pipeline']['identify'],
+                        cfg['pipeline']['verify'])
+    in_progress = {}
+    # Each file in the pipeline gets its own scratch directory
+    scratch_dirs = [os.path.join(get_scratch_dir(), f'job-{i}')
+                    for i in range(size)]
+
+    try:
+        while True:
+            row = None
+            local_path = None
+            if len(in_progress) < size:
+                with store.lock:
+                    # Files in the pipeline are skipped, since they're leased
+                    with tracer.time('query'):
+                        tbl = etl.dicts(store.lease_rows(conds, params, owner,
+                                                         order='depth, id'))
+                    if tbl:
+                        row = tbl[0]
+                        start_row(row, dest_dir, store, reconvert, counter)
+                        if prefetcher:
+                            # Before the next files are set, which leaves
+                            # out this file since it's leased
+                            if row['source_id'] is None:
+                                local_path = prefetcher.get(row['path'])
+                            prefetch_rows(prefetcher, store, conds, params)
+
+            if not row and not in_progress:
+                if wait_for_leases(store, conds, params):
+                    continue
+                break
+
+            if row:
+                scratch_dir = scratch_dirs.pop()
+                os.makedirs(scratch_dir, exist_ok=True)
+                src_file = File(row, pwconv_path, unidentify, scratch_dir,
+                                local_path)
+                job = Job(row, src_file, src_file.convert_steps(*args),
+                          local_path, scratch_dir)
+                in_progress[row['id']] = job
+                pipeline.submit(job)
+
+            # Wait for a file to finish when no more files can be added
+            for job in pipeline.get_done(wait=(row is None or
+                                               len(in_progress) >= size)):
+                del in_progress[job.row['id']]
+                scratch_dirs.append(job.scratch_dir)
+                if job.error:
+                    raise job.error
+                with store.lock:
+                    finish_row(job.file, job.result, dest_dir, store,
+                               counter)
+                if job.local_path:
+                    prefetcher.release(job.row['path'])
+    finally:
+        pipeline.close()
+
+
+def start_row(row: dict, dest_dir: str, store: Storage, reconvert: bool,
+              counter: Counter) -> None:
+    """Prepare file in `row` for conversion"""
+    counter.start(row['path'])
+
+    if reconvert and row['source_id'] is None:
+        remove_converted(row['id'], row['path'], dest_dir, store)
+
+
+def remove_converted(id: int, path: str, dest_dir: str,
+                     store: Storage) -> None:
+    """Remove files converted from original file, with their rows"""
+    # Remove any copied original files
+    remove_file(Path(dest_dir, path))
+
+    rows = store.get_descendants(id)
+    for file_row in rows:
+        remove_file(Path(dest_dir, file_row[1]))
+
+    store.delete_descendants(id)
+
+
+def finish_row(src_file: File, norm, dest_dir: str, store: Storage,
+               counter: Counter) -> None:
+    """Write result of conversion to database"""
+    with tracer.time('write', src_file.mime):
+        write_row(src_file, norm, dest_dir, store, counter)
+    counter.finish()
+
+
+def write_row(src_file: File, norm, dest_dir: str, store: Storage,
+              counter: Counter) -> None:
+    # If conversion failed
+    if norm is False:
+        if src_file.status != 'accepted':
+            print_message(src_file.path, src_file.status, "bold red")
+    elif type(norm) is str:
+        # Write new files to database
+        n = add_files_to_storage(os.path.join(dest_dir, norm), store, norm,
+                                 source_id=src_file.id,
+                                 depth=src_file.depth + 1)
+        print_message(src_file.path, f'unpacked {n} files', "bold cyan")
+
+        counter.add(n)
+
+    else:
+        if norm.status == 'failed' and norm.kept is True:
+            print_message(norm.path, 'converted file kept', "bold orange1")
+        norm.status_ts = datetime.datetime.now()
+        store.add_row(norm.__dict__)
+
+    src_file.status_ts = datetime.datetime.now()
+    store.update_row(src_file.__dict__ | {'lease_owner': None,
+                                          'lease_expires': None})
+
+
+def print_message(path: str, message: str, style: str) -> None:
+    """Print message about file on its own line, above the progress"""
+    clear_line()
+    console.print(f'{path}: {message}', style=style, markup=False,
+                  highlight=False)
+
+
+def add_files_to_storage(folder: str, store: Storage, unpacked_path: str = '',
+                         source_id: int = None, depth: int = 0) -> int:
+    """
+    Scan folder and add its files to database
+
+    Files already in the database are skipped. Rows are written in
+    batches while the scan goes on.
+
+    Args:
+        unpacked_path: path of folder relative to destination, if the
+                       files are unpacked from an archive
+    Returns:
+        number of files added
+    """
+    prefix = unpacked_path.rstrip('/') + '/' if unpacked_path else ''
+    existing = store.get_paths(prefix)
+    batch_size = cfg['scan']['batch-size']
+    count = 0
+    rows = []
+    for files in scan_tree(folder, cfg['scan']['threads']):
+        for path, size, mtime, inode in files:
+            path = prefix + path
+            if path in existing:
+                continue
+            rows.append({'path': path, 'size': size, 'mtime': mtime,
+                         'inode': inode, 'status': 'new',
+                         'source_id': source_id, 'depth': depth})
+        if len(rows) >= batch_size:
+            store.add_rows(rows)
+            count += len(rows)
+            rows = []
+    store.add_rows(rows)
+    count += len(rows)
+
+    return count
 
 
 def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
                              store: Storage, unpacked_path: str,
-                             source_id: int = None) -> int:
+                             source_id: int = None, depth: int = 0) -> int:
 
     table = etl.fromtext(tsv_source_path, header=['filename'], strip="\n")
     table = etl.rename(
@@ -318,12 +743,14 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
         strict=False,
     )
     table = etl.select(table, lambda rec: rec.path != "")
-    table = add_fields(table, 'mime', 'version', 'status', 'puid', 'source_id')
+    table = add_fields(table, 'mime', 'version', 'status', 'puid', 'source_id',
+                       'depth')
     # Remove Siegfried generated columns
     table = remove_fields(table, "namespace", "basis", "warning")
 
     table = etl.update(table, 'status', "new")
     table = etl.update(table, 'source_id', source_id)
+    table = etl.update(table, 'depth', depth)
 
     # Treat csv (detected from extension only) as plain text:
     table = etl.convert(table, "mime", lambda v,
@@ -345,43 +772,72 @@ def write_id_file_to_storage(tsv_source_path: str, source_dir: str,
     return row_count
 
 
-def check_files(source_dir, store):
-    """ Check if files in database match files on disk """
-
-    files_count = sum([len(files) for r, d, files in os.walk(source_dir)])
-    conds, params = store.get_conds(original=True)
-    total_row_count = store.get_row_count(conds, params)
-
-    if files_count != total_row_count:
-        console.print(f"Row count: {str(total_row_count)}", style="red")
-        console.print(f"File count: {str(files_count)}", style="red")
-        db_files = []
-        table = store.get_all_rows('')
-        for row in etl.dicts(table):
-            db_files.append(row['path'])
-        print("Following files don't exist in database:")
-        extra_files = []
-        for r, d, files in os.walk(source_dir):
-            for file_ in files:
-                path = Path(r, file_)
-                commonprefix = os.path.commonprefix([source_dir, path])
-                relpath = os.path.relpath(path, commonprefix)
-                if relpath not in db_files:
-                    extra_files.append({'path': relpath, 'status': 'new'})
-                    print('- ' + relpath)
-
-        answ = input(f"Files listed in database doesn't match "
+def check_files(source_dir: str, store: Storage, report_path: str,
+                action: str = None) -> str | None:
+    """
+    Check if files in source match files in database
+
+    Compares one scan of source with the original files in the
+    database, and writes files added to or missing from source, or
+    changed since they were scanned, to `report_path`.
+
+    Args:
+        action: what to do if they don't match: continue, cancel, add
+                (new files to database) or delete (new files from source).
+                Asked if not set
+    Returns:
+        action taken, or None if the files match
+    """
+    files = {}
+    for scanned in scan_tree(source_dir, cfg['scan']['threads']):
+        for path, size, mtime, inode in scanned:
+            files[path] = (size, mtime, inode)
+    snapshot = store.get_snapshot()
+
+    added = sorted(path for path in files if path not in snapshot)
+    missing = sorted(path for path, row in snapshot.items()
+                     if path not in files and row['status'] != 'deleted')
+    changed = sorted(
+        path for path, (size, mtime, inode) in files.items()
+        if path in snapshot and snapshot[path]['mtime'] is not None and
+        (size, mtime) != (snapshot[path]['size'], snapshot[path]['mtime'])
+    )
+
+    if not (added or missing or changed):
+        console.print("Files in source match database", style="bold green")
+        return None
+
+    with open(report_path, 'w') as f:
+        f.write('change\tpath\n')
+        for change, paths in (('added', added), ('missing', missing),
+                              ('changed', changed)):
+            for path in paths:
+                f.write(f'{change}\t{path}\n')
+
+    console.print(f"{len(added)} files not in database, {len(missing)} "
+                  f"files missing in source and {len(changed)} changed. "
+                  f"See {report_path}", style="red")
+
+    if not action:
+        answ = input("Files listed in database doesn't match "
                      "files on disk. Continue? [y]es, [n]o, [a]dd, [d]elete ")
-        if answ == 'd':
-            for file_ in extra_files:
-                Path(source_dir, file_['source_path']).unlink()
-            return 'deleted'
-        elif answ == 'a':
-            table = etl.fromdicts(extra_files)
-            store.append_rows(table)
-            return 'added'
-        elif answ != 'y':
-            return 'cancelled'
+        action = {'y': 'continue', 'a': 'add', 'd': 'delete'}.get(answ,
+                                                                  'cancel')
+
+    if action == 'delete':
+        for path in added:
+            Path(source_dir, path).unlink()
+        return 'deleted'
+    elif action == 'add':
+        store.add_rows([{'path': path, 'size': files[path][0],
+                         'mtime': files[path][1], 'inode': files[path][2],
+                         'status': 'new', 'source_id': None, 'depth': 0}
+                        for path in added])
+        return 'added'
+    elif action != 'continue':
+        return 'cancelled'
+
+    return action
 
 
 if __name__ == "__main__":
@@ -10,11 +10,16 @@ from typing import Any, Type, Dict
 from shlex import quote
 import time
 import mimetypes
+import importlib
 
 import magic
+import pikepdf
 
 from config import cfg, converters
-from util import run_shell_cmd
+from util import (run_shell_cmd, is_archive_bomb, delete_file_or_dir,
+                  get_thread_cpu_time, count_children, set_wall_time,
+                  get_scratch_dir, has_scratch_space, place_file,
+                  get_checksum, get_tree_size, tracer)
 
 
 class File:
@@ -24,9 +29,14 @@ class File:
         self,
         row: Dict[str, Any],
         pwconv_path: Path,
-        unidentify: bool
+        unidentify: bool,
+        scratch_dir: str = None,
+        local_path: str = None
     ):
         self._pwconv_path = pwconv_path
+        self._scratch_dir = scratch_dir or get_scratch_dir()
+        # Prefetched copy of source file
+        self._local_path = local_path
         self.id = row['id']
         self.path = row['path']
         self.encoding = row['encoding']
@@ -41,8 +51,28 @@ class File:
         self._stem = Path(self.path).stem
         self.ext = Path(self.path).suffix
         self.kept = row['kept'] or False
+        self.depth = row.get('depth') or 0
+        self.converter = row.get('converter')
+        # Resources used by conversion: seconds, cpu seconds and peak kB.
+        # For engines, cpu seconds are those of the thread running it
+        # and of the processes it ran with `run_shell_cmd`. None if not
+        # known, like for engines converting several files in a process
+        self.wall_time = row.get('wall_time')
+        self.cpu_time = row.get('cpu_time')
+        self.max_rss = row.get('max_rss')
+        self.checksum = row.get('checksum')
+        # Bytes extracted, if it's an archive
+        self.expanded = row.get('expanded')
+        # Bytes extracted from the other archives within the same
+        # original file, see `<expanded>` in converters.yml
+        self._nested_size = 0
 
     def set_metadata(self, source_path, source_dir):
+        if cfg['checksum']:
+            # Read the file before it's identified and converted, so that
+            # these read it from the page cache and not from storage
+            self.checksum = get_checksum(source_path, cfg['checksum'])
+
         if cfg['use_siegfried']:
             cmd = ['sf', '-json', source_path]
             p = subprocess.Popen(cmd, cwd=source_dir, stdout=subprocess.PIPE,
@@ -68,6 +98,30 @@ class File:
             m.load()
             self.encoding = m.buffer(blob)
 
+        if self.mime == 'application/pdf':
+            self.set_pdf_metadata(source_path)
+
+    def set_pdf_metadata(self, source_path):
+        """
+        Set PDF/A version from XMP metadata of pdf
+
+        Siegfried doesn't always report the PDF/A version, so without
+        this the file would be rewritten with Ghostscript even if it's
+        already PDF/A. Encrypted pdfs are identified as such, so that
+        no conversion is attempted.
+        """
+        try:
+            with pikepdf.open(source_path) as pdf:
+                pdfa_status = pdf.open_metadata().pdfa_status
+                # PDF/A requires an output intent
+                if pdfa_status and '/OutputIntents' in pdf.Root:
+                    self.version = pdfa_status.lower()
+        except pikepdf.PasswordError:
+            self.mime = 'application/encrypted'
+        except Exception:
+            # Leave damaged files to the converter
+            pass
+
     def get_dest_ext(self, converter, dest_path, orig_ext):
         if 'dest-ext' not in converter:
             dest_ext = self.ext
@@ -75,13 +129,59 @@ class File:
             dest_ext = ('' if converter['dest-ext'] is None
                         else '.' + converter['dest-ext'].strip('.'))
 
-        if orig_ext and dest_ext != self.ext:
+        # A folder written for a file that's kept would get the path of
+        # the kept file
+        if (orig_ext and dest_ext != self.ext and
+                not (dest_ext == '' and converter.get('keep'))):
             dest_ext = self.ext + dest_ext
 
         return dest_ext
 
-    def get_conversion_cmd(self, converter, source_path, dest_path, temp_path):
-        cmd = converter["command"] if 'command' in converter else None
+    def get_commands(self, converter, store=None):
+        """
+        Get conversion commands in the order they should be tried
+
+        A converter can have an engine and a list of alternative commands.
+        The engine is tried first. When enough attempts are recorded for
+        the file format, alternatives that seldom succeed are skipped.
+        The rest are tried in the declared order, since it says which
+        output is preferred, unless `fallback.order-by-speed` is set in
+        application.yml. Then they are ordered by average time spent per
+        successful conversion.
+        """
+        commands = self.get_alternatives(converter)
+        if len(commands) == 1 or not store:
+            return commands
+
+        stats = store.get_converter_stats(self.puid or self.mime, self.version)
+        limits = cfg['fallback']
+        ranked = []
+        for i, command in enumerate(commands):
+            attempts, failures, seconds = stats.get(command, (0, 0, 0))
+            if attempts < limits['min-attempts']:
+                ranked.append((0, i, command))
+                continue
+            successes = attempts - failures
+            if successes / attempts < limits['min-success-rate']:
+                continue
+            ranked.append((seconds / successes, i, command))
+
+        if limits['order-by-speed']:
+            ranked.sort()
+
+        # Use declared order if all commands seem to fail for this format
+        return [command for cost, i, command in ranked] or commands
+
+    def get_alternatives(self, converter):
+        """Get engine and commands of converter in declared order"""
+        commands = converter.get('command')
+        if not isinstance(commands, list):
+            commands = [commands] if commands else []
+
+        return ([converter['engine']] if 'engine' in converter else []) + list(commands)
+
+    def get_conversion_cmd(self, command, source_path, dest_path, temp_path):
+        cmd = command
 
         if cmd:
             if '<temp>' in cmd:
@@ -95,6 +195,8 @@ class File:
             cmd = cmd.replace("<dest-parent>",
                               quote(str(Path(dest_path).parent)))
             cmd = cmd.replace("<pid>", str(os.getpid()))
+            cmd = cmd.replace("<scratch>", quote(self._scratch_dir))
+            cmd = cmd.replace("<expanded>", str(self._nested_size))
 
         return cmd
 
@@ -111,10 +213,38 @@ class File:
         return accept
 
     def convert(self, source_dir: str, dest_dir: str, orig_ext: bool, debug: bool,
-                set_source_ext: bool, identify_only: bool) -> dict[str, Type[str]]:
+                set_source_ext: bool, identify_only: bool,
+                store=None) -> dict[str, Type[str]]:
+        """Convert file to archive format, running the steps in this thread"""
+        steps = self.convert_steps(source_dir, dest_dir, orig_ext, debug,
+                                   set_source_ext, identify_only, store)
+        result = None
+        while True:
+            try:
+                step = steps.send(result)
+            except StopIteration as e:
+                return e.value
+            result = run_step(step)
+
+    def convert_steps(self, source_dir: str, dest_dir: str, orig_ext: bool,
+                      debug: bool, set_source_ext: bool, identify_only: bool,
+                      store=None):
         """
         Convert file to archive format
 
+        Generator that yields the slow steps of the conversion, and is
+        sent back the result of each step (see `run_step`). This lets
+        `convert` and the stages in pipeline.py share the conversion logic.
+        Steps are yielded as tuples starting with the name of the step:
+
+        - ('identify', file, path, folder): identify file before conversion
+        - ('engine', module, source_path, dest_path, timeout, usage)
+        - ('command', cmd, cwd, timeout, usage)
+        - ('verify', file, path, folder): identify converted file
+
+        If `store` is given, it's used to record and look up how well
+        alternative conversion commands work for the file format
+
         Returns
         - path to converted file
         - False if conversion fails
@@ -125,20 +255,30 @@ class File:
             source_path = os.path.join(dest_dir, self.path)
         else:
             source_path = os.path.join(source_dir, self.path)
+        # Converted files to be converted again are moved aside, next to
+        # the destination, so that they can be restored if the
+        # conversion is interrupted
+        moved_path = os.path.join(dest_dir.rstrip('/') + '-temp', self.path)
+        if self.status == 'interrupted' and os.path.isfile(moved_path):
+            # Replaces any output written in its place
+            shutil.move(moved_path, source_path)
+        read_path = self._local_path or source_path
         dest_path = os.path.join(dest_dir, self._parent, self._stem)
-        # temp_path = os.path.join(dest_dir.rstrip('/') + '-temp',  self.path)
-        temp_path = os.path.join('/tmp/convert',  self.path)
         dest_path = os.path.abspath(dest_path)
         os.makedirs(os.path.dirname(dest_path), exist_ok=True)
 
         if self.mime in ['', 'None', None]:
-            self.set_metadata(source_path, source_dir)
+            yield ('identify', self, read_path, source_dir)
+        elif cfg['checksum'] and not self.checksum:
+            self.checksum = get_checksum(read_path, cfg['checksum'])
 
         if self.mime not in converters:
             self.status = 'skipped'
             converter = {}
         else:
-            converter = converters[self.mime]
+            # Copy, since puid and source-ext settings are merged into it,
+            # and files of the same type may be converted at the same time
+            converter = dict(converters[self.mime])
 
         mime_ext = converter.get('ext')
         mime_ext = '.' + mime_ext.lstrip('.') if mime_ext else None
@@ -152,6 +292,8 @@ class File:
             self.ext = mime_ext
             self.path = str(Path(self._parent, self._stem + mime_ext))
             source_path = os.path.join(source_dir, self.path)
+            if not self._local_path:
+                read_path = source_path
 
         if identify_only:
             return None
@@ -163,24 +305,41 @@ class File:
 
         accept = self.is_accepted(converter)
 
+        # The limit on total size counts what's extracted from all
+        # archives within the original file
+        if converter.get('archive', False) and store and self.depth:
+            self._nested_size = store.get_expanded_size(self.id)
+
         norm_path = None
         if accept:
             self.status = 'accepted'
         elif self.mime == 'application/encrypted':
             self.status = 'protected'
-        elif 'command' in converter:
-            from_path = source_path
+        elif (converter.get('archive', False) and
+              is_archive_bomb(read_path, self.depth, self._nested_size)):
+            self.status = 'rejected'
+        elif 'command' in converter or 'engine' in converter:
+            from_path = read_path
 
             dest_ext = self.get_dest_ext(converter, dest_path, orig_ext)
             dest_path = dest_path + dest_ext
 
-            if self.source_id and self.ext == dest_ext:
-                os.makedirs(os.path.dirname(temp_path), exist_ok=True)
-                shutil.move(source_path, temp_path)
-                from_path = temp_path
+            # Output of the interrupted conversion may be incomplete
+            if (self.status == 'interrupted' and dest_path != source_path
+                    and os.path.exists(dest_path)):
+                delete_file_or_dir(dest_path)
 
-            cmd = self.get_conversion_cmd(converter, from_path, dest_path,
-                                          temp_path)
+            # Files too large for the scratch directory are written
+            # next to the destination, apart from any moved source
+            if has_scratch_space(self.size):
+                temp_path = os.path.join(self._scratch_dir, 'temp', self.path)
+            else:
+                temp_path = moved_path + '.tmp'
+
+            if self.source_id and self.ext == dest_ext:
+                os.makedirs(os.path.dirname(moved_path), exist_ok=True)
+                shutil.move(source_path, moved_path)
+                from_path = moved_path
 
             # Disabled because not in use, and file command doesn't have version
             # with option --mime-type
@@ -188,12 +347,62 @@ class File:
             timeout = (converter['timeout'] if 'timeout' in converter
                        else cfg['timeout'])
 
+            cmd = ''
+            out = ''
+            err = ''
             returncode = 0
             # Don't run convert command if file is converted manually
             if (not os.path.exists(dest_path) or os.path.getsize(dest_path) == self.size):
 
-                returncode, out, err = run_shell_cmd(cmd, cwd=self._pwconv_path,
-                                                     shell=True, timeout=timeout)
+                alternatives = self.get_alternatives(converter)
+                self.wall_time = 0
+                self.cpu_time = None
+                self.max_rss = None
+                for command in self.get_commands(converter, store):
+                    # Set where the step is run, so that time spent
+                    # waiting in the pipeline isn't counted
+                    usage = {}
+                    if command == converter.get('engine'):
+                        cmd = command
+                        returncode, out, err = yield ('engine', command, from_path,
+                                                      dest_path, timeout, usage)
+                        out = out or ''
+                        # Engines report how the file was converted
+                        self.converter = command + (': ' + out if not returncode
+                                                    and out else '')
+                    else:
+                        self.converter = command
+                        # Commands that look for files next to the source
+                        # must read it where it is
+                        path = (source_path if '<source-parent>' in command
+                                and from_path == self._local_path else from_path)
+                        cmd = self.get_conversion_cmd(command, path,
+                                                      dest_path, temp_path)
+                        returncode, out, err = yield ('command', cmd,
+                                                      self._pwconv_path,
+                                                      timeout, usage)
+                    seconds = usage.get('wall_time', 0)
+                    self.wall_time += seconds
+                    # Keyed by command template or engine, since many
+                    # commands start with the same program
+                    tracer.add('convert', f'{self.mime}: {command}', seconds)
+                    # Usage of this conversion alone, since other
+                    # conversions may run at the same time. Left out
+                    # when it isn't known
+                    if 'cpu_time' in usage:
+                        self.cpu_time = ((self.cpu_time or 0) +
+                                         usage['cpu_time'])
+                    if 'max_rss' in usage:
+                        self.max_rss = max(self.max_rss or 0, usage['max_rss'])
+                    failed = bool(returncode) or not os.path.exists(dest_path)
+                    if store and len(alternatives) > 1:
+                        store.add_converter_stat(self.puid or self.mime,
+                                                 self.version, command,
+                                                 failed, seconds)
+                    if not failed:
+                        break
+                    # Remove any partial output before trying next command
+                    delete_file_or_dir(dest_path)
 
             if returncode or not os.path.exists(dest_path):
                 if os.path.isfile(dest_path):
@@ -207,6 +416,8 @@ class File:
                     time.sleep(0.1)
                 if 'file requires a password for access' in out:
                     self.status = 'protected'
+                elif 'Archive exceeds limits' in out:
+                    self.status = 'rejected'
                 elif out == 'timeout':
                     self.status = 'timeout'
                 else:
@@ -220,7 +431,7 @@ class File:
 
                 # Move the file back from temp if it was moved there
                 # prior to conversion
-                if from_path != source_path:
+                if from_path == moved_path:
                     # use shutil.copyfile to not get any file permission error
                     shutil.copyfile(from_path, source_path)
                     os.remove(from_path)
@@ -229,11 +440,15 @@ class File:
             else:
                 self.status = 'converted'
                 norm_path = relpath(dest_path, start=dest_dir)
+                if converter.get('archive', False):
+                    self.expanded = get_tree_size(dest_path)[1]
 
             if os.path.isfile(temp_path):
                 os.remove(temp_path)
             elif os.path.isdir(temp_path):
                 shutil.rmtree(temp_path)
+            if from_path == moved_path and os.path.isfile(moved_path):
+                os.remove(moved_path)
         elif 'keep' in converter and converter['keep'] is False:
             self.status = 'removed'
         else:
@@ -247,6 +462,7 @@ class File:
             accept or
             self.status == 'skipped' or
             self.status == 'protected' or
+            self.status == 'rejected' or
             norm_path is False  # conversion failed
         ):
             self.kept = True
@@ -263,7 +479,9 @@ class File:
                     copy_path = Path(dest_dir, self._parent, dest_name)
                     norm_path = relpath(copy_path, start=dest_dir)
                 try:
-                    shutil.copyfile(Path(source_dir, self.path), copy_path)
+                    with tracer.time('copy', self.mime):
+                        place_file(Path(source_dir, self.path), copy_path,
+                                   copy_from=self._local_path)
                 except Exception as e:
                     frame = getframeinfo(currentframe())
                     filename = frame.filename
@@ -290,10 +508,17 @@ class File:
                 'status': 'new',
                 'size': None,
                 'source_id': self.id or self.source_id,
-                'kept': False
+                'kept': False,
+                'depth': self.depth,
+                'converter': None,
+                'wall_time': None,
+                'cpu_time': None,
+                'max_rss': None,
+                'checksum': None,
+                'expanded': None
             }
-            new_file = File(row, self._pwconv_path, True)
-            new_file.set_metadata(str(dest_path), dest_dir)
+            new_file = File(row, self._pwconv_path, True, self._scratch_dir)
+            yield ('verify', new_file, str(dest_path), dest_dir)
 
             # If the file is converted again with the same extension,
             # we should accept it. This happens when a pdf can't be
@@ -303,10 +528,63 @@ class File:
                 new_file.kept = True
                 norm_file = False
             else:
-                norm_file = new_file.convert(source_dir, dest_dir, orig_ext,
-                                             debug, set_source_ext, identify_only)
+                norm_file = yield from new_file.convert_steps(
+                    source_dir, dest_dir, orig_ext, debug, set_source_ext,
+                    identify_only, store
+                )
 
             return norm_file if norm_file else new_file
 
         else:
             return False
+
+
+def queue_step(step: tuple) -> None:
+    """
+    Tell engine of step that the step is waiting to be run
+
+    Engines with a `queue` function can then convert the file together
+    with other files they convert.
+    """
+    name, *args = step
+    if name == 'engine':
+        module = importlib.import_module(args[0])
+        if hasattr(module, 'queue'):
+            module.queue(args[1], args[2])
+
+
+def run_step(step: tuple):
+    """Run step yielded by `File.convert_steps`, and return its result"""
+    name, *args = step
+    if name in ('identify', 'verify'):
+        file, path, folder = args
+        t0 = time.perf_counter()
+        result = file.set_metadata(path, folder)
+        tracer.add(name, file.mime, time.perf_counter() - t0)
+        return result
+    elif name == 'engine':
+        module, source_path, dest_path, timeout, usage = args
+        module = importlib.import_module(module)
+        t0 = time.perf_counter()
+        cpu0 = get_thread_cpu_time()
+        try:
+            # With the processes the engine runs, like ffmpeg
+            with count_children({}) as children:
+                result = module.convert(source_path, dest_path, timeout)
+        except Exception as e:
+            # Fails the file, like a command that fails
+            result = (1, '', str(e))
+        set_wall_time(usage, t0)
+        # Engines that keep state between files, like the Ghostscript
+        # process, convert several files in the same process, so the
+        # usage of one file isn't known
+        if not getattr(module, 'SERIAL', False):
+            usage['cpu_time'] = (get_thread_cpu_time() - cpu0 +
+                                 children.get('cpu_time', 0))
+            if 'max_rss' in children:
+                usage['max_rss'] = children['max_rss']
+        return result
+    else:
+        cmd, cwd, timeout, usage = args
+        return run_shell_cmd(cmd, cwd=cwd, shell=True, timeout=timeout,
+                             usage=usage)
@@ -0,0 +1,56 @@
+import itertools
+import os
+from pathlib import Path
+import typer
+import petl as etl
+from storage import Storage
+from config import cfg
+
+
+def manifest(dest: str, db: str = None, originals: bool = False,
+             output: str = None):
+    """
+    Write manifest with checksums calculated during conversion
+
+    Each line has checksum and path, as in BagIt manifests and output
+    from sha256sum.
+
+    --db:        Name of MySQL base.\n
+    ..           If not set, it uses a SQLite base with path `dest + .db`
+
+    --originals: List original files instead of files in DEST
+
+    --output:    Path of manifest. Default is `dest + -manifest-<algorithm>.txt`,
+    ..           with `-originals` added when listing original files
+    """
+
+    if not cfg['checksum']:
+        print('No checksums are calculated, since `checksum` is not set '
+              'in application.yml')
+        raise typer.Exit(code=1)
+
+    if not db:
+        db = dest.rstrip('/') + '.db'
+
+    if not output:
+        output = (dest.rstrip('/') + ('-originals' if originals else '') +
+                  '-manifest-' + cfg['checksum'] + '.txt')
+
+    count = 0
+    with Storage(db) as store, open(output, 'w') as f:
+        rows = etl.dicts(store.get_checksums(original=originals))
+        for path, group in itertools.groupby(rows, key=lambda r: r['path']):
+            # Only the newest row of a path in dest, since the file of
+            # older rows has been written over
+            for row in list(group)[0 if originals else -1:]:
+                # Files converted further, or removed, are no longer in dest
+                if not originals and not os.path.isfile(Path(dest, path)):
+                    continue
+                f.write(f"{row['checksum']}  {path}\n")
+                count += 1
+
+    print(f'Wrote {count} checksums to {output}')
+
+
+if __name__ == "__main__":
+    typer.run(manifest)
@@ -0,0 +1,197 @@
+from __future__ import annotations
+import asyncio
+import importlib
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from file import File, run_step, queue_step
+from util import Supervisor, profiler
+
+# Stage that runs each step yielded by `File.convert_steps`
+STAGES = {
+    'identify': 'identify',
+    'engine': 'convert',
+    'command': 'convert',
+    'verify': 'verify',
+}
+
+
+class Job:
+    """File in the pipeline, with the steps left of its conversion"""
+
+    def __init__(self, row: dict, file: File, steps, local_path: str = None,
+                 scratch_dir: str = None):
+        self.row = row
+        self.file = file
+        self.local_path = local_path
+        self.scratch_dir = scratch_dir
+        # Next step to run, None when the conversion is finished
+        self.step = None
+        self.result = None
+        self.error = None
+        self._steps = steps
+
+    def advance(self, result=None) -> None:
+        """Send result of step, and run conversion until the next step"""
+        try:
+            self.step = self._steps.send(result)
+        except StopIteration as e:
+            self.step = None
+            self.result = e.value
+        except Exception as e:
+            self.fail(e)
+
+    def run(self, lock: threading.Lock = None) -> None:
+        """Run step in this thread, and advance to the next"""
+        try:
+            if self.step is None:
+                # Start the conversion
+                result = None
+            elif lock:
+                with lock:
+                    result = run_step(self.step)
+            else:
+                result = run_step(self.step)
+        except Exception as e:
+            self.fail(e)
+            return
+
+        self.advance(result)
+
+    def fail(self, error: Exception) -> None:
+        self.step = None
+        self.error = error
+        self._steps.close()
+
+
+class Pipeline:
+    """
+    Converts files in stages that run at the same time
+
+    - identify: threads identifying files before they're converted.
+      New jobs start here, where also the steps before conversion
+      are run, like checking archives
+    - convert: an event loop running `jobs` conversions at a time.
+      Commands are run by a `Supervisor`, and engines in threads
+    - verify: threads identifying converted files
+
+    Each step of a job is sent to the stage that runs it, until the
+    conversion is finished. A converted file that must be converted
+    again goes back to the convert stage. Finished jobs are returned
+    by `get_done`. The caller bounds the queues by limiting the
+    number of jobs in the pipeline.
+    """
+
+    def __init__(self, jobs: int, identify: int, verify: int):
+        self._jobs = jobs
+        self._queues = {stage: queue.Queue()
+                        for stage in ('identify', 'convert', 'verify')}
+        self._done = queue.Queue()
+        # Engines that keep state between files, like the Ghostscript
+        # process, set `SERIAL` and are run by one thread at a time
+        self._engine_locks = defaultdict(threading.Lock)
+        # Stage of each thread
+        work = profiler.wrap(self._work)
+        self._threads = (
+            [('identify', threading.Thread(target=work,
+                                           args=('identify',), daemon=True))
+             for _ in range(identify)] +
+            [('verify', threading.Thread(target=work,
+                                         args=('verify',), daemon=True))
+             for _ in range(verify)] +
+            [('convert', threading.Thread(target=profiler.wrap(asyncio.run),
+                                          args=(self._convert_loop(),),
+                                          daemon=True))]
+        )
+        for stage, thread in self._threads:
+            thread.start()
+
+    def submit(self, job: Job) -> None:
+        self._queues['identify'].put(job)
+
+    def get_done(self, wait: bool = False) -> list[Job]:
+        """Get finished jobs, waiting for at least one if `wait`"""
+        jobs = []
+        try:
+            if wait:
+                jobs.append(self._done.get())
+            while True:
+                jobs.append(self._done.get_nowait())
+        except queue.Empty:
+            pass
+
+        return jobs
+
+    def close(self) -> None:
+        """Stop the stages when the jobs are done"""
+        for stage, thread in self._threads:
+            self._queues[stage].put(None)
+        for stage, thread in self._threads:
+            thread.join()
+
+    def _route(self, job: Job) -> None:
+        if job.step is None:
+            self._done.put(job)
+        else:
+            if job.step[0] == 'engine':
+                queue_step(job.step)
+            self._queues[STAGES[job.step[0]]].put(job)
+
+    def _work(self, stage: str) -> None:
+        while (job := self._queues[stage].get()) is not None:
+            job.run()
+            self._route(job)
+
+    async def _convert_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        supervisor = Supervisor(self._jobs)
+        # Engines and the steps between commands are run in these threads,
+        # so that they don't block the event loop
+        executor = ThreadPoolExecutor(self._jobs)
+        slots = asyncio.Semaphore(self._jobs)
+        tasks = set()
+        while True:
+            await slots.acquire()
+            job = await loop.run_in_executor(None, self._queues['convert'].get)
+            if job is None:
+                break
+            task = asyncio.ensure_future(
+                self._convert(job, supervisor, executor, slots)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+        executor.shutdown()
+
+    async def _convert(self, job: Job, supervisor: Supervisor,
+                       executor: ThreadPoolExecutor,
+                       slots: asyncio.Semaphore) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while job.step and STAGES[job.step[0]] == 'convert':
+                name, *args = job.step
+                if name == 'engine':
+                    lock = None
+                    if getattr(importlib.import_module(args[0]), 'SERIAL',
+                               False):
+                        lock = self._engine_locks[args[0]]
+                    await loop.run_in_executor(executor,
+                                               profiler.wrap(job.run), lock)
+                    continue
+                cmd, cwd, timeout, usage = args
+                try:
+                    result = await supervisor.run(cmd, cwd=cwd, shell=True,
+                                                  timeout=timeout, usage=usage)
+                except Exception as e:
+                    job.fail(e)
+                    break
+                await loop.run_in_executor(executor,
+                                           profiler.wrap(job.advance), result)
+        finally:
+            slots.release()
+
+        self._route(job)
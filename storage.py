@@ -1,7 +1,10 @@
+import fcntl
 import os
 import sqlite3
 import pymysql
 import datetime
+import threading
+from contextlib import contextmanager
 from sqlite3 import Connection
 from typing import Optional
 
@@ -22,7 +25,7 @@ class Storage:
         mime varchar(100),
         encoding varchar(30),
         ext varchar(10),
-        status varchar(10),
+        status varchar(20),
         status_ts datetime,
         kept boolean,
         source_id int
@@ -46,10 +49,39 @@ class Storage:
     order by path;
     """
 
+    _create_table_converter_stat = """
+    CREATE TABLE IF NOT EXISTS converter_stat(
+        format varchar(100) not null,
+        version varchar(32) not null,
+        command varchar(1000) not null,
+        attempts integer,
+        failures integer,
+        seconds double
+    );
+    """
+
+    # Columns added after the original schema. These are added to
+    # existing databases when the data source is loaded
+    _added_columns = {
+        'depth': 'integer',
+        'converter': 'varchar(1000)',
+        'wall_time': 'double',
+        'cpu_time': 'double',
+        'max_rss': 'integer',
+        'checksum': 'varchar(128)',
+        'lease_owner': 'varchar(255)',
+        'lease_expires': 'datetime',
+        'mtime': 'double',
+        'inode': 'bigint',
+        'expanded': 'bigint',
+    }
+
     def __init__(self, path: str):
         self._conn = Optional[Connection]
         self.path = path
         self.system = 'sqlite' if '.' in path else 'mysql'
+        # Held when the connection is used from several threads
+        self.lock = threading.RLock()
 
     def __enter__(self):
         self.load_data_source()
@@ -64,7 +96,7 @@ class Storage:
             if not os.path.isdir(storage_dir):
                 os.makedirs(storage_dir)
 
-            self._conn = sqlite3.connect(self.path)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
 
             query = """
                 SELECT name FROM sqlite_master 
@@ -106,8 +138,34 @@ class Storage:
             cursor.execute("CREATE INDEX file_status on file(status)")
             cursor.execute("CREATE INDEX file_status_ts on file(status_ts)")
             cursor.execute(self._create_view_file_root)
+        self.add_missing_columns(cursor)
+        cursor.execute(self._create_table_converter_stat)
         self._conn.commit()
 
+    def add_missing_columns(self, cursor):
+        cursor.execute('SELECT * FROM file LIMIT 0')
+        columns = [col[0] for col in cursor.description]
+        cursor.fetchall()
+        for column, datatype in self._added_columns.items():
+            if column in columns:
+                continue
+            cursor.execute(f'ALTER TABLE file ADD COLUMN {column} {datatype}')
+            if column == 'depth':
+                cursor.execute('UPDATE file SET depth = 0')
+                cursor.execute('CREATE INDEX file_depth on file(depth)')
+
+        # Make room for statuses 'in_progress' and 'interrupted'.
+        # SQLite doesn't limit the length
+        if self.system == 'mysql':
+            cursor.execute(f"""
+            SELECT character_maximum_length
+            FROM information_schema.columns
+            WHERE table_schema = '{self.path}'
+            AND table_name = 'file' AND column_name = 'status'
+            """)
+            if cursor.fetchone()[0] < 20:
+                cursor.execute('ALTER TABLE file MODIFY status varchar(20)')
+
     def close_data_source(self):
         if self._conn:
             self._conn.close()
@@ -142,6 +200,38 @@ class Storage:
                                   if k != 'id' and not k.startswith('_')))
         self._conn.commit()
 
+    def add_rows(self, rows: list[dict]):
+        """Insert rows with the same fields"""
+        if not rows:
+            return
+        fields = [k for k in rows[0] if k != 'id' and not k.startswith('_')]
+        sql = "insert into file ({}) values ({})".format(
+            ', '.join(fields), ', '.join(['?'] * len(fields))
+        )
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.executemany(sql, [tuple(row[k] for k in fields)
+                                 for row in rows])
+        self._conn.commit()
+
+    def update_rows(self, rows: list[dict]):
+        """Update rows with the same fields"""
+        if not rows:
+            return
+        fields = [k for k in rows[0] if k != 'id' and not k.startswith('_')]
+        sql = 'UPDATE file SET {} WHERE id = ?'.format(
+            ', '.join(f'{k}=?' for k in fields)
+        )
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.executemany(sql, [tuple(row[k] for k in fields) + (row['id'],)
+                                 for row in rows])
+        self._conn.commit()
+
     def add_row(self, data: dict):
         sql = "insert into file ({})".format(', '.join('{}'.format(k) for k in data
                                                        if k != 'id' and not k.startswith('_')))
@@ -250,11 +340,12 @@ class Storage:
             conds.append("source_id IS NULL")
 
         if not finished and not reconvert:
-            conds.append('(status is null or status not in (?, ?, ?, ?))')
+            conds.append('(status is null or status not in (?, ?, ?, ?, ?))')
             params.append('converted')
             params.append('accepted')
             params.append('removed')
             params.append('renamed')
+            params.append('deleted')
 
         if reconvert:
             conds.append('source_id is null')
@@ -302,13 +393,16 @@ class Storage:
 
         return conds, params
 
-    def get_rows(self, conds, params, limit=None):
+    def get_rows(self, conds, params, limit=None, order=None):
 
         select = "SELECT * from file"
 
         if len(conds):
             select += " WHERE " + ' AND '.join(conds)
 
+        if order:
+            select += " ORDER BY " + order
+
         # Since the selection is run for every file, limit the result.
         # If not the query takes too long on MySQL for large number of files
         if limit:
@@ -319,6 +413,212 @@ class Storage:
 
         return fromdb(self._conn, select, params)
 
+    def lease_rows(self, conds, params, owner, limit=1, order=None):
+        """
+        Lease rows for conversion, so that other workers skip them
+
+        The rows get status 'in_progress' until the result is written,
+        and are leased for `lease.seconds` in application.yml. The
+        lease is renewed by `renew_leases` while the worker runs.
+        On MySQL, rows being leased by other workers are skipped with
+        `SKIP LOCKED`. On SQLite the database is locked while the rows
+        are leased.
+
+        Returns:
+            petl table with the leased rows, with status as before
+        """
+        expires = (datetime.datetime.now() +
+                   datetime.timedelta(seconds=cfg['lease']['seconds']))
+        conds = conds + ['(status is null or status <> ?)']
+        select = "SELECT * FROM file WHERE " + ' AND '.join(conds)
+        if order:
+            select += " ORDER BY " + order
+        select += " LIMIT " + str(limit)
+        update = """
+        UPDATE file
+        SET    status = ?, lease_owner = ?, lease_expires = ?
+        WHERE  id IN ({})
+        """
+        if self.system == 'mysql':
+            select = select.replace('?', '%s') + " FOR UPDATE SKIP LOCKED"
+            update = update.replace('?', '%s')
+
+        with self.lock:
+            cursor = self._conn.cursor()
+            if self.system == 'mysql':
+                self._conn.begin()
+            else:
+                if self._conn.in_transaction:
+                    self._conn.commit()
+                cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute(select, params + ['in_progress'])
+                fields = [col[0] for col in cursor.description]
+                rows = [dict(zip(fields, row)) for row in cursor.fetchall()]
+                if rows:
+                    marks = ', '.join(['%s' if self.system == 'mysql'
+                                       else '?'] * len(rows))
+                    cursor.execute(update.format(marks),
+                                   ['in_progress', owner, expires] +
+                                   [row['id'] for row in rows])
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+        return petl.fromdicts(rows, header=fields)
+
+    def count_unleased(self, conds, params):
+        """
+        Count rows `lease_rows` could lease, including rows skipped
+        because other workers are leasing them
+        """
+        conds = conds + ['(status is null or status <> ?)']
+        with self.lock:
+            # Ends the transaction, so that rows leased since are seen
+            self._conn.commit()
+            return self.get_row_count(conds, params + ['in_progress'])
+
+    @contextmanager
+    def scan_lock(self):
+        """
+        Let one worker at a time add files found in source, so that
+        workers starting at the same time don't add the same files
+        """
+        if self.system == 'mysql':
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT GET_LOCK(%s, -1)",
+                           [self.path + '.scan'])
+            try:
+                yield
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)",
+                               [self.path + '.scan'])
+        else:
+            with open(self.path + '-scan.lock', 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def renew_leases(self, owner):
+        """Extend leases of rows being converted by `owner`"""
+        sql = """
+        UPDATE file SET lease_expires = ?
+        WHERE  lease_owner = ?
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+        expires = (datetime.datetime.now() +
+                   datetime.timedelta(seconds=cfg['lease']['seconds']))
+
+        with self.lock:
+            cursor = self._conn.cursor()
+            cursor.execute(sql, [expires, owner])
+            self._conn.commit()
+
+    def recover_rows(self, is_stale):
+        """
+        Give status 'interrupted' to rows left in progress by workers
+        that are gone, so that they're converted again
+
+        A worker is gone when its leases have expired, or when
+        `is_stale(owner)` is true.
+
+        Returns:
+            number of recovered rows
+        """
+        owners = """
+        SELECT DISTINCT lease_owner FROM file
+        WHERE  status = ?
+        """
+        recover = """
+        UPDATE file
+        SET    status = ?, lease_owner = NULL, lease_expires = NULL
+        WHERE  status = ? AND {} = ?
+        """
+        expired = recover.replace('{} =', 'lease_expires <')
+        recover = recover.format('lease_owner')
+        if self.system == 'mysql':
+            owners = owners.replace('?', '%s')
+            recover = recover.replace('?', '%s')
+            expired = expired.replace('?', '%s')
+
+        count = 0
+        with self.lock:
+            cursor = self._conn.cursor()
+            cursor.execute(owners, ['in_progress'])
+            for owner in [row[0] for row in cursor.fetchall()]:
+                if is_stale(owner):
+                    cursor.execute(recover,
+                                   ['interrupted', 'in_progress', owner])
+                    count += cursor.rowcount
+            cursor.execute(expired, ['interrupted', 'in_progress',
+                                     datetime.datetime.now()])
+            count += cursor.rowcount
+            self._conn.commit()
+
+        return count
+
+    def get_paths(self, prefix=''):
+        """Get paths of files starting with `prefix`"""
+        select = "SELECT path FROM file"
+        params = []
+        if prefix:
+            select += " WHERE path LIKE ?"
+            params.append(prefix + '%')
+            if self.system == 'mysql':
+                select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+
+        # Wildcards in prefix may match more paths, which does no harm
+        return {row[0] for row in cursor.fetchall()}
+
+    def get_snapshot(self, folder=None, recursive=False):
+        """
+        Get size and modification time of original files, as recorded
+        when the source was scanned
+
+        Args:
+            folder: only files in this folder, or all files if None
+            recursive: include files in subfolders of `folder`
+        Returns:
+            dict with id, size, mtime and status of each file, by path
+        """
+        select = """
+        SELECT id, path, size, mtime, status FROM file
+        WHERE  source_id IS NULL
+        """
+        params = []
+        if folder == '':
+            if not recursive:
+                select += " AND path NOT LIKE ?"
+                params.append('%/%')
+        elif folder is not None:
+            # Wildcards in the folder name only match more files,
+            # which are filtered out below
+            select += " AND path LIKE ?"
+            params.append(folder + '/%')
+        if self.system == 'mysql':
+            select = select.replace('?', '%s')
+
+        cursor = self._conn.cursor()
+        cursor.execute(select, params)
+        snapshot = {}
+        for id, path, size, mtime, status in cursor.fetchall():
+            if folder and not path.startswith(folder + '/'):
+                continue
+            if folder is not None and not recursive:
+                if os.path.dirname(path) != folder:
+                    continue
+            snapshot[path] = {'id': id, 'size': size, 'mtime': mtime,
+                              'status': status}
+
+        return snapshot
+
     def get_failed_rows(self, mime: str = None):
         select = """
             SELECT path FROM file
@@ -335,6 +635,29 @@ class Storage:
 
         return fromdb(self._conn, select, params)
 
+    def get_checksums(self, original: bool = False):
+        """
+        Get path and checksum of files, ordered by path and then by
+        when the rows were added
+
+        Args:
+            original: get original files instead of files in destination
+        """
+        select = """
+            SELECT path, checksum FROM file
+            WHERE  checksum IS NOT NULL
+        """
+        if original:
+            select += " AND source_id IS NULL"
+        else:
+            select += " AND (source_id IS NOT NULL OR kept = 1)"
+        # A converted file may be written over by its own conversion,
+        # like an attachment converted to text with the same extension.
+        # The newest row of each path is then the file in destination
+        select += " ORDER BY path, id"
+
+        return fromdb(self._conn, select)
+
     def get_skipped_rows(self, mime: str = None):
         select = """
             SELECT path FROM file
@@ -389,6 +712,78 @@ class Storage:
         self._conn.commit()
         params.pop(0)
 
+    def get_converter_stats(self, format, version):
+        """Get attempts, failures and seconds spent per conversion command"""
+        sql = """
+        SELECT command, attempts, failures, seconds FROM converter_stat
+        WHERE  format = ? AND version = ?
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        with self.lock:
+            cursor = self._conn.cursor()
+            cursor.execute(sql, [format, version or ''])
+
+            return {row[0]: row[1:] for row in cursor.fetchall()}
+
+    def add_converter_stat(self, format, version, command, failed, seconds):
+        params = [int(failed), seconds, format, version or '', command]
+        sql = """
+        UPDATE converter_stat
+        SET    attempts = attempts + 1, failures = failures + ?,
+               seconds = seconds + ?
+        WHERE  format = ? AND version = ? AND command = ?
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        insert = """
+        INSERT INTO converter_stat
+            (failures, seconds, format, version, command, attempts)
+        VALUES (?, ?, ?, ?, ?, 1)
+        """
+        if self.system == 'mysql':
+            insert = insert.replace('?', '%s')
+
+        with self.lock:
+            cursor = self._conn.cursor()
+            cursor.execute(sql, params)
+            if cursor.rowcount == 0:
+                cursor.execute(insert, params)
+            self._conn.commit()
+
+    def get_expanded_size(self, id):
+        """
+        Get bytes extracted from the other archives within the same
+        original file as row `id`, as recorded in column `expanded`
+        """
+        sql = """
+        with recursive ancestor as (
+        select a.id, a.source_id from file a
+        where a.id = ?
+        union all
+        select b.id, b.source_id from file b
+        inner join ancestor c on b.id = c.source_id
+        ), descendant as (
+        select id from ancestor
+        where source_id is null
+        union all
+        select b.id from file b
+        inner join descendant c on c.id = b.source_id
+        )
+        select sum(expanded) from file
+        where id in (select id from descendant) and id <> ?
+        """
+        if self.system == 'mysql':
+            sql = sql.replace('?', '%s')
+
+        with self.lock:
+            cursor = self._conn.cursor()
+            cursor.execute(sql, [id, id])
+
+            return cursor.fetchone()[0] or 0
+
     def get_descendants(self, id):
         sql = """
         with recursive descendant as (
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import cfg  # noqa: E402
+from storage import Storage  # noqa: E402
+from util import remove_scratch_dir  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    """SQLite database with the file table"""
+    with Storage(str(tmp_path / 'test.db')) as store:
+        yield store
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    """Scratch directories in a temporary folder"""
+    root = tmp_path / 'scratch'
+    monkeypatch.setitem(cfg['scratch'], 'root', str(root))
+    monkeypatch.setenv('TMPDIR', os.environ.get('TMPDIR', ''))
+    yield root
+    remove_scratch_dir()
+
+
+def make_row(path, **fields):
+    """Row of original file, as added when the source is scanned"""
+    return {'path': path, 'size': 1, 'status': 'new', 'source_id': None,
+            'depth': 0} | fields
@@ -0,0 +1,85 @@
+import gzip
+import os
+import zipfile
+
+import petl as etl
+import pytest
+
+from conftest import make_row
+from config import cfg
+from util import ArchiveLimitError, is_archive_bomb
+from bin.unarchive import gunzip
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setitem(cfg['archive'], 'max-depth', 2)
+    monkeypatch.setitem(cfg['archive'], 'max-files', 10)
+    monkeypatch.setitem(cfg['archive'], 'max-size', 1_000_000)
+    monkeypatch.setitem(cfg['archive'], 'max-ratio', 100)
+    return cfg['archive']
+
+
+def make_zip(path, files):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name, data in files.items():
+            zfile.writestr(name, data)
+    return str(path)
+
+
+def test_is_archive_bomb_accepts_small_archive(tmp_path, limits):
+    path = make_zip(tmp_path / 'a.zip', {'a.txt': os.urandom(1000)})
+    assert not is_archive_bomb(path)
+
+
+def test_is_archive_bomb_checks_limits(tmp_path, limits):
+    many = make_zip(tmp_path / 'many.zip',
+                    {f'{i}.txt': b'x' for i in range(11)})
+    ratio = make_zip(tmp_path / 'ratio.zip', {'a.txt': bytes(500_000)})
+    assert is_archive_bomb(many)
+    assert is_archive_bomb(ratio)
+
+
+def test_is_archive_bomb_checks_depth_and_expanded(tmp_path, limits):
+    path = make_zip(tmp_path / 'a.zip', {'a.txt': os.urandom(1000)})
+    assert is_archive_bomb(path, depth=2)
+    assert is_archive_bomb(path, expanded=999_500)
+
+
+def test_gunzip_checks_bytes_written(tmp_path, limits):
+    path = tmp_path / 'a.gz'
+    path.write_bytes(gzip.compress(bytes(500_000)))
+    dest = tmp_path / 'a'
+    with pytest.raises(ArchiveLimitError):
+        gunzip(str(path), str(dest))
+    assert not dest.exists()
+
+    path.write_bytes(gzip.compress(b'text'))
+    gunzip(str(path), str(dest))
+    assert dest.read_bytes() == b'text'
+
+
+def test_gunzip_counts_nested_archives(tmp_path, limits):
+    path = tmp_path / 'a.gz'
+    path.write_bytes(gzip.compress(os.urandom(2000)))
+    dest = tmp_path / 'a'
+    with pytest.raises(ArchiveLimitError):
+        gunzip(str(path), str(dest), expanded=999_000)
+    assert not dest.exists()
+
+
+def test_get_expanded_size(store):
+    # Archive with a nested archive, in another archive, and an
+    # unrelated archive
+    store.add_rows([
+        make_row('a.zip', expanded=100),
+        make_row('a.zip/b.zip', source_id=1, depth=1, expanded=20),
+        make_row('a.zip/b.zip/c.zip', source_id=2, depth=2, expanded=3),
+        make_row('a.zip/d.zip', source_id=1, depth=1, expanded=None),
+        make_row('e.zip', expanded=5000),
+    ])
+    ids = {row['path']: row['id'] for row in etl.dicts(store.get_rows([], []))}
+
+    assert store.get_expanded_size(ids['a.zip/b.zip/c.zip']) == 120
+    assert store.get_expanded_size(ids['a.zip/d.zip']) == 123
+    assert store.get_expanded_size(ids['e.zip']) == 0
@@ -0,0 +1,45 @@
+import json
+
+from config import converters
+from file import File
+from benchmark import CORPUS, STUB_MIME, make_corpus, orchestration
+
+
+def read_corpus(corpus):
+    return {mime: [open(path, 'rb').read() for path in paths]
+            for mime, paths in corpus.items()}
+
+
+def test_make_corpus_is_reproducible(tmp_path):
+    mimes = list(CORPUS)
+    corpus = make_corpus(str(tmp_path / 'a'), mimes, 2, seed=1)
+    assert sorted(corpus) == sorted(mimes)
+    # Files of one type don't depend on the other types generated
+    same = make_corpus(str(tmp_path / 'b'), ['message/rfc822',
+                                             'application/zip'], 2, seed=1)
+    other = make_corpus(str(tmp_path / 'c'), ['application/zip'], 2, seed=2)
+
+    files = read_corpus(corpus)
+    assert read_corpus(same) == {mime: files[mime] for mime in same}
+    assert read_corpus(other)['application/zip'] != files['application/zip']
+
+
+def test_orchestration(tmp_path, scratch, monkeypatch):
+    # Converters and identification are swapped for stubs
+    monkeypatch.setattr(File, 'set_metadata', File.set_metadata)
+    saved = dict(converters)
+    monkeypatch.chdir(tmp_path)
+    output = tmp_path / 'result.json'
+    try:
+        orchestration(str(tmp_path), files=50, mysql=None, stub='command',
+                      jobs=2, output=str(output), keep=False)
+    finally:
+        converters.clear()
+        converters.update(saved)
+
+    [result] = json.loads(output.read_text())['results']
+    assert (result['rows'], result['converted']) == (50, 50)
+    assert result['stub'] == 'command'
+    assert 'convert' in result['stages_us_per_file']
+    assert not (tmp_path / 'pwconvert-benchmark').exists()
+    assert STUB_MIME not in converters
@@ -0,0 +1,39 @@
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('ezdxf')
+
+from bin.dwg2dxf import convert_dir  # noqa: E402
+
+FAKE_CONVERTER = '''#!/bin/sh
+echo "$@" >> "$2/calls"
+for path in "$1"/*.dwg; do
+    name=$(basename "$path" .dwg)
+    [ "$name" = bad ] || echo dxf > "$2/$name.dxf"
+done
+'''
+
+
+def test_convert_dir(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    converter = bin_dir / 'ODAFileConverter'
+    converter.write_text(FAKE_CONVERTER)
+    converter.chmod(converter.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setattr('shutil.which', lambda cmd: None)
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    src.mkdir()
+    dest.mkdir()
+    for name in ('a.dwg', 'b.dwg', 'bad.dwg', 'c.txt'):
+        (src / name).write_text('dwg')
+
+    assert convert_dir(str(src), str(dest)) == 1
+    # One call for the whole folder
+    assert ((dest / 'calls').read_text() ==
+            f'{src} {dest} ACAD2018 DXF 0 1 *.DWG\n')
+    assert sorted(path.name for path in dest.glob('*.dxf')) == ['a.dxf',
+                                                               'b.dxf']
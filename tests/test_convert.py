@@ -0,0 +1,61 @@
+import os
+
+import petl as etl
+import pytest
+
+from config import cfg
+import convert as pwconvert
+from convert import check_files, convert
+from storage import Storage
+
+
+def read_report(path):
+    with open(path) as f:
+        return f.read().splitlines()[1:]
+
+
+def test_check_files(tmp_path, store):
+    source = tmp_path / 'source'
+    (source / 'sub').mkdir(parents=True)
+    (source / 'a.txt').write_text('a')
+    (source / 'sub' / 'b.txt').write_text('b')
+    report = str(tmp_path / 'report.tsv')
+
+    assert check_files(str(source), store, report, 'add') == 'added'
+    paths = [row['path'] for row in etl.dicts(store.get_rows([], []))]
+    assert sorted(paths) == ['a.txt', 'sub/b.txt']
+    assert check_files(str(source), store, report, 'continue') is None
+
+    (source / 'a.txt').write_text('changed')
+    os.utime(source / 'a.txt', (0, 0))
+    (source / 'sub' / 'b.txt').unlink()
+    (source / 'c.txt').write_text('c')
+
+    assert check_files(str(source), store, report, 'cancel') == 'cancelled'
+    assert read_report(report) == ['added\tc.txt', 'missing\tsub/b.txt',
+                                   'changed\ta.txt']
+
+    assert check_files(str(source), store, report, 'delete') == 'deleted'
+    assert not (source / 'c.txt').exists()
+    assert (source / 'a.txt').exists()
+
+
+def test_convert_with_filecheck_action(tmp_path, scratch, monkeypatch):
+    monkeypatch.setitem(cfg, 'use_siegfried', False)
+    monkeypatch.setattr('builtins.input', pytest.fail)
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    source.mkdir()
+    (source / 'a.txt').write_text('a')
+    convert(str(source), str(dest), yes=True)
+
+    # Files added by the check are counted and converted
+    (source / 'b.txt').write_text('b')
+    convert(str(source), str(dest), filecheck=True, filecheck_action='add')
+
+    with Storage(str(tmp_path / 'dest.db')) as store:
+        rows = {row['path']: row['status']
+                for row in etl.dicts(store.get_rows([], []))}
+    assert sorted(rows) == ['a.txt', 'b.txt']
+    assert 'new' not in rows.values()
+    assert pwconvert.progress.total == 1
@@ -0,0 +1,147 @@
+import pikepdf
+import pytest
+
+from config import cfg, converters, pwconv_path
+from file import File
+from conftest import make_row
+
+CONVERTER = {'engine': 'engine', 'command': ['first', 'second', 'third']}
+
+
+class StatStore:
+    """Store with recorded attempts, failures and seconds per command"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def get_converter_stats(self, format, version):
+        return self.stats
+
+
+@pytest.fixture
+def src_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(cfg['fallback'], 'min-attempts', 10)
+    monkeypatch.setitem(cfg['fallback'], 'min-success-rate', 0.1)
+    monkeypatch.setitem(cfg['fallback'], 'order-by-speed', False)
+    row = make_row('a.doc', id=1, encoding=None, mime='application/msword',
+                   format=None, version=None, puid='fmt/40', kept=False)
+    return File(row, pwconv_path, False, str(tmp_path))
+
+
+def test_get_commands_in_declared_order(src_file):
+    assert src_file.get_commands(CONVERTER) == ['engine', 'first', 'second',
+                                                'third']
+    store = StatStore({'second': (100, 0, 1), 'first': (100, 0, 500)})
+    assert src_file.get_commands(CONVERTER, store) == ['engine', 'first',
+                                                       'second', 'third']
+
+
+def test_get_commands_skips_failing(src_file):
+    store = StatStore({'engine': (20, 19, 10), 'second': (20, 20, 0),
+                       'third': (5, 5, 0)})
+    # Too few attempts of `third` to skip it
+    assert src_file.get_commands(CONVERTER, store) == ['first', 'third']
+
+
+def test_get_commands_by_speed(src_file, monkeypatch):
+    monkeypatch.setitem(cfg['fallback'], 'order-by-speed', True)
+    store = StatStore({'engine': (10, 0, 150), 'first': (10, 5, 50),
+                       'second': (10, 0, 20)})
+    # Commands without enough attempts are tried first
+    assert src_file.get_commands(CONVERTER, store) == ['third', 'second',
+                                                       'first', 'engine']
+
+
+def test_get_commands_all_failing(src_file):
+    store = StatStore({command: (10, 10, 0)
+                       for command in ['engine', 'first', 'second', 'third']})
+    assert src_file.get_commands(CONVERTER, store) == ['engine', 'first',
+                                                       'second', 'third']
+
+
+def test_convert_with_set_source_ext(tmp_path, monkeypatch):
+    monkeypatch.setitem(cfg, 'use_siegfried', False)
+    monkeypatch.setitem(converters, 'text/x-test',
+                        {'ext': 'tst', 'dest-ext': 'out',
+                         'command': 'cp <source> <dest>'})
+    monkeypatch.setitem(converters, 'text/plain', {'accept': True})
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    source.mkdir()
+    (source / 'a.dat').write_text('text')
+    row = make_row('a.dat', id=1, encoding=None, mime='text/x-test',
+                   format=None, version=None, puid=None, kept=False)
+    src_file = File(row, pwconv_path, False, str(tmp_path / 'scratch'))
+
+    # The source is renamed before it's read
+    result = src_file.convert(str(source), str(dest), False, False, True,
+                              False)
+
+    assert src_file.status == 'converted'
+    assert src_file.path == 'a.tst'
+    assert (source / 'a.tst').exists()
+    assert result.path == 'a.out'
+    assert (dest / 'a.out').read_text() == 'text'
+
+
+def test_convert_to_folder_with_orig_ext(tmp_path, monkeypatch):
+    # Email is converted to a folder with message and attachments
+    monkeypatch.setitem(converters, 'message/rfc822',
+                        {'dest-ext': None, 'keep': True,
+                         'command': 'mkdir <dest> && cp <source> <dest>'})
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    source.mkdir()
+    (source / 'a.eml').write_text('text')
+    row = make_row('a.eml', id=1, encoding=None, mime='message/rfc822',
+                   format=None, version=None, puid=None, kept=False)
+    src_file = File(row, pwconv_path, False, str(tmp_path / 'scratch'))
+
+    result = src_file.convert(str(source), str(dest), True, False, False,
+                              False)
+
+    assert result == 'a'
+    assert src_file.status == 'converted'
+    assert src_file.kept
+    assert (dest / 'a.eml').read_text() == 'text'
+    assert (dest / 'a' / 'a.eml').read_text() == 'text'
+
+
+def make_pdf(path, pdfa=None, output_intent=True, **save_args):
+    with pikepdf.new() as pdf:
+        pdf.add_blank_page()
+        if pdfa:
+            with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
+                meta['pdfaid:part'] = pdfa[0]
+                meta['pdfaid:conformance'] = pdfa[1].upper()
+        if output_intent:
+            pdf.Root.OutputIntents = pikepdf.Array([pdf.make_indirect(
+                pikepdf.Dictionary(Type=pikepdf.Name.OutputIntent,
+                                   S=pikepdf.Name.GTS_PDFA1)
+            )])
+        pdf.save(path, **save_args)
+
+    return str(path)
+
+
+@pytest.mark.parametrize('pdfa, output_intent, version', [
+    ('2b', True, '2b'),
+    # Claims PDF/A without the output intent it requires
+    ('2b', False, None),
+    (None, True, None),
+])
+def test_set_pdf_metadata(src_file, tmp_path, pdfa, output_intent, version):
+    path = make_pdf(tmp_path / 'a.pdf', pdfa, output_intent)
+    src_file.mime = 'application/pdf'
+    src_file.set_pdf_metadata(path)
+    assert src_file.version == version
+    assert src_file.mime == 'application/pdf'
+
+
+def test_set_pdf_metadata_encrypted(src_file, tmp_path):
+    path = make_pdf(tmp_path / 'a.pdf', '2b', encryption=pikepdf.Encryption(
+        owner='owner', user='user'
+    ))
+    src_file.set_pdf_metadata(path)
+    assert src_file.mime == 'application/encrypted'
+    assert src_file.version is None
@@ -0,0 +1,81 @@
+import os
+import stat
+
+import pytest
+
+from bin.ghostscript import DONE, FAILED, Ghostscript
+
+# Runs jobs like Ghostscript does, copying source to output file
+FAKE_GS = f'''#!/usr/bin/env python3
+import re, sys, time
+with open(CALLS, 'a') as f:
+    f.write(' '.join(a for a in sys.argv[1:] if 'permit-file-all' in a)
+            + '\\n')
+for line in sys.stdin:
+    dest, source = [bytes.fromhex(s).decode()
+                    for s in re.findall('<([0-9a-f]+)>', line)]
+    if 'hang' in source:
+        time.sleep(30)
+    if 'bad' in source:
+        print('{FAILED}', flush=True)
+        continue
+    open(dest, 'w').write(open(source).read())
+    print('{DONE}', flush=True)
+'''
+
+
+@pytest.fixture
+def ghostscript(tmp_path, monkeypatch):
+    """Ghostscript object running a fake gs, with its log of starts"""
+    calls = tmp_path / 'calls'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    path = bin_dir / 'gs'
+    path.write_text(FAKE_GS.replace('CALLS', repr(str(calls))))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    gs = Ghostscript()
+    yield gs, calls
+    gs.stop()
+
+
+def test_ghostscript_converts_in_one_process(tmp_path, ghostscript):
+    gs, calls = ghostscript
+    src = tmp_path / 'src'
+    dest = tmp_path / 'dest'
+    other = tmp_path / 'other'
+    for folder in (src, dest, src / 'sub', other):
+        folder.mkdir()
+    for path in ('a.pdf', 'b.pdf', 'bad.pdf', 'sub/c.pdf'):
+        (src / path).write_text(path)
+    (other / 'd.pdf').write_text('d')
+
+    for path in ('a.pdf', 'b.pdf'):
+        returncode, out, err = gs.convert(str(src / path), str(dest / path),
+                                          10)
+        assert (returncode, out.strip(), err) == (0, DONE, '')
+        assert (dest / path).read_text() == path
+    assert gs.convert(str(src / 'bad.pdf'), str(dest / 'bad.pdf'), 10)[0] == 1
+    # Subfolders are permitted too
+    assert gs.convert(str(src / 'sub/c.pdf'), str(dest / 'c.pdf'), 10)[0] == 0
+    # Restarted with access to the new folder as well
+    assert gs.convert(str(other / 'd.pdf'), str(dest / 'd.pdf'), 10)[0] == 0
+
+    assert calls.read_text().splitlines() == [
+        f'--permit-file-all={src}/* --permit-file-all={dest}/*',
+        f'--permit-file-all={src}/* --permit-file-all={dest}/* '
+        f'--permit-file-all={other}/*',
+    ]
+
+
+def test_ghostscript_timeout(tmp_path, ghostscript):
+    gs, calls = ghostscript
+    (tmp_path / 'hang.pdf').write_text('hang')
+    (tmp_path / 'a.pdf').write_text('a')
+
+    assert gs.convert(str(tmp_path / 'hang.pdf'), str(tmp_path / 'out.pdf'),
+                      0.5) == (1, 'timeout', None)
+    # Started again for the next file
+    assert gs.convert(str(tmp_path / 'a.pdf'), str(tmp_path / 'out.pdf'),
+                      10)[0] == 0
+    assert len(calls.read_text().splitlines()) == 2
@@ -0,0 +1,46 @@
+import io
+
+import pytest
+
+pytest.importorskip('pi_heif')
+
+from PIL import Image, ImageCms  # noqa: E402
+
+from bin.image2pdf import image2pdf, to_png  # noqa: E402
+
+
+@pytest.fixture
+def icc_profile(tmp_path, monkeypatch):
+    """sRGB profile made by Pillow, in case icc-profiles-free is missing"""
+    path = tmp_path / 'sRGB.icc'
+    path.write_bytes(
+        ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    )
+    monkeypatch.setattr('bin.image2pdf.ICC_PROFILE', str(path))
+
+
+def test_to_png_removes_transparency():
+    image = Image.new('RGBA', (2, 1), (255, 0, 0, 0))
+    image.putpixel((1, 0), (0, 0, 255, 255))
+    with Image.open(io.BytesIO(to_png(image))) as png:
+        assert png.mode == 'RGB'
+        # Transparent pixels are white
+        assert [png.getpixel((x, 0)) for x in range(2)] == [
+            (255, 255, 255), (0, 0, 255)
+        ]
+
+
+def test_to_png_keeps_direct_modes():
+    with Image.open(io.BytesIO(to_png(Image.new('L', (1, 1))))) as png:
+        assert png.mode == 'L'
+
+
+@pytest.mark.parametrize('mode, fmt, method', [('RGB', 'JPEG', 'embed'),
+                                               ('RGBA', 'PNG', 'decode'),
+                                               ('CMYK', 'TIFF', 'decode')])
+def test_image2pdf(tmp_path, icc_profile, mode, fmt, method):
+    path = tmp_path / f'a.{fmt.lower()}'
+    Image.new(mode, (10, 10)).save(path, format=fmt)
+    dest = tmp_path / 'a.pdf'
+    assert image2pdf(str(path), str(dest)) == method
+    assert dest.read_bytes().startswith(b'%PDF')
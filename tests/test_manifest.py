@@ -0,0 +1,42 @@
+import pytest
+import typer
+
+from config import cfg
+from manifest import manifest
+from conftest import make_row
+
+
+def test_manifest(tmp_path, store):
+    dest = tmp_path / 'dest'
+    (dest / 'a').mkdir(parents=True)
+    (dest / 'a' / 'b.txt').write_text('b')
+    (dest / 'c.pdf').write_text('c')
+    # Rows added together need the same fields
+    store.add_rows([
+        make_row('a.doc', checksum='orig-a', kept=False),
+        make_row('c.pdf', checksum='orig-c', kept=True),
+        # Attachment converted to a file with the same path
+        make_row('a/b.txt', checksum='old-b', kept=False, source_id=1),
+        make_row('a/b.txt', checksum='new-b', kept=False, source_id=1),
+        # Converted further, so not in dest
+        make_row('a/d.eml', checksum='d', kept=False, source_id=1),
+        make_row('a/e.txt', checksum=None, kept=False, source_id=1),
+    ])
+    db = store.path
+    output = tmp_path / 'manifest.txt'
+
+    manifest(str(dest), db, output=str(output))
+    assert output.read_text().splitlines() == ['new-b  a/b.txt',
+                                               'orig-c  c.pdf']
+
+    manifest(str(dest), db, originals=True, output=str(output))
+    assert output.read_text().splitlines() == ['orig-a  a.doc',
+                                               'orig-c  c.pdf']
+
+
+def test_manifest_without_checksum(tmp_path, monkeypatch):
+    monkeypatch.setitem(cfg, 'checksum', None)
+    dest = tmp_path / 'dest'
+    with pytest.raises(typer.Exit):
+        manifest(str(dest))
+    assert not list(tmp_path.iterdir())
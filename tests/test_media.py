@@ -0,0 +1,34 @@
+from bin.media import get_ffmpeg_cmd
+
+
+def test_get_ffmpeg_cmd_remux():
+    streams = [{'codec_type': 'video', 'codec_name': 'h264',
+                'field_order': 'progressive'},
+               {'codec_type': 'audio', 'codec_name': 'aac'},
+               # Cover art
+               {'codec_type': 'video', 'codec_name': 'mjpeg',
+                'disposition': {'attached_pic': 1}}]
+    cmd, transcoded = get_ffmpeg_cmd('a.mov', 'a.mp4', streams)
+    assert transcoded == []
+    assert cmd[cmd.index('-map'):] == [
+        '-map', '0:V', '-c:v', 'copy', '-map', '0:a', '-c:a', 'copy',
+        '-movflags', '+faststart', 'a.mp4'
+    ]
+
+
+def test_get_ffmpeg_cmd_transcode():
+    streams = [{'codec_type': 'video', 'codec_name': 'mpeg2video',
+                'field_order': 'tt'},
+               {'codec_type': 'audio', 'codec_name': 'aac'}]
+    cmd, transcoded = get_ffmpeg_cmd('a.mpg', 'a.mp4', streams)
+    assert transcoded == ['video']
+    assert cmd[cmd.index('-c:v') + 1] == 'libx264'
+    assert cmd[cmd.index('-vf') + 1] == 'yadif'
+    assert cmd[cmd.index('-c:a') + 1] == 'copy'
+
+    # Only audio is kept in mp3
+    cmd, transcoded = get_ffmpeg_cmd('a.mpg', 'a.mp3', streams)
+    assert transcoded == ['audio']
+    assert cmd[cmd.index('-map'):] == [
+        '-map', '0:a', '-c:a', 'libmp3lame', '-b:a', '192k', 'a.mp3'
+    ]
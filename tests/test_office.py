@@ -0,0 +1,77 @@
+import os
+import stat
+
+import pytest
+
+from bin import office2pdf
+
+# Saves files in order, and stops at a file named bad
+FAKE_BUILDER = '''#!/usr/bin/env python3
+import json, sys
+lines = open(sys.argv[1]).read().splitlines()
+with open(CALLS, 'a') as f:
+    f.write(str(len(lines) // 3) + '\\n')
+for i in range(0, len(lines), 3):
+    source = json.loads(lines[i][len('builder.OpenFile('):-len(', "")')])
+    target = json.loads(lines[i + 1][len('builder.SaveFile("pdf", '):-1])
+    if 'bad' in source:
+        sys.exit(1)
+    open(target, 'w').write(open(source).read())
+'''
+
+
+@pytest.fixture
+def builder(tmp_path, scratch, monkeypatch):
+    """Fake documentbuilder, returning path of its log of batch sizes"""
+    calls = tmp_path / 'calls'
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    path = bin_dir / 'documentbuilder'
+    path.write_text(FAKE_BUILDER.replace('CALLS', repr(str(calls))))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bin_dir}:{os.environ['PATH']}")
+    for name, value in (('_cache', {}), ('_cache_dir', None),
+                        ('_failed', set()), ('_queued', {})):
+        monkeypatch.setattr(office2pdf, name, value)
+    return calls
+
+
+def make_files(folder, *names):
+    folder.mkdir(exist_ok=True)
+    for name in names:
+        (folder / name).write_text(name)
+    return [str(folder / name) for name in names]
+
+
+def test_convert_queued_files_in_one_session(tmp_path, builder):
+    a, b, c = make_files(tmp_path / 'src', 'a.docx', 'b.docx', 'c.docx')
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    office2pdf.queue(b, str(dest / 'b.pdf'))
+    office2pdf.queue(c, str(dest / 'c.pdf'))
+
+    for path in (a, b, c):
+        name = os.path.basename(path)
+        assert office2pdf.convert(path, str(dest / f'{name}.pdf'), 10) == \
+            (0, '', '')
+        assert (dest / f'{name}.pdf').read_text() == name
+    assert builder.read_text() == '3\n'
+
+
+def test_convert_retries_file_alone(tmp_path, builder):
+    a, bad, c = make_files(tmp_path / 'src', 'a.docx', 'bad.docx', 'c.docx')
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    office2pdf.queue(bad, str(dest / 'bad.pdf'))
+    office2pdf.queue(c, str(dest / 'c.pdf'))
+
+    # The session is stopped by bad.docx, so c.docx isn't converted
+    assert office2pdf.convert(a, str(dest / 'a.pdf'), 10)[0] == 0
+    assert office2pdf.convert(bad, str(dest / 'bad.pdf'), 10)[0] == 1
+    assert office2pdf.convert(c, str(dest / 'c.pdf'), 10)[0] == 0
+    # Files that failed alone are left out of later sessions
+    [d] = make_files(tmp_path / 'src', 'd.docx')
+    office2pdf.queue(bad, str(dest / 'bad.pdf'))
+    assert office2pdf.convert(d, str(dest / 'd.pdf'), 10)[0] == 0
+
+    assert builder.read_text().split() == ['3', '1', '1', '1']
@@ -0,0 +1,115 @@
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from pipeline import Job, Pipeline
+
+
+class FakeFile:
+    """File identified as the text it contains"""
+
+    def set_metadata(self, path, folder):
+        with open(path) as f:
+            self.mime = f.read()
+
+
+@pytest.fixture
+def engines(monkeypatch):
+    """Engines counting how many of their conversions run at once"""
+    modules = {}
+    for name, serial in (('parallel_engine', False),
+                         ('serial_engine', True)):
+        module = types.ModuleType(name)
+        module.SERIAL = serial
+        module.running = 0
+        module.max_running = 0
+        module.lock = threading.Lock()
+
+        def convert(source_path, dest_path, timeout, module=module):
+            with module.lock:
+                module.running += 1
+                module.max_running = max(module.max_running, module.running)
+            time.sleep(0.2)
+            with module.lock:
+                module.running -= 1
+            return 0, source_path, ''
+
+        module.convert = convert
+        monkeypatch.setitem(sys.modules, name, module)
+        modules[name] = module
+
+    return modules
+
+
+def run_jobs(pipeline, jobs):
+    for job in jobs:
+        pipeline.submit(job)
+    done = []
+    while len(done) < len(jobs):
+        done += pipeline.get_done(wait=True)
+    pipeline.close()
+
+    return done
+
+
+def convert_steps(path):
+    file = FakeFile()
+    yield ('identify', file, path, None)
+    usage = {}
+    returncode, out, err = yield ('command', 'echo $((1 + 1))', None, 10,
+                                  usage)
+    engine_usage = {}
+    engine_result = yield ('engine', 'parallel_engine', out.strip(), None,
+                           10, engine_usage)
+    yield ('verify', file, path, None)
+
+    return (file.mime, engine_result, 'wall_time' in usage,
+            engine_usage['wall_time'] >= 0.2)
+
+
+def test_pipeline_runs_steps_in_stages(tmp_path, engines):
+    path = tmp_path / 'a.txt'
+    path.write_text('text/plain')
+    job = Job({'id': 1}, None, convert_steps(str(path)))
+
+    done = run_jobs(Pipeline(2, 1, 1), [job])
+
+    assert done == [job]
+    assert job.error is None
+    assert job.result == ('text/plain', (0, '2', ''), True, True)
+
+
+def test_pipeline_fails_job_on_error(tmp_path, engines):
+    def failing_steps():
+        yield ('identify', FakeFile(), str(tmp_path / 'missing'), None)
+        raise AssertionError('not reached')
+
+    def raising_steps():
+        yield ('command', 'true', None, 10, {})
+        raise ValueError('conversion failed')
+
+    jobs = [Job({'id': 1}, None, failing_steps()),
+            Job({'id': 2}, None, raising_steps())]
+
+    run_jobs(Pipeline(2, 1, 1), jobs)
+
+    assert isinstance(jobs[0].error, FileNotFoundError)
+    assert isinstance(jobs[1].error, ValueError)
+    assert jobs[0].result is None and jobs[1].result is None
+
+
+@pytest.mark.parametrize('engine, max_running', [('parallel_engine', 2),
+                                                 ('serial_engine', 1)])
+def test_pipeline_runs_engines_at_same_time(engines, engine, max_running):
+    def steps():
+        return (yield ('engine', engine, 'a', None, 10, {}))
+
+    jobs = [Job({'id': i}, None, steps()) for i in range(2)]
+
+    run_jobs(Pipeline(2, 1, 1), jobs)
+
+    assert [job.result for job in jobs] == [(0, 'a', '')] * 2
+    assert engines[engine].max_running == max_running
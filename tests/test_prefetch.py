@@ -0,0 +1,65 @@
+import time
+
+import petl as etl
+
+from config import cfg
+from convert import prefetch_rows
+from util import Prefetcher
+from conftest import make_row
+
+CONDS = ['source_id is null']
+
+
+def wait_for_copies(prefetcher, count):
+    for i in range(100):
+        if len([path for path in prefetcher._files.values() if path]) >= count:
+            return
+        time.sleep(0.01)
+
+
+def test_prefetcher(tmp_path, scratch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        (source / name).write_text(name)
+    prefetcher = Prefetcher(str(source), 10)
+    try:
+        prefetcher.update(['a.txt', 'b.txt', 'c.txt'])
+        # Only as many files as fit in max_bytes
+        wait_for_copies(prefetcher, 1)
+        local_path = prefetcher.get('a.txt')
+        assert open(local_path).read() == 'a.txt'
+
+        # Copies in use are kept when the files to prefetch change
+        prefetcher.update(['c.txt'])
+        assert open(local_path).read() == 'a.txt'
+        assert prefetcher.get('b.txt') is None
+        prefetcher.release('a.txt')
+        wait_for_copies(prefetcher, 1)
+        assert open(prefetcher.get('c.txt')).read() == 'c.txt'
+    finally:
+        prefetcher.close()
+    assert not (scratch.exists() and list(scratch.rglob('*.txt')))
+
+
+def test_prefetch_rows_leaves_out_leased_rows(tmp_path, scratch, store,
+                                              monkeypatch):
+    monkeypatch.setitem(cfg['prefetch'], 'max-files', 10)
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ['a.txt', 'b.txt']:
+        (source / name).write_text(name)
+    store.add_rows([make_row('a.txt'), make_row('b.txt')])
+    prefetcher = Prefetcher(str(source), 100)
+    try:
+        prefetch_rows(prefetcher, store, CONDS, [])
+        wait_for_copies(prefetcher, 2)
+        row = list(etl.dicts(store.lease_rows(CONDS, [], 'worker',
+                                              order='id')))[0]
+        # The copy of the leased file is taken before the next are set
+        local_path = prefetcher.get(row['path'])
+        prefetch_rows(prefetcher, store, CONDS, [])
+        assert open(local_path).read() == 'a.txt'
+        assert list(prefetcher._files) == ['a.txt', 'b.txt']
+    finally:
+        prefetcher.close()
@@ -0,0 +1,47 @@
+import multiprocessing
+
+from util import Progress
+from util.progress import PATH_SIZE
+
+
+def convert_files(counter, n):
+    counter.add(n)
+    for i in range(n):
+        counter.start(f'{i}.txt')
+        counter.finish()
+
+
+def test_progress_counts_in_other_processes():
+    progress = Progress(2)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=convert_files, args=(progress.counter(i), n))
+             for i, n in enumerate([3, 5])]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    assert (progress.finished, progress.total) == (8, 8)
+    assert progress.path.endswith('.txt')
+
+    progress.reset()
+    assert (progress.finished, progress.total) == (0, 0)
+
+
+def test_progress_path_is_cut():
+    progress = Progress(1)
+    progress.counter(0).start('a' * 1000)
+    assert progress.path == 'a' * (PATH_SIZE - 1)
+
+
+def test_progress_show(capsys):
+    progress = Progress(1)
+    counter = progress.counter(0)
+    counter.add(4)
+    with progress.show(log_interval=0.05):
+        counter.start('a.txt')
+        counter.finish()
+    # Stdout isn't a terminal, so lines are printed
+    line = capsys.readouterr().out.splitlines()[-1]
+    assert line.startswith('25% | 1/4 | ')
+    assert line.endswith('| a.txt')
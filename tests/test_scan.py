@@ -0,0 +1,52 @@
+import os
+
+import petl as etl
+
+from config import cfg
+from convert import add_files_to_storage
+from util import scan_tree
+
+
+def make_tree(root):
+    for path in ('a.txt', 'b/c.txt', 'b/d/e.txt', 'b/.f.txt', '.hidden.txt',
+                 '.git/config'):
+        path = root / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(path.name)
+    (root / 'empty').mkdir()
+    (root / 'link.txt').symlink_to(root / 'a.txt')
+
+
+def test_scan_tree(tmp_path):
+    make_tree(tmp_path)
+    scanned = list(scan_tree(str(tmp_path), threads=2))
+
+    # One list for each folder with files
+    assert len(scanned) == 3
+    files = {path: (size, mtime, inode)
+             for files in scanned for path, size, mtime, inode in files}
+    # Hidden files directly in root are skipped, and symlinks
+    assert sorted(files) == ['a.txt', 'b/.f.txt', 'b/c.txt', 'b/d/e.txt']
+    stat = os.stat(tmp_path / 'b' / 'd' / 'e.txt')
+    assert files['b/d/e.txt'] == (5, stat.st_mtime, stat.st_ino)
+
+
+def test_scan_tree_missing_folder(tmp_path):
+    assert list(scan_tree(str(tmp_path / 'missing'))) == []
+
+
+def test_add_files_to_storage(tmp_path, store, monkeypatch):
+    monkeypatch.setitem(cfg['scan'], 'batch-size', 1)
+    source = tmp_path / 'source'
+    make_tree(source)
+
+    assert add_files_to_storage(str(source), store) == 4
+    # Files already in the database are skipped
+    (source / 'g.txt').write_text('g')
+    assert add_files_to_storage(str(source), store) == 1
+
+    rows = list(etl.dicts(store.get_rows([], [])))
+    assert sorted(row['path'] for row in rows) == [
+        'a.txt', 'b/.f.txt', 'b/c.txt', 'b/d/e.txt', 'g.txt'
+    ]
+    assert all(row['status'] == 'new' and row['inode'] for row in rows)
@@ -0,0 +1,59 @@
+import petl as etl
+
+from config import cfg
+from conftest import make_row
+
+CONDS = ['source_id is null']
+
+
+def lease(store, owner, limit=1):
+    rows = etl.dicts(store.lease_rows(CONDS, [], owner, limit, order='id'))
+    return [row['path'] for row in rows]
+
+
+def get_status(store):
+    rows = etl.dicts(store.get_rows([], [], order='id'))
+    return {row['path']: (row['status'], row['lease_owner']) for row in rows}
+
+
+def test_lease_rows_skips_leased_rows(store):
+    store.add_rows([make_row('a.txt'), make_row('b.txt'), make_row('c.txt')])
+
+    assert lease(store, 'worker-1') == ['a.txt']
+    assert lease(store, 'worker-2', limit=5) == ['b.txt', 'c.txt']
+    assert lease(store, 'worker-3') == []
+    assert get_status(store)['b.txt'] == ('in_progress', 'worker-2')
+    assert store.count_unleased(CONDS, []) == 0
+
+
+def test_lease_rows_returns_status_before_lease(store):
+    store.add_rows([make_row('a.txt', status='interrupted')])
+    rows = list(etl.dicts(store.lease_rows(CONDS, [], 'worker-1')))
+    assert rows[0]['status'] == 'interrupted'
+
+
+def test_recover_rows_of_stale_owner(store):
+    store.add_rows([make_row('a.txt'), make_row('b.txt')])
+    lease(store, 'gone')
+    lease(store, 'alive')
+
+    count = store.recover_rows(lambda owner: owner == 'gone')
+
+    assert count == 1
+    assert get_status(store) == {'a.txt': ('interrupted', None),
+                                 'b.txt': ('in_progress', 'alive')}
+    assert store.count_unleased(CONDS, []) == 1
+    assert lease(store, 'worker') == ['a.txt']
+
+
+def test_recover_rows_with_expired_lease(store, monkeypatch):
+    store.add_rows([make_row('a.txt'), make_row('b.txt')])
+    monkeypatch.setitem(cfg['lease'], 'seconds', -1)
+    lease(store, 'expired')
+    monkeypatch.setitem(cfg['lease'], 'seconds', 600)
+    lease(store, 'renewed')
+    store.renew_leases('renewed')
+
+    assert store.recover_rows(lambda owner: False) == 1
+    assert get_status(store)['a.txt'] == ('interrupted', None)
+    assert get_status(store)['b.txt'] == ('in_progress', 'renewed')
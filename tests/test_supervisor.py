@@ -0,0 +1,51 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from config import cfg
+from util import Supervisor
+
+
+def run(*commands, jobs=2, **kwargs):
+    async def main():
+        supervisor = Supervisor(jobs)
+        return await asyncio.gather(*(
+            supervisor.run(cmd, shell=True, **kwargs) for cmd in commands
+        ))
+
+    return asyncio.run(main())
+
+
+def test_supervisor_runs_commands_at_same_time():
+    usage = {}
+    t0 = time.time()
+    results = run('sleep 0.5; echo a', 'sleep 0.5; echo b >&2',
+                  'sleep 0.5; exit 3', usage=usage)
+    # Two at a time
+    assert 0.9 < time.time() - t0 < 1.5
+    assert results == [(0, 'a\n', ''), (0, '', 'b\n'), (3, '', '')]
+    assert usage['wall_time'] >= 0.5
+    assert usage['max_rss'] > 0
+
+
+def test_supervisor_kills_process_group_on_timeout(tmp_path, monkeypatch):
+    monkeypatch.setitem(cfg, 'kill-grace', 0)
+    pid_path = tmp_path / 'pid'
+    t0 = time.time()
+    # The command leaves a process behind, which is killed too
+    [result] = run(f'sleep 30 & echo $! > {pid_path}; sleep 30',
+                   timeout=0.5)
+    assert result == (1, 'timeout', None)
+    assert time.time() - t0 < 5
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+
+
+def test_supervisor_kills_processes_left_behind(tmp_path):
+    pid_path = tmp_path / 'pid'
+    [result] = run(f'sleep 30 > /dev/null & echo $! > {pid_path}; echo a')
+    assert result == (0, 'a\n', '')
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
@@ -0,0 +1,72 @@
+import pstats
+import threading
+
+import pytest
+
+from util import Tracer, Profiler
+
+
+def busy():
+    return sum(range(1000))
+
+
+def test_tracer_merge_and_summary(tmp_path):
+    for part, seconds in enumerate([[0.1, 0.2], [0.3, 3.0]]):
+        tracer = Tracer()
+        tracer.enabled = True
+        for s in seconds:
+            tracer.add('convert', 'text/plain: cmd', s)
+        tracer.add('query', None, 0.001)
+        tracer.dump(str(tmp_path / f'trace-{part}.json'))
+    path = str(tmp_path / 'trace.json')
+
+    Tracer.merge(str(tmp_path / 'trace-*.json'), path)
+    # Parts are removed when merged, so merging again adds nothing
+    stats = Tracer.merge(str(tmp_path / 'trace-*.json'), path)
+
+    convert = stats['convert']['text/plain: cmd']
+    assert convert['count'] == 4
+    assert convert['total'] == pytest.approx(3.6)
+    assert convert['max'] == 3.0
+    assert convert['histogram'] == {'0.125': 1, '0.25': 1, '0.5': 1,
+                                    '4.0': 1}
+    assert not list(tmp_path.glob('trace-*.json'))
+    # Stages in order, with 95th percentile as upper bound of bucket
+    summary = Tracer.summary(stats)
+    assert [row[:2] for row in summary] == [('query', 2), ('convert', 4)]
+    assert summary[1][3:] == (pytest.approx(0.9), 4.0)
+
+
+def test_tracer_disabled(tmp_path):
+    tracer = Tracer()
+    with tracer.time('query'):
+        pass
+    tracer.dump(str(tmp_path / 'trace.json'))
+    assert not (tmp_path / 'trace.json').exists()
+
+
+def profile_threads(profiler, tmp_path):
+    profiler.enabled = True
+    thread = threading.Thread(target=profiler.wrap(busy))
+    with profiler.profile():
+        thread.start()
+        thread.join()
+    path = str(tmp_path / 'profile.prof')
+    profiler.dump(str(tmp_path / 'profile-0.prof'))
+    Profiler.merge(str(tmp_path / 'profile-*.prof'), path)
+
+    return pstats.Stats(path)
+
+
+def test_profiler_all_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(Profiler, 'one_thread', False)
+    stats = profile_threads(Profiler(), tmp_path)
+    assert any(func[2] == 'busy' for func in stats.stats)
+
+
+def test_profiler_one_thread(tmp_path, monkeypatch, recwarn):
+    monkeypatch.setattr(Profiler, 'one_thread', True)
+    stats = profile_threads(Profiler(), tmp_path)
+    # The thread started while this one is profiled isn't
+    assert not any(func[2] == 'busy' for func in stats.stats)
+    assert len(recwarn) == 1
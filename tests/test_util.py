@@ -0,0 +1,151 @@
+import errno
+import fcntl
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+
+from config import cfg
+from util import (count_children, place_file, run_shell_cmd,
+                  get_scratch_dir, remove_scratch_dir, clean_scratch_dirs,
+                  has_scratch_space)
+
+BUSY = 'python3 -c "import time; t = time.time()\nwhile time.time() - t < 0.5: pass"'
+
+
+def test_run_shell_cmd_usage():
+    usage = {}
+    returncode, out, err = run_shell_cmd(BUSY + '; echo out; echo err >&2',
+                                         shell=True, usage=usage)
+    assert (returncode, out, err) == (0, 'out\n', 'err\n')
+    assert 0.4 < usage['cpu_time'] <= usage['wall_time'] + 0.1
+    assert usage['max_rss'] > 0
+
+
+def test_run_shell_cmd_usage_of_own_process():
+    # Processes reaped by other threads at the same time aren't counted
+    thread = threading.Thread(target=run_shell_cmd, args=(BUSY,),
+                              kwargs={'shell': True})
+    thread.start()
+    usage = {}
+    run_shell_cmd('sleep 0.7', shell=True, usage=usage)
+    thread.join()
+    assert usage['cpu_time'] < 0.2
+
+
+def test_run_shell_cmd_timeout(tmp_path):
+    pid_path = tmp_path / 'pid'
+    usage = {}
+    t0 = time.time()
+    # The command leaves a process behind, which is killed too
+    returncode, out, err = run_shell_cmd(
+        f'sleep 30 & echo $! > {pid_path}; sleep 30', shell=True,
+        timeout=0.5, usage=usage
+    )
+    assert (returncode, out) == (1, 'timeout')
+    assert time.time() - t0 < 5
+    assert 'cpu_time' not in usage
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+
+
+def test_count_children():
+    with count_children({}) as children:
+        run_shell_cmd(BUSY, shell=True)
+        run_shell_cmd('true', shell=True)
+    assert children['cpu_time'] > 0.4
+    assert children['max_rss'] > 0
+
+
+def raise_oserror(code):
+    def raise_error(*args):
+        raise OSError(code, os.strerror(code))
+
+    return raise_error
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / 'src.txt'
+    path.write_bytes(os.urandom(10_000))
+    return path
+
+
+def test_place_file_falls_back_to_copy(tmp_path, src, monkeypatch):
+    monkeypatch.setattr(fcntl, 'ioctl', raise_oserror(errno.EOPNOTSUPP))
+    dest = tmp_path / 'dest.txt'
+    dest.write_text('old')
+    assert place_file(str(src), str(dest), 'auto') == 'copy'
+    assert dest.read_bytes() == src.read_bytes()
+
+    monkeypatch.setattr(os, 'copy_file_range', raise_oserror(errno.ENOSYS))
+    assert place_file(str(src), str(dest), 'reflink') == 'copy'
+    assert dest.read_bytes() == src.read_bytes()
+
+
+def test_place_file_checks_bytes_copied(tmp_path, src, monkeypatch):
+    # Like FUSE, which can return 0 before the end of the file
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0)
+    dest = tmp_path / 'dest.txt'
+    assert place_file(str(src), str(dest), 'copy') == 'copy'
+    assert dest.read_bytes() == src.read_bytes()
+
+
+def test_place_file_hardlink(tmp_path, src, monkeypatch):
+    dest = tmp_path / 'dest.txt'
+    assert place_file(str(src), str(dest), 'hardlink') == 'hardlink'
+    assert os.path.samefile(src, dest)
+    with pytest.raises(shutil.SameFileError):
+        place_file(str(src), str(src), 'hardlink')
+    assert src.exists()
+
+    # Across volumes the prefetched copy is read instead
+    monkeypatch.setattr(os, 'link', raise_oserror(errno.EXDEV))
+    prefetched = tmp_path / 'prefetched.txt'
+    prefetched.write_text('prefetched')
+    dest = tmp_path / 'other.txt'
+    assert place_file(str(src), str(dest), 'hardlink',
+                      copy_from=str(prefetched)) == 'copy'
+    assert dest.read_text() == 'prefetched'
+
+
+def test_scratch_dir(scratch):
+    path = get_scratch_dir()
+    assert os.path.dirname(path) == str(scratch)
+    assert os.environ['TMPDIR'] == path
+    # Kept until removed
+    assert get_scratch_dir() == path
+
+    # Converters write their temp files there
+    run_shell_cmd('touch "$TMPDIR/a.tmp"', shell=True)
+    assert os.listdir(path) == ['a.tmp']
+
+    remove_scratch_dir()
+    assert not os.path.exists(path)
+    assert os.environ.get('TMPDIR') != path
+
+
+def test_clean_scratch_dirs(scratch):
+    own = get_scratch_dir()
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    gone = scratch / f'pwconvert-{proc.pid}-abc'
+    gone.mkdir()
+    other = scratch / 'other'
+    other.mkdir()
+
+    clean_scratch_dirs()
+    assert not gone.exists()
+    assert os.path.isdir(own) and other.exists()
+
+
+def test_has_scratch_space(scratch, monkeypatch):
+    monkeypatch.setitem(cfg['scratch'], 'max-file-size', 1000)
+    monkeypatch.setitem(cfg['scratch'], 'min-free', 0)
+    assert has_scratch_space(1000)
+    assert not has_scratch_space(1001)
+    monkeypatch.setitem(cfg['scratch'], 'min-free', 1 << 60)
+    assert not has_scratch_space(1)
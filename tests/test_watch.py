@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+import petl as etl
+import pytest
+
+from config import cfg
+from convert import sync_source
+from util import Watcher
+
+
+def get_rows(store):
+    return {row['path']: row for row in etl.dicts(store.get_rows([], []))}
+
+
+def test_sync_source(tmp_path, store, monkeypatch):
+    monkeypatch.setitem(cfg['watch'], 'settle', 5)
+    source = tmp_path / 'source'
+    dest = tmp_path / 'dest'
+    (source / 'sub').mkdir(parents=True)
+    (dest / 'a').mkdir(parents=True)
+    for path in ('a.txt', 'b.txt', 'sub/c.txt'):
+        (source / path).write_text(path)
+        os.utime(source / path, (0, 0))
+
+    assert sync_source(str(source), str(dest), store) == 3
+    rows = get_rows(store)
+    store.update_rows([{'id': rows[path]['id'], 'status': 'converted'}
+                       for path in rows])
+    # File converted from a.txt
+    (dest / 'a' / 'a.pdf').write_text('pdf')
+    store.add_rows([{'path': 'a/a.pdf', 'size': 3, 'status': 'converted',
+                     'source_id': rows['a.txt']['id'], 'depth': 1}])
+
+    (source / 'a.txt').write_text('changed')
+    os.utime(source / 'a.txt', (0, 0))
+    (source / 'sub' / 'c.txt').unlink()
+    (source / 'd.txt').write_text('d')
+    # Still being written to
+    (source / 'e.txt').write_text('e')
+    os.utime(source / 'd.txt', (0, 0))
+
+    assert sync_source(str(source), str(dest), store) == 2
+    rows = get_rows(store)
+    assert sorted(rows) == ['a.txt', 'b.txt', 'd.txt', 'sub/c.txt']
+    assert rows['a.txt']['status'] == 'new'
+    assert rows['b.txt']['status'] == 'converted'
+    assert rows['sub/c.txt']['status'] == 'deleted'
+    assert not (dest / 'a' / 'a.pdf').exists()
+
+    # Only the given folders are looked at
+    (source / 'b.txt').unlink()
+    assert sync_source(str(source), str(dest), store, {'sub'}) == 0
+    assert get_rows(store)['b.txt']['status'] == 'converted'
+
+
+def test_watcher_polling(tmp_path):
+    with Watcher(str(tmp_path), 0.2, 0, inotify=False) as watcher:
+        assert watcher.polling
+        t0 = time.time()
+        assert watcher.wait() is None
+        assert time.time() - t0 >= 0.2
+
+
+def test_watcher_inotify(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    with Watcher(str(tmp_path), 60, 0.2) as watcher:
+        if watcher.polling:
+            pytest.skip('inotify not available')
+
+        def write_files():
+            time.sleep(0.1)
+            (tmp_path / 'sub' / 'a.txt').write_text('a')
+            (tmp_path / 'new' / 'deep').mkdir(parents=True)
+
+        thread = threading.Thread(target=write_files)
+        thread.start()
+        changed = watcher.wait()
+        thread.join()
+
+        assert {'sub', 'new'} <= changed
+        # Folders made since are watched too
+        (tmp_path / 'new' / 'deep' / 'b.txt').write_text('b')
+        assert 'new/deep' in watcher.wait()
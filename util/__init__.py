@@ -1,2 +1,8 @@
 from .util import *
 from .result import Result
+from .supervisor import Supervisor
+from .prefetch import Prefetcher
+from .progress import Progress, Counter, clear_line
+from .scan import scan_tree
+from .watch import Watcher, scan_files
+from .trace import tracer, profiler, Tracer, Profiler
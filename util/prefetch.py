@@ -0,0 +1,159 @@
+from __future__ import annotations
+import os
+import shutil
+import threading
+from collections import deque
+
+from .util import get_scratch_dir
+
+
+class Prefetcher:
+    """
+    Copies upcoming source files to the scratch directory in a
+    background thread, so that converters read them from local disk
+
+    The copies take at most `max_bytes` together. A copy is removed
+    with `release` when the file is converted, which makes room for
+    the next files.
+    """
+
+    def __init__(self, source_dir: str, max_bytes: int):
+        self._source_dir = source_dir
+        self._max_bytes = max_bytes
+        self._dir = os.path.join(get_scratch_dir(), 'prefetch')
+        self._queue = deque()
+        # Local path of each prefetched file, None until it's copied
+        self._files = {}
+        # Files handed out by `get` and not released yet
+        self._used = set()
+        self._sizes = {}
+        self._copying = None
+        self._bytes = 0
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, paths: list[str]) -> None:
+        """
+        Set files to prefetch, with paths relative to source
+
+        Copies of files no longer in `paths` are removed, unless
+        they're in use.
+        """
+        with self._cond:
+            upcoming = set(paths)
+            for path in list(self._files):
+                if path not in upcoming and path not in self._used:
+                    self._drop(path)
+            for path in paths:
+                if path not in self._files:
+                    self._files[path] = None
+                    self._queue.append(path)
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        """Number of files prefetched or waiting to be"""
+        with self._cond:
+            return len(self._files) - len(self._used)
+
+    def get(self, path: str) -> str | None:
+        """
+        Get local copy of file, waiting for it if it's being copied
+
+        Returns:
+            path to the copy, or None if the file isn't prefetched
+        """
+        with self._cond:
+            while path == self._copying:
+                self._cond.wait()
+            if self._files.get(path):
+                self._used.add(path)
+                return self._files[path]
+            # Not worth copying when the file is needed now
+            self._drop(path)
+            return None
+
+    def release(self, path: str) -> None:
+        """Remove local copy of file"""
+        with self._cond:
+            self._used.discard(path)
+            self._drop(path)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def _drop(self, path: str) -> None:
+        if path not in self._files:
+            return
+        local_path = self._files.pop(path)
+        if local_path:
+            self._bytes -= self._sizes.pop(path)
+            shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+        elif path in self._queue:
+            self._queue.remove(path)
+        self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                path = self._queue.popleft()
+
+            source_path = os.path.join(self._source_dir, path)
+            try:
+                size = os.path.getsize(source_path)
+            except OSError:
+                size = self._max_bytes + 1
+
+            with self._cond:
+                # Wait until earlier copies are released
+                while (
+                    self._bytes + size > self._max_bytes and
+                    size <= self._max_bytes and path in self._files and
+                    not self._closed
+                ):
+                    self._cond.wait()
+                if path not in self._files:
+                    continue
+                if size > self._max_bytes:
+                    # Mark as not prefetched, so that it isn't queued again
+                    self._files[path] = ''
+                    continue
+                if self._closed:
+                    return
+                self._bytes += size
+                self._count += 1
+                self._copying = path
+
+            # Keep the file name, since converters may look at the extension
+            local_path = os.path.join(self._dir, str(self._count),
+                                      os.path.basename(path))
+            try:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                shutil.copyfile(source_path, local_path)
+            except OSError:
+                shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+                local_path = None
+
+            with self._cond:
+                self._copying = None
+                if local_path and path in self._files:
+                    self._files[path] = local_path
+                    self._sizes[path] = size
+                else:
+                    # Failed, or dropped while it was copied
+                    self._bytes -= size
+                    self._files.pop(path, None)
+                    if local_path:
+                        shutil.rmtree(os.path.dirname(local_path),
+                                      ignore_errors=True)
+                self._cond.notify_all()
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import datetime
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.sharedctypes import RawArray
+
+# Bytes kept of the path of the file last started
+PATH_SIZE = 256
+
+
+class Counter:
+    """Counters of one conversion task, see `Progress`"""
+
+    def __init__(self, progress: Progress, slot: int):
+        self._progress = progress
+        self._slot = slot
+
+    def add(self, n: int) -> None:
+        """Add files to convert, like files unpacked from an archive"""
+        self._progress._added[self._slot] += n
+
+    def start(self, path: str) -> None:
+        self._progress._set_path(path)
+
+    def finish(self) -> None:
+        self._progress._finished[self._slot] += 1
+
+
+class Progress:
+    """
+    Counts files converted by all processes, in shared memory
+
+    Each conversion task gets its own slot of counters with `counter`,
+    which only that task writes to. So the counters need neither locks
+    nor round-trips to a manager process, and are summed when shown.
+    The memory is shared with processes forked after it's created,
+    e.g. by passing it to the initializer of a multiprocessing Pool.
+    """
+
+    def __init__(self, slots: int):
+        self._added = RawArray('q', slots)
+        self._finished = RawArray('q', slots)
+        self._path = RawArray('c', PATH_SIZE)
+
+    def counter(self, slot: int) -> Counter:
+        return Counter(self, slot)
+
+    def reset(self) -> None:
+        """Start counting again. Only when no tasks are running"""
+        for i in range(len(self._added)):
+            self._added[i] = 0
+            self._finished[i] = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self._added)
+
+    @property
+    def finished(self) -> int:
+        return sum(self._finished)
+
+    @property
+    def path(self) -> str:
+        return self._path.value.decode(errors='replace')
+
+    def _set_path(self, path: str) -> None:
+        # May be read while written, which only garbles the display
+        self._path.value = path.encode()[:PATH_SIZE - 1]
+
+    @contextmanager
+    def show(self, interval: float = 0.25, log_interval: float = 10):
+        """
+        Show progress in a thread until the block is left
+
+        The progress line is redrawn every `interval` seconds on a
+        terminal. Else a line is printed every `log_interval` seconds.
+        """
+        tty = sys.stdout.isatty()
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._render,
+            args=(stop, interval if tty else log_interval, tty),
+            daemon=True
+        )
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def _render(self, stop: threading.Event, interval: float, tty: bool):
+        # Finished files over the last seconds, for throughput
+        window = deque([(time.monotonic(), self.finished)],
+                       maxlen=max(2, round(30 / interval)))
+        percent = 0
+        while True:
+            stopped = stop.wait(interval)
+            total = self.total
+            finished = self.finished
+            window.append((time.monotonic(), finished))
+            # Never lower, as files unpacked from archives are added
+            if total:
+                percent = max(percent, int(finished / total * 100))
+
+            seconds = window[-1][0] - window[0][0]
+            rate = (finished - window[0][1]) / seconds if seconds else 0
+            eta = '-'
+            if rate:
+                eta = str(datetime.timedelta(
+                    seconds=round((total - finished) / rate)
+                ))
+            line = (f"{percent}% | {finished}/{total} | {rate:.1f} files/s "
+                    f"| ETA {eta} | {self.path[0:100]}")
+            if tty:
+                print('\r\x1b[2K' + line, end='\n' if stopped else '',
+                      flush=True)
+            else:
+                print(line, flush=True)
+            if stopped:
+                return
+
+
+def clear_line() -> None:
+    """Clear progress line, so that a message can be printed"""
+    if sys.stdout.isatty():
+        print('\r\x1b[2K', end='')
@@ -0,0 +1,63 @@
+from __future__ import annotations
+import os
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def scan_folder(root: str, folder: str) -> tuple[list, list]:
+    """
+    List files and subfolders of folder
+
+    Hidden files and folders directly in `root` are skipped.
+
+    Returns:
+        files with path, size, mtime and inode, and subfolders,
+        with paths relative to `root`
+    """
+    files = []
+    dirs = []
+    try:
+        entries = list(os.scandir(os.path.join(root, folder)))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return files, dirs
+
+    for entry in entries:
+        if not folder and entry.name.startswith('.'):
+            continue
+        path = os.path.join(folder, entry.name)
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((path, stat.st_size, stat.st_mtime,
+                              entry.inode()))
+        except FileNotFoundError:
+            continue
+
+    return files, dirs
+
+
+def scan_tree(root: str, threads: int = 8) -> Iterator[list[tuple]]:
+    """
+    Walk folder tree, reading folders in parallel threads
+
+    On network filesystems each folder read waits on the server, so
+    several are kept in flight. Files are yielded as soon as their
+    folder is read, so that they can be written to the database while
+    the scan goes on.
+
+    Yields:
+        lists of files with path relative to `root`, size, mtime and
+        inode, one list for each folder
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        pending = {executor.submit(scan_folder, root, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for folder in dirs:
+                    pending.add(executor.submit(scan_folder, root, folder))
+                if files:
+                    yield files
@@ -0,0 +1,149 @@
+from __future__ import annotations
+import asyncio
+import os
+import signal
+import subprocess
+import time
+
+from config import cfg
+from .util import set_usage, set_wall_time
+
+
+async def read_pipe(pipe) -> str:
+    """Read pipe until it's closed, without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    try:
+        data = await reader.read()
+    finally:
+        transport.close()
+
+    return data.decode(errors='replace')
+
+
+async def wait_process(proc: subprocess.Popen):
+    """
+    Wait for process to exit, and reap it with `wait4`
+
+    The event loop is woken by a pidfd when the process exits. Where
+    pidfd isn't available, the process is polled.
+
+    Returns:
+        resource usage of the process
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    else:
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            await asyncio.sleep(0.05)
+
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+async def kill_group(pid: int, grace: float = 0) -> bool:
+    """
+    Async version of `kill_process_group`, for a group whose leader
+    is reaped by `wait_process`
+
+    Returns:
+        True if no processes are left in the group
+    """
+    loop = asyncio.get_running_loop()
+    for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, 5)):
+        try:
+            os.killpg(pid, sig)
+        except ProcessLookupError:
+            return True
+        deadline = loop.time() + wait
+        while loop.time() < deadline:
+            await asyncio.sleep(0.1)
+            try:
+                os.killpg(pid, 0)
+            except ProcessLookupError:
+                return True
+
+    return False
+
+
+class Supervisor:
+    """
+    Runs conversion commands as subprocesses from an asyncio event loop
+
+    No thread is blocked while a command runs, so one worker can have
+    many commands running at the same time. This pays off for
+    converters that mostly wait on I/O, like unpacking archives on
+    network storage. At most `jobs` commands run at once.
+    """
+
+    def __init__(self, jobs: int):
+        self._semaphore = asyncio.Semaphore(jobs)
+
+    async def run(self, command, cwd=None, timeout=None,
+                  shell=False, usage=None) -> tuple[int, str, str]:
+        """Run command as subprocess. Same arguments as `run_shell_cmd`"""
+        os.environ["PYTHONUNBUFFERED"] = "1"
+
+        # Make calls from subprocess timeout before main subprocess
+        if not timeout:
+            timeout = cfg['timeout'] - 1
+
+        async with self._semaphore:
+            t0 = time.perf_counter()
+            try:
+                proc = subprocess.Popen(
+                    command,
+                    cwd=cwd,
+                    shell=shell,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=os.environ,
+                    start_new_session=True,
+                )
+            except Exception as e:
+                return 1, '', e
+
+            output = asyncio.gather(read_pipe(proc.stdout),
+                                    read_pipe(proc.stderr))
+            waiter = asyncio.ensure_future(wait_process(proc))
+            done, _ = await asyncio.wait({waiter}, timeout=timeout)
+            timed_out = not done
+
+            # Kill the command on timeout, and else any processes
+            # it left behind
+            if await kill_group(proc.pid, cfg['kill-grace']):
+                set_usage(usage, await waiter)
+            else:
+                print(f"\nCould not kill process group {proc.pid}", flush=True)
+
+            try:
+                out, err = await asyncio.wait_for(output, 1)
+            except asyncio.TimeoutError:
+                # Pipes held open by processes outside the group
+                out, err = '', ''
+
+            set_wall_time(usage, t0)
+
+        if timed_out:
+            return 1, 'timeout', None
+
+        return proc.returncode, out, err
@@ -0,0 +1,227 @@
+from __future__ import annotations
+import cProfile
+import glob
+import json
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+# Stages of the conversion of a file, in the order they're run
+STAGES = ('query', 'identify', 'convert', 'copy', 'verify', 'write')
+
+
+class Tracer:
+    """
+    Times the stages of the conversion of each file
+
+    Durations are collected per stage and key, like the mime type or
+    the converter, as count, total, max and a histogram with buckets
+    that double in size. Each process writes its stats with `dump`,
+    and the parts are added to the joined stats with `merge`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str, key: str = None):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, key, time.perf_counter() - t0)
+
+    def add(self, stage: str, key: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        # Upper bound of bucket, from 1 ms and up
+        exponent = math.frexp(seconds)[1] if seconds > 0 else -10
+        bucket = str(2.0 ** max(-10, exponent))
+        with self._lock:
+            stats = self._stats.setdefault(stage, {}).setdefault(
+                str(key), {'count': 0, 'total': 0, 'max': 0, 'histogram': {}}
+            )
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+    def dump(self, path: str) -> None:
+        """Write stats collected since the last dump"""
+        with self._lock:
+            if not self._stats:
+                return
+            with open(path, 'w') as f:
+                json.dump(self._stats, f)
+            self._stats = {}
+
+    @staticmethod
+    def merge(pattern: str, path: str) -> dict:
+        """Add stats in files matching `pattern` to `path`"""
+        merged = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                merged = json.load(f)
+        for part in glob.glob(pattern):
+            with open(part) as f:
+                for stage, keys in json.load(f).items():
+                    for key, stats in keys.items():
+                        total = merged.setdefault(stage, {}).setdefault(
+                            key, {'count': 0, 'total': 0, 'max': 0,
+                                  'histogram': {}}
+                        )
+                        total['count'] += stats['count']
+                        total['total'] += stats['total']
+                        total['max'] = max(total['max'], stats['max'])
+                        for bucket, count in stats['histogram'].items():
+                            total['histogram'][bucket] = (
+                                total['histogram'].get(bucket, 0) + count
+                            )
+            os.remove(part)
+
+        with open(path, 'w') as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+
+        return merged
+
+    @staticmethod
+    def summary(stats: dict) -> list[tuple]:
+        """
+        Get count, total seconds, mean and 95th percentile (upper bound
+        of its bucket) of each stage, for all keys
+        """
+        rows = []
+        for stage in [stage for stage in STAGES if stage in stats]:
+            count = sum(s['count'] for s in stats[stage].values())
+            total = sum(s['total'] for s in stats[stage].values())
+            histogram = {}
+            for s in stats[stage].values():
+                for bucket, n in s['histogram'].items():
+                    histogram[float(bucket)] = histogram.get(float(bucket),
+                                                             0) + n
+            seen = 0
+            p95 = 0
+            for bucket in sorted(histogram):
+                seen += histogram[bucket]
+                p95 = bucket
+                if seen >= 0.95 * count:
+                    break
+            rows.append((stage, count, total, total / count if count else 0,
+                         p95))
+
+        return rows
+
+
+class Profiler:
+    """
+    Runs threads of the conversion under cProfile when enabled
+
+    The profiles of all threads in a process are joined with `dump`,
+    and the parts of all processes are added to the joined profile
+    with `merge`. From Python 3.12, cProfile can only profile one
+    thread of a process at a time, so other threads run unprofiled
+    while a thread is profiled.
+    """
+
+    # Whether only one thread can be profiled at a time
+    one_thread = sys.version_info >= (3, 12)
+
+    def __init__(self):
+        self.enabled = False
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Thread being profiled, where only one can be
+        self._active = None
+
+    @contextmanager
+    def profile(self):
+        """Profile the current thread in the block"""
+        if not self.enabled:
+            yield
+            return
+        if self.one_thread:
+            with self._lock:
+                active = self._active
+                if active is None:
+                    self._active = threading.get_ident()
+            if active is not None:
+                if active != threading.get_ident():
+                    warnings.warn('Python 3.12 and later can only profile '
+                                  'one thread at a time. Other threads are '
+                                  'not profiled', stacklevel=3)
+                yield
+                return
+            try:
+                with self._profile():
+                    yield
+            finally:
+                self._active = None
+        else:
+            with self._profile():
+                yield
+
+    @contextmanager
+    def _profile(self):
+        # Each thread adds to its own profile
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def wrap(self, func):
+        """Get function that profiles `func`, e.g. as target of a thread"""
+        if not self.enabled:
+            return func
+
+        def run(*args, **kwargs):
+            with self.profile():
+                return func(*args, **kwargs)
+
+        return run
+
+    def dump(self, path: str) -> None:
+        """Write profiles of threads since the last dump"""
+        with self._lock:
+            if not self._profiles:
+                return
+            pstats.Stats(*self._profiles).dump_stats(path)
+            self._profiles = []
+            # Threads still running start new profiles
+            self._local = threading.local()
+
+    @staticmethod
+    def merge(pattern: str, path: str) -> pstats.Stats | None:
+        """Add profiles in files matching `pattern` to `path`"""
+        parts = glob.glob(pattern)
+        if os.path.isfile(path):
+            parts.append(path)
+        if not parts:
+            return None
+        stats = pstats.Stats(*parts)
+        stats.dump_stats(path)
+        for part in parts:
+            if part != path:
+                os.remove(part)
+
+        return stats
+
+
+tracer = Tracer()
+profiler = Profiler()
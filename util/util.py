@@ -1,15 +1,65 @@
 from __future__ import annotations
-import re
+import atexit
+import errno
+import fcntl
+import hashlib
+import json
 import shutil
 import subprocess
 import os
 import signal
+import socket
+import resource
+import select
+import tempfile
+import threading
+import time
 import zipfile
+from contextlib import contextmanager
+from shlex import quote
 from config import cfg
 
 
+def kill_process_group(proc: subprocess.Popen, grace: float = 0) -> bool:
+    """
+    Kill all processes in the process group of `proc`
+
+    Sends SIGTERM, and SIGKILL to processes still running after
+    `grace` seconds. Nothing is sent if the group is already gone.
+
+    Returns:
+        True if no processes are left in the group
+    """
+    for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, 5)):
+        if not has_process_group(proc):
+            return True
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return True
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            if not has_process_group(proc):
+                return True
+
+    return not has_process_group(proc)
+
+
+def has_process_group(proc: subprocess.Popen) -> bool:
+    """Check if processes are left in the process group of `proc`"""
+    # Reap the child, since it's still in the group as a zombie
+    proc.poll()
+    try:
+        os.killpg(proc.pid, 0)
+    except ProcessLookupError:
+        return False
+
+    return True
+
+
 def run_shell_cmd(command, cwd=None, timeout=None,
-                  shell=False) -> tuple[int, str, str]:
+                  shell=False, usage=None) -> tuple[int, str, str]:
     """
     Run the given command as a subprocess
 
@@ -18,6 +68,8 @@ def run_shell_cmd(command, cwd=None, timeout=None,
         cwd: Sets the current directory before the child is executed
         timeout: The number of seconds to wait before timing out the subprocess
         shell: If true, the command will be executed through the shell.
+        usage: If given, `wall_time` and `cpu_time` (seconds) and
+               `max_rss` (kB) of the subprocess are set in this dict
     Returns:
         exit code
     """
@@ -27,6 +79,7 @@ def run_shell_cmd(command, cwd=None, timeout=None,
     if not timeout:
         timeout = cfg['timeout'] - 1
 
+    t0 = time.perf_counter()
     try:
         proc = subprocess.Popen(
             command,
@@ -38,23 +91,239 @@ def run_shell_cmd(command, cwd=None, timeout=None,
             universal_newlines=True,
             start_new_session=True,
         )
-        out, err = proc.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-        return 1, 'timeout', None
     except Exception as e:
         return 1, '', e
 
-    return proc.returncode, out, err
+    # The output is read in threads, so that the process can be reaped
+    # with `wait4`, which gives the usage of this process alone
+    output = ['', '']
+    readers = [threading.Thread(target=read_pipe, args=(pipe, output, i),
+                                daemon=True)
+               for i, pipe in enumerate((proc.stdout, proc.stderr))]
+    for reader in readers:
+        reader.start()
+    rusage = wait_child(proc, timeout)
+
+    # Kill the command on timeout, and else any processes it left behind
+    if not kill_process_group(proc, cfg['kill-grace']) and rusage is None:
+        print(f"\nCould not kill process group {proc.pid}", flush=True)
+    for reader in readers:
+        # Pipes may be held open by processes outside the group
+        reader.join(1)
+    set_wall_time(usage, t0)
+    if rusage is None:
+        return 1, 'timeout', None
+
+    set_usage(usage, rusage)
+    add_usage(getattr(_children, 'usage', None), rusage)
+
+    return proc.returncode, output[0], output[1]
+
+
+def read_pipe(pipe, output: list, index: int) -> None:
+    """Read pipe until it's closed, into `output[index]`"""
+    with pipe:
+        output[index] = pipe.read()
+
+
+def wait_child(proc: subprocess.Popen, timeout: float):
+    """
+    Wait for process to exit, and reap it with `wait4`
+
+    The process is waited for on a pidfd. Where pidfd isn't
+    available, the process is polled.
+
+    Returns:
+        resource usage of the process, or None on timeout
+    """
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        try:
+            ready, _, _ = select.select([fd], [], [], timeout)
+        finally:
+            os.close(fd)
+        if not ready:
+            return None
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    else:
+        deadline = time.monotonic() + timeout
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.05)
+
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def get_thread_cpu_time() -> float:
+    """Get CPU time used by the current thread"""
+    rusage = resource.getrusage(resource.RUSAGE_THREAD)
+
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def set_usage(usage: dict, rusage) -> None:
+    if usage is None or rusage is None:
+        return
+    usage['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+    usage['max_rss'] = rusage.ru_maxrss
+
+
+def set_wall_time(usage: dict, since: float) -> None:
+    """Set seconds since `since` was read with `time.perf_counter()`"""
+    if usage is not None:
+        usage['wall_time'] = time.perf_counter() - since
+
+
+# Usage of the processes run by `run_shell_cmd` in each thread,
+# see `count_children`
+_children = threading.local()
+
+
+@contextmanager
+def count_children(usage: dict):
+    """
+    Add usage of processes run by `run_shell_cmd` in this thread in
+    the block to `usage`
+
+    Lets engines report the usage of the processes they run, like
+    ffmpeg. Each process is reaped with `wait4`, so processes run by
+    other threads aren't counted.
+    """
+    _children.usage = usage
+    try:
+        yield usage
+    finally:
+        _children.usage = None
+
+
+def add_usage(usage: dict, rusage) -> None:
+    """Add CPU time of process to `usage`, and keep the peak memory"""
+    if usage is None:
+        return
+    usage['cpu_time'] = (usage.get('cpu_time', 0) + rusage.ru_utime
+                         + rusage.ru_stime)
+    usage['max_rss'] = max(usage.get('max_rss', 0), rusage.ru_maxrss)
+
+
+SCRATCH_PREFIX = 'pwconvert-'
+# Scratch directory of each process, since workers are forked
+_scratch_dirs = {}
+_tmpdir = os.environ.get('TMPDIR')
+
+
+def get_scratch_root() -> str:
+    """Get folder for scratch directories set in application.yml"""
+    return cfg['scratch']['root'] or tempfile.gettempdir()
+
+
+def get_scratch_dir() -> str:
+    """
+    Get scratch directory of this process
+
+    The directory is created under `scratch.root` in application.yml
+    the first time it's asked for, and is set as TMPDIR for the
+    converters, so that their intermediate files are written there.
+    """
+    path = _scratch_dirs.get(os.getpid())
+    if path and os.path.isdir(path):
+        return path
+
+    root = get_scratch_root()
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f'{SCRATCH_PREFIX}{os.getpid()}-', dir=root)
+    _scratch_dirs[os.getpid()] = path
+    os.environ['TMPDIR'] = path
+
+    return path
+
+
+def remove_scratch_dir() -> None:
+    """Remove scratch directory of this process, with all its files"""
+    path = _scratch_dirs.pop(os.getpid(), None)
+    if not path:
+        return
+
+    shutil.rmtree(path, ignore_errors=True)
+    if _tmpdir is None:
+        os.environ.pop('TMPDIR', None)
+    else:
+        os.environ['TMPDIR'] = _tmpdir
+
+
+atexit.register(remove_scratch_dir)
+
+
+def clean_scratch_dirs() -> None:
+    """Remove scratch directories left by processes that are gone"""
+    root = get_scratch_root()
+    if not os.path.isdir(root):
+        return
+
+    for name in os.listdir(root):
+        if not name.startswith(SCRATCH_PREFIX):
+            continue
+        pid = name[len(SCRATCH_PREFIX):].split('-')[0]
+        if not pid.isdigit():
+            continue
+        if not pid_exists(int(pid)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process of another user
+        pass
+
+    return True
+
+
+def get_worker_id() -> str:
+    """Identify this process among workers sharing a database"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def is_stale_worker(worker_id: str) -> bool:
+    """Check if worker on this host is gone"""
+    host, _, pid = worker_id.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+
+    return not pid_exists(int(pid))
+
+
+def has_scratch_space(size: int) -> bool:
+    """Check if a file of `size` bytes should be written to scratch"""
+    if size is None:
+        return True
+    if size > cfg['scratch']['max-file-size']:
+        return False
 
+    free = shutil.disk_usage(get_scratch_dir()).free
 
-def make_filelist(source_dir: str, path: str) -> None:
-    os.chdir(source_dir)
-    cmd = 'find -type f -not -path "./.*" | cut -c 3- > "' + path + '"'
-    subprocess.run(cmd,
-                   stderr=subprocess.DEVNULL,
-                   stdout=subprocess.DEVNULL,
-                   shell=True)
+    return free - size > cfg['scratch']['min-free']
+
+
+def get_checksum(path: str, algorithm: str) -> str:
+    """Get hex digest of file with hashlib algorithm"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+
+    return digest.hexdigest()
 
 
 def remove_file(src_path: str) -> None:
@@ -62,6 +331,99 @@ def remove_file(src_path: str) -> None:
         os.remove(src_path)
 
 
+# ioctl that makes a file share the data blocks of another (Btrfs, XFS)
+FICLONE = 0x40049409
+PLACEMENTS = ('auto', 'reflink', 'hardlink', 'copy')
+
+
+def reflink(src_path: str, dest_path: str) -> None:
+    """Clone file without copying data. Raises OSError if not supported"""
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dest.close()
+            os.remove(dest_path)
+            raise
+
+
+def copy_file_range(src_path: str, dest_path: str) -> None:
+    """
+    Copy file within the kernel with `copy_file_range`
+
+    The filesystem may clone the file, or copy it on the server for
+    network filesystems. Falls back to `shutil.copyfile`, which uses
+    sendfile, where `copy_file_range` isn't supported. Some filesystems,
+    like FUSE and procfs, return 0 before the end of the file, so the
+    bytes copied are checked against the size of the source.
+    """
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        size = os.fstat(src.fileno()).st_size
+        copied = 0
+        try:
+            while n := os.copy_file_range(src.fileno(), dest.fileno(),
+                                          1 << 30):
+                copied += n
+            if copied == size:
+                return
+        except (AttributeError, OSError) as e:
+            if getattr(e, 'errno', None) not in (
+                None, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL
+            ):
+                raise
+
+    shutil.copyfile(src_path, dest_path)
+
+
+def place_file(src_path: str, dest_path: str, placement: str = None,
+               copy_from: str = None) -> str:
+    """
+    Put copy of file in destination, with as little I/O as possible
+
+    Args:
+        placement: `auto` tries reflink and then copy_file_range.
+                   `hardlink` links the file if source and destination
+                   are on the same volume, so the destination must never
+                   be changed in place. Defaults to `placement`
+                   in application.yml
+        copy_from: path to read from if the file must be copied,
+                   e.g. a prefetched copy of `src_path`
+    Returns:
+        the method used: reflink, hardlink or copy
+    """
+    placement = placement or cfg['placement']
+    if os.path.exists(dest_path):
+        if os.path.realpath(src_path) == os.path.realpath(dest_path):
+            raise shutil.SameFileError(f'{src_path} and {dest_path} are the same file')
+        os.remove(dest_path)
+
+    if placement in ('auto', 'reflink'):
+        try:
+            reflink(src_path, dest_path)
+            return 'reflink'
+        except OSError:
+            pass
+    elif placement == 'hardlink':
+        try:
+            os.link(src_path, dest_path)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    copy_file_range(copy_from or src_path, dest_path)
+    return 'copy'
+
+
+def remove_empty_dirs(path: str) -> None:
+    """Remove folder and its subfolders if they contain no files"""
+    if not os.path.isdir(path):
+        return
+
+    for root, dirs, files in os.walk(path, topdown=False):
+        if not os.listdir(root):
+            os.rmdir(root)
+
+
 def delete_file_or_dir(path: str) -> None:
     """Delete file or directory tree"""
     if os.path.isfile(path):
@@ -71,13 +433,112 @@ def delete_file_or_dir(path: str) -> None:
         shutil.rmtree(path)
 
 
-def extract_nested_zip(zipped_file: str, to_folder: str) -> None:
-    """Extract nested zipped files to specified folder"""
-    with zipfile.ZipFile(zipped_file, "r") as zfile:
-        zfile.extractall(path=to_folder)
+def get_archive_info(archive_path: str) -> tuple[int, int]:
+    """
+    Get number of entries and total uncompressed size of archive
+
+    Reads the listing of the archive without extracting it, so that
+    zip bombs can be detected before anything is written to disk.
+
+    Returns:
+        (entry count, total size), or (None, None) if the archive
+        can't be listed
+    """
+    if zipfile.is_zipfile(archive_path):
+        try:
+            with zipfile.ZipFile(archive_path) as zfile:
+                infos = zfile.infolist()
+            return len(infos), sum(info.file_size for info in infos)
+        except Exception:
+            pass
+
+    cmd = 'lsar -j ' + quote(archive_path)
+    returncode, out, err = run_shell_cmd(cmd, shell=True)
+    if returncode or not out:
+        return None, None
+
+    try:
+        entries = json.loads(out)['lsarContents']
+    except (ValueError, KeyError):
+        return None, None
+
+    files = [entry for entry in entries if not entry.get('XADIsDirectory')]
+    return len(files), sum(entry.get('XADFileSize', 0) for entry in files)
+
+
+def is_archive_bomb(archive_path: str, depth: int = 0,
+                    expanded: int = 0) -> bool:
+    """
+    Check archive against limits set in `archive` in application.yml
+
+    Only the sizes listed in the archive are checked here, and these
+    can be false. The limits are enforced on the bytes actually written
+    when the archive is extracted, see `check_extracted`.
+
+    Args:
+        archive_path: path to archive
+        depth: number of archives this archive is nested within
+        expanded: bytes already extracted from the archives it's
+                  nested within
+    Returns:
+        True if the archive exceeds any of the limits
+    """
+    limits = cfg['archive']
+    if depth >= limits['max-depth']:
+        return True
+
+    count, size = get_archive_info(archive_path)
+    if count is None:
+        return False
+
+    try:
+        check_extracted(count, size, os.path.getsize(archive_path), expanded)
+    except ArchiveLimitError:
+        return True
+
+    return False
+
+
+class ArchiveLimitError(Exception):
+    """Extraction exceeds a limit set in `archive` in application.yml"""
+
+
+def check_extracted(count: int, size: int, archive_size: int,
+                    expanded: int = 0) -> None:
+    """
+    Check files extracted from archive against limits in application.yml
+
+    Args:
+        count: number of files extracted
+        size: bytes extracted
+        archive_size: size of the archive
+        expanded: bytes extracted from the archives it's nested within
+    Raises:
+        ArchiveLimitError if any of the limits is exceeded
+    """
+    limits = cfg['archive']
+    if count > limits['max-files']:
+        raise ArchiveLimitError(f"more than {limits['max-files']} files")
+    if expanded + size > limits['max-size']:
+        raise ArchiveLimitError(f"more than {limits['max-size']} bytes")
+    if archive_size > 0 and size / archive_size > limits['max-ratio']:
+        raise ArchiveLimitError(f"more than {limits['max-ratio']} times "
+                                "the size of the archive")
+
+
+def get_tree_size(path: str) -> tuple[int, int]:
+    """Get number of files and their total size in folder tree"""
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+
+    count = 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+            count += 1
 
-    for root, dirs, files in os.walk(to_folder):
-        for filename in files:
-            if re.search(r"\.zip$", filename):
-                filespec = os.path.join(root, filename)
-                extract_nested_zip(filespec, root)
+    return count, size
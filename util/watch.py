@@ -0,0 +1,193 @@
+from __future__ import annotations
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from config import cfg
+from .scan import scan_folder, scan_tree
+
+# Events from inotify(7)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_inotify():
+    """Get libc with inotify, or None where it isn't available"""
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+
+    return libc
+
+
+class Watcher:
+    """
+    Waits for changes in a folder tree
+
+    Uses inotify where available, which tells which folders have
+    changed. Else, or when inotify can't watch all folders, `wait`
+    returns after `interval` seconds, and the whole tree must be
+    scanned.
+    """
+
+    def __init__(self, path: str, interval: float, settle: float,
+                 inotify: bool = True):
+        self._path = os.path.abspath(path)
+        self._interval = interval
+        self._settle = settle
+        # Folder of each watch, relative to path
+        self._dirs = {}
+        self._fd = None
+        self._libc = load_inotify() if inotify else None
+        if self._libc:
+            self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self._fd < 0:
+                self._fd = None
+            elif not self._add_tree(''):
+                self.close()
+
+    @property
+    def polling(self) -> bool:
+        return self._fd is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def wait(self) -> set[str] | None:
+        """
+        Wait for changes
+
+        Returns when there have been no changes for `settle` seconds,
+        so that files being copied are complete.
+
+        Returns:
+            folders with changes, relative to path, or None if the
+            whole tree must be scanned
+        """
+        if self._fd is None:
+            time.sleep(self._interval)
+            return None
+
+        changed = set()
+        timeout = None
+        while True:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                return changed
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                continue
+            if not self._read_events(data, changed):
+                # Events were lost, or a folder couldn't be watched
+                self.close()
+                return None
+            if changed:
+                timeout = self._settle
+
+    def _read_events(self, data: bytes, changed: set[str]) -> bool:
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs:
+                continue
+            folder = self._dirs[wd]
+            path = os.path.join(folder, os.fsdecode(name)) if name else folder
+            if mask & IN_DELETE_SELF:
+                changed.add(folder)
+            elif mask & IN_ISDIR:
+                # The folder itself is scanned, or found to be gone
+                changed.add(path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if not self._add_tree(path, changed):
+                        return False
+            else:
+                changed.add(folder)
+
+        return True
+
+    def _add_tree(self, folder: str, changed: set[str] = None) -> bool:
+        """Watch folder and its subfolders, which are added to `changed`"""
+        for root, dirs, files in os.walk(os.path.join(self._path, folder)):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root),
+                                              WATCH_MASK)
+            if wd < 0:
+                # Folder removed while walking, or too many watches
+                if ctypes.get_errno() == errno.ENOENT:
+                    continue
+                return False
+            rel = os.path.relpath(root, self._path)
+            self._dirs[wd] = '' if rel == '.' else rel
+            if changed is not None:
+                changed.add(self._dirs[wd])
+
+        return True
+
+
+def scan_files(source_dir: str, folders: set[str] = None,
+               settle: float = 0) -> dict[str, tuple[int, float] | None]:
+    """
+    Get size and modification time of files in folders
+
+    Files modified less than `settle` seconds ago are listed with None,
+    since they may still be written to.
+
+    Args:
+        folders: folders relative to `source_dir` whose files are
+                 listed, not including subfolders. All files in the
+                 tree if None
+    Returns:
+        size and mtime of each file, by path relative to `source_dir`
+    """
+    if folders is None:
+        scans = scan_tree(source_dir, cfg['scan']['threads'])
+    else:
+        # Hidden folders in source are skipped when scanning
+        scans = (scan_folder(source_dir, folder)[0] for folder in folders
+                 if not folder.startswith('.'))
+
+    newest = time.time() - settle
+    files = {}
+    for scanned in scans:
+        for path, size, mtime, inode in scanned:
+            files[path] = None if mtime > newest else (size, mtime)
+
+    return files